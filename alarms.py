@@ -0,0 +1,267 @@
+"""
+Alarm and threshold rules evaluated on every sample.
+
+Rules are compiled once per point list into parallel NumPy arrays.
+AlarmEngine.update() then evaluates all of them against a sample in a
+handful of array operations, and builds Python objects only for rules whose
+state changed. Thousands of rules cost well under a millisecond per sample.
+The state changes are returned as AlarmEvents. They are stored in the
+alarm_events table, and app.py also pushes them over Socket.IO.
+"""
+import time
+from collections import namedtuple
+import numpy as np
+import metrics
+import storage
+from db_writer import get_writer
+
+# --- Rule Kinds ---
+# Condition alarms stay active while their condition holds:
+#   high / low   value above / below limit; clears once back past limit -/+ hysteresis
+#   rate         |change per second| above limit; clears below limit - hysteresis
+#   on / off     value (or its bit) is set / clear
+# Edge rules fire a one-off event on each transition of the value (or its bit):
+#   rising, falling, change
+CONDITION_KINDS = ('high', 'low', 'rate', 'on', 'off')
+EDGE_KINDS = ('rising', 'falling', 'change')
+KINDS = CONDITION_KINDS + EDGE_KINDS
+_KIND_CODES = {kind: code for code, kind in enumerate(KINDS)}
+
+# Event states
+ACTIVE = 'active'
+CLEARED = 'cleared'
+FIRED = 'fired'
+
+SCHEMA = (
+    '''
+    CREATE TABLE IF NOT EXISTS alarm_events (
+        device_id INTEGER NOT NULL,
+        ts INTEGER NOT NULL,            -- milliseconds since the Unix epoch
+        rule TEXT NOT NULL,
+        state TEXT NOT NULL,            -- active, cleared or fired
+        point TEXT NOT NULL,
+        value REAL,
+        severity INTEGER NOT NULL DEFAULT 0,
+        message TEXT,
+        PRIMARY KEY (device_id, ts, rule, state)
+    ) WITHOUT ROWID
+    ''',
+    'CREATE INDEX IF NOT EXISTS alarm_events_ts ON alarm_events (ts)',
+)
+
+# Replayed spool rows (see spool.py) may repeat an event; the key absorbs that
+EVENT_INSERT_SQL = '''
+    INSERT OR IGNORE INTO alarm_events (device_id, ts, rule, state, point, value, severity, message)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+AlarmEvent = namedtuple('AlarmEvent', 'rule state value timestamp')
+
+
+def initialize_alarms(conn):
+    """Create the alarm_events table on an open connection."""
+    for statement in SCHEMA:
+        conn.execute(statement)
+    conn.commit()
+
+
+class Rule:
+    """
+    One alarm rule on a named point ('register_N', 'input_N' or a tag name).
+    bit picks one bit of the value for on/off and edge rules. on_delay is how
+    long the condition must hold before the alarm goes active, off_delay how
+    long it must be gone before it clears (seconds).
+    """
+
+    def __init__(self, name, point, kind, limit=0.0, hysteresis=0.0, bit=None,
+                 on_delay=0.0, off_delay=0.0, severity=0, message=None):
+        if kind not in KINDS:
+            raise ValueError(f"Rule {name!r}: unknown kind {kind!r}; expected one of {', '.join(KINDS)}")
+        if hysteresis < 0 or on_delay < 0 or off_delay < 0:
+            raise ValueError(f"Rule {name!r}: hysteresis and delays must be >= 0")
+        if bit is not None and not 0 <= bit < 64:
+            raise ValueError(f"Rule {name!r}: bit must be in 0..63")
+        if kind == 'rate' and limit <= 0:
+            raise ValueError(f"Rule {name!r}: a rate limit must be > 0")
+        self.name = name
+        self.point = point
+        self.kind = kind
+        self.limit = limit
+        self.hysteresis = hysteresis
+        self.bit = bit
+        self.on_delay = on_delay
+        self.off_delay = off_delay
+        self.severity = severity
+        self.message = message
+
+    def __repr__(self):
+        return f"Rule({self.name!r}, {self.point!r}, {self.kind!r})"
+
+
+class AlarmEngine:
+    """
+    Evaluates a fixed list of rules against samples laid out as points (a list
+    of names, e.g. registers, then inputs, then tag values). Missing values
+    (NaN) leave a rule's state and timers untouched. device labels the
+    engine's metrics.
+    """
+
+    def __init__(self, rules, points, device=''):
+        self.rules = list(rules)
+        self.device = device
+        index = {}
+        for i, name in enumerate(points):
+            index.setdefault(name, i)
+        missing = [rule for rule in self.rules if rule.point not in index]
+        if missing:
+            raise ValueError(f"Rules on unknown points: {missing}")
+        names = [rule.name for rule in self.rules]
+        if len(set(names)) != len(names):
+            raise ValueError("Rule names must be unique")
+
+        self.point_count = len(points)
+        self._points = np.array([index[rule.point] for rule in self.rules], dtype=np.intp)
+        kinds = np.array([_KIND_CODES[rule.kind] for rule in self.rules], dtype=np.int8)
+        self._high = kinds == _KIND_CODES['high']
+        self._low = kinds == _KIND_CODES['low']
+        self._rate = kinds == _KIND_CODES['rate']
+        self._on = kinds == _KIND_CODES['on']
+        self._off = kinds == _KIND_CODES['off']
+        self._rising = kinds == _KIND_CODES['rising']
+        self._falling = kinds == _KIND_CODES['falling']
+        self._edge = np.isin(kinds, [_KIND_CODES[kind] for kind in EDGE_KINDS])
+        self._limit = np.array([rule.limit for rule in self.rules], dtype=np.float64)
+        self._hysteresis = np.array([rule.hysteresis for rule in self.rules], dtype=np.float64)
+        self._on_delay = np.array([rule.on_delay for rule in self.rules], dtype=np.float64)
+        self._off_delay = np.array([rule.off_delay for rule in self.rules], dtype=np.float64)
+        self._bit_rules = np.array([i for i, rule in enumerate(self.rules) if rule.bit is not None], dtype=np.intp)
+        self._bits = np.array([self.rules[i].bit for i in self._bit_rules], dtype=np.uint64)
+        # Set and clear thresholds; hysteresis only widens the way back
+        self._clear_high = self._limit - self._hysteresis
+        self._clear_low = self._limit + self._hysteresis
+        self._any_rate = bool(self._rate.any())
+
+        count = len(self.rules)
+        self.active = np.zeros(count, dtype=bool)
+        self._since = np.full(count, np.nan)   # when the pending change (set or clear) started
+        self._last = np.full(count, np.nan)    # previous value, for rate and edge rules
+        self._last_time = np.full(count, np.nan)
+        self._values = np.full(count, np.nan)  # latest value seen by each rule
+        self._activated = np.full(count, np.nan)  # wall-clock time each active alarm went active
+        self._eval_seconds = metrics.ALARM_EVAL_SECONDS.labels(device)
+        self._active_gauge = metrics.ALARMS_ACTIVE.labels(device)
+        self._event_counts = {state: metrics.ALARM_EVENTS.labels(device, state) for state in (ACTIVE, CLEARED, FIRED)}
+
+    def update(self, values, now=None, timestamp=None):
+        """
+        Evaluate one sample. values is aligned with the engine's points (NaN =
+        not read), now a monotonic time for delays and rates, timestamp the
+        wall-clock time put on events. Returns the list of AlarmEvents.
+        """
+        started = time.perf_counter()
+        now = time.monotonic() if now is None else now
+        v = np.asarray(values, dtype=np.float64)[self._points]
+        if len(self._bit_rules):
+            raw = v[self._bit_rules]
+            ok = ~np.isnan(raw)
+            bits = np.full(len(raw), np.nan)
+            bits[ok] = (raw[ok].astype(np.int64).astype(np.uint64) >> self._bits[ok]) & np.uint64(1)
+            v[self._bit_rules] = bits
+        present = ~np.isnan(v)
+        last = self._last
+        seen = present & ~np.isnan(last)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            # Condition rules: what the state should be with hysteresis, before delays
+            want = np.where(self.active, v > self._clear_high, v > self._limit) & self._high
+            want |= np.where(self.active, v < self._clear_low, v < self._limit) & self._low
+            want |= (v != 0) & self._on
+            want |= (v == 0) & self._off
+            if self._any_rate:
+                rate = np.abs(v - last) / (now - self._last_time)
+                measured = seen & self._rate & (now > self._last_time)
+                want |= measured & np.where(self.active, rate > self._clear_high, rate > self._limit)
+                # Without a previous value (or time step) a rate alarm keeps its state
+                hold = self._rate & ~measured
+                want[hold] = self.active[hold]
+
+            # Edge rules fire once per transition of the value's truth
+            was, now_set = last != 0, v != 0
+            fired = seen & self._edge & (was != now_set)
+            fired &= ~(self._rising & was) & ~(self._falling & now_set)
+
+        # On/off delays: a change of state must persist for its delay before it takes effect
+        changing = present & ~self._edge & (want != self.active)
+        self._since[~changing & present] = np.nan
+        start = changing & np.isnan(self._since)
+        self._since[start] = now
+        delay = np.where(self.active, self._off_delay, self._on_delay)
+        flipped = changing & (now - self._since >= delay)
+        self.active[flipped] = ~self.active[flipped]
+        self._since[flipped] = np.nan
+
+        self._last[present] = v[present]
+        self._last_time[present] = now
+        self._values[present] = v[present]
+
+        changed = np.flatnonzero(flipped | fired)
+        events = []
+        if len(changed):
+            timestamp = time.time() if timestamp is None else timestamp
+            events = [AlarmEvent(self.rules[i], FIRED if fired[i] else (ACTIVE if self.active[i] else CLEARED),
+                                 float(v[i]), timestamp) for i in changed.tolist()]
+            self._activated[flipped & self.active] = timestamp
+            for event in events:
+                self._event_counts[event.state].inc()
+            self._active_gauge.set(int(np.count_nonzero(self.active)))
+        self._eval_seconds.observe(time.perf_counter() - started)
+        return events
+
+    def active_alarms(self):
+        """An ACTIVE AlarmEvent per alarm active now, with its latest value and the time it went active."""
+        return [AlarmEvent(self.rules[i], ACTIVE, float(self._values[i]), float(self._activated[i]))
+                for i in np.flatnonzero(self.active).tolist()]
+
+
+def block_points(register_count, input_count, tag_names=()):
+    """Point names of a sample laid out as the deadband filter sees it: registers, inputs, tags."""
+    return ([f'register_{i}' for i in range(register_count)] + [f'input_{i}' for i in range(input_count)]
+            + list(tag_names))
+
+
+# --- Events ---
+def event_record(event, device=None):
+    """JSON-able dict of an event, as pushed to Socket.IO clients."""
+    rule = event.rule
+    return {
+        'device': device, 'rule': rule.name, 'state': event.state, 'point': rule.point,
+        'kind': rule.kind, 'value': event.value, 'severity': rule.severity,
+        'message': rule.message, 'time': event.timestamp,
+    }
+
+def store_events(database, device_name, events):
+    """Queue events for the database's batched writer, like storage.store_sample."""
+    if not events:
+        return
+    device_id = storage.get_device_id(database, device_name)
+    writer = get_writer(database)
+    for event in events:
+        rule = event.rule
+        writer.submit(EVENT_INSERT_SQL, (device_id, storage.timestamp_ms(event.timestamp), rule.name, event.state,
+                                         rule.point, event.value, rule.severity, rule.message))
+
+def recent_events(conn, device_id=None, since_ms=None, limit=100):
+    """Latest stored events, newest first, as dicts."""
+    query = ('SELECT d.name, e.ts, e.rule, e.state, e.point, e.value, e.severity, e.message '
+             'FROM alarm_events e JOIN devices d ON d.id = e.device_id WHERE 1 = 1')
+    params = []
+    if device_id is not None:
+        query += ' AND e.device_id = ?'
+        params.append(device_id)
+    if since_ms is not None:
+        query += ' AND e.ts >= ?'
+        params.append(since_ms)
+    query += ' ORDER BY e.ts DESC LIMIT ?'
+    params.append(limit)
+    columns = ('device', 'time', 'rule', 'state', 'point', 'value', 'severity', 'message')
+    return [dict(zip(columns, row), time=row[1] / 1000) for row in conn.execute(query, params)]
@@ -1,15 +1,31 @@
-from flask import Flask, render_template, g
+from flask import Flask, Response, render_template, g, jsonify, request, stream_with_context
 from flask_socketio import SocketIO
-from pymodbus.client import ModbusTcpClient
-from datetime import datetime
+from pymodbus.exceptions import ConnectionException, ModbusException, ModbusIOException
+from modbus_pool import get_pool
+from db_writer import configure_connection, close_writers
+import metrics
+import storage
+import history
+import export
+from scheduler import ScanTimer
+from deadband import DeadbandFilter
+from read_plan import Tag
+from tag_decoder import TagDecoder
+import live_frames
+import latest_cache
+import alarms
+from alarms import Rule
+import rollup
+import writes
 import sqlite3
 import time
 import threading
 import eventlet
 import atexit
+import json
 import logging
 
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=logging.INFO)
 
 app = Flask(__name__)
 socketio = SocketIO(app, async_mode='eventlet')  # Specify async_mode
@@ -18,14 +34,57 @@ socketio = SocketIO(app, async_mode='eventlet')  # Specify async_mode
 MODBUS_HOST = '127.0.0.1'
 MODBUS_PORT = 502
 SLAVE_ID = 1
+DEVICE_NAME = 'plc-1'  # Name the samples are stored under (matches master.DEVICES)
 REGISTER_COUNT = 20
 INPUT_COUNT = 20
+# Typed tags decoded from the register/input blocks above and pushed next to
+# them as engineering values, e.g.
+#     Tag('flow_m3h', 3, 4, 'float32', word_order='little'), Tag('running', 3, 10, bits=0)
+# Addresses must fall inside the blocks (holding registers and inputs from 0).
+TAGS = []
 DATABASE = 'modbus_data.db'
+# The rollup/retention job runs in master.py, the logger. Turn it on here only
+# when app.py stores its own samples (LIVE_SOURCE = 'modbus') with no master.py
+# running; two jobs on one database just compete for its write lock.
+ROLLUP_ENABLED = False
+FETCH_INTERVAL = 0.5   # Seconds between background_fetch cycles
+
+# Where background_fetch gets samples: 'modbus' polls the PLC from this process
+# and stores what it reads; 'cache' reads the shared latest-value segment that
+# master.py publishes, so any number of web workers add no device load (and
+# leave storage to master.py).
+# replay.py sets 'replay' and feeds recorded samples to publish_sample() instead.
+LIVE_SOURCE = 'modbus'
+LATEST_CACHE_PATH = latest_cache.CACHE_PATH
+
+# --- Report-by-Exception ---
+# Samples are stored and pushed only when a point moved past its deadband or
+# has been silent for MAX_SILENCE. Inputs always report on change.
+DEFAULT_DEADBAND = (0, 0.0)   # (absolute counts, percent of last reported value) for registers
+REGISTER_DEADBANDS = {}       # Per-register overrides, e.g. {3: (5, 0.0), 7: (0, 1.0)}
+TAG_DEADBANDS = {}            # {tag name: (absolute, percent)} in engineering units; default any change
+MAX_SILENCE = 60.0            # Seconds before an unchanged point is reported anyway
+
+# --- Alarms ---
+# Rules on 'register_N', 'input_N' or tag names, evaluated on every sample
+# (before the deadband), e.g.
+#     Rule('tank_high', 'register_3', 'high', limit=900, hysteresis=20, on_delay=5),
+#     Rule('pump_trip', 'input_2', 'falling', severity=2, message='Pump tripped')
+# State changes are stored in alarm_events and pushed as 'alarm_events'.
+ALARM_RULES = []
+
+# --- Writes ---
+# Coils and holding registers of the device, written through /api/write and
+# the 'write' Socket.IO event. Writes are coalesced and batched by writes.py.
+# WRITABLE limits the addresses, e.g. {'register': [(100, 20)], 'coil': [(0, 16)]};
+# None allows every address.
+WRITABLE = None
+WRITE_RATE_LIMIT = writes.RATE_LIMIT  # Write requests per second sent to the device
 
 # --- Database Initialization ---
 def connect_db():
     """Connect to the SQLite database."""
-    conn = sqlite3.connect(DATABASE)
+    conn = configure_connection(sqlite3.connect(DATABASE))
     conn.row_factory = sqlite3.Row  # Optional: to access columns by name
     return conn
 
@@ -49,144 +108,275 @@ def teardown_db(exception):
 def initialize_database():
     """Initialize the database and create tables if they don't exist."""
     with app.app_context():
-        conn = get_db()
-        cursor = conn.cursor()
-
-        # Create holding_registers table
-        cursor.execute(f'''
-            CREATE TABLE IF NOT EXISTS holding_registers (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                timestamp DATETIME NOT NULL,
-                {', '.join([f'register_{i} INTEGER' for i in range(REGISTER_COUNT)])}
-            )
-        ''')
-
-        # Create coil_status table
-        cursor.execute(f'''
-            CREATE TABLE IF NOT EXISTS coil_status (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                timestamp DATETIME NOT NULL,
-                {', '.join([f'coil_{i} INTEGER' for i in range(INPUT_COUNT)])}
-            )
-        ''')
-
-        conn.commit()
-
-def insert_data_into_database(registers, inputs):
-    """Insert data into the database."""
-    with app.app_context():  # Ensure we're in an application context
-        conn = get_db()
-        cursor = conn.cursor()
-
-        print(f"registers [{registers}]")
-        print(f"inputs [{inputs}]")
-
-        # Validate lengths
-        if len(registers) != REGISTER_COUNT:
-            raise ValueError(f"Expected {REGISTER_COUNT} registers, but got {len(registers)}")
-        if len(inputs) != INPUT_COUNT:
-            raise ValueError(f"Expected {INPUT_COUNT} inputs, but got {len(inputs)}")
+        # Packed one-row-per-sample schema shared with master.py (see storage.py)
+        storage.initialize_schema(get_db())
+        rollup.initialize_rollups(get_db())
+        alarms.initialize_alarms(get_db())
+
+def insert_data_into_database(registers, inputs, tag_values=None, ts=None):
+    """Queue one sample (and the decoded values of TAGS) for the shared batched database writer."""
+    # Validate lengths
+    if len(registers) != REGISTER_COUNT:
+        raise ValueError(f"Expected {REGISTER_COUNT} registers, but got {len(registers)}")
+    if len(inputs) != INPUT_COUNT:
+        raise ValueError(f"Expected {INPUT_COUNT} inputs, but got {len(inputs)}")
+
+    stored = [i for i, tag in enumerate(TAGS) if not tag.raw]
+    storage.store_sample(DATABASE, DEVICE_NAME, registers, [int(bool(value)) for value in inputs], ts,
+                         tag_names=[TAGS[i].name for i in stored] if stored else None,
+                         tag_values=tag_values[stored] if stored and tag_values is not None else None)
+
+# --- Socket.IO Emits ---
+_emit_counts = {}
+
+def emit_counted(event, data, to=None):
+    """socketio.emit that records message count and payload size for /metrics."""
+    counters = _emit_counts.get(event)
+    if counters is None:
+        counters = _emit_counts[event] = (metrics.SOCKETIO_EMITS.labels(event),
+                                          metrics.SOCKETIO_BYTES.labels(event))
+    size = len(data) if isinstance(data, (bytes, bytearray)) else len(json.dumps(data))
+    socketio.emit(event, data, to=to)
+    counters[0].inc()
+    counters[1].inc(size)
+
+# --- Live Frames ---
+# Labels go out once per connection as the schema; after that clients get
+# binary frames with only the changed points (see live_frames.py).
+LIVE_SCHEMA = live_frames.build_schema(REGISTER_COUNT, INPUT_COUNT, TAGS)
+_live_encoder = live_frames.LiveFrameEncoder(len(LIVE_SCHEMA['points']), float64=LIVE_SCHEMA['float64'])
+_tag_decoder = TagDecoder(TAGS, [(3, 0, REGISTER_COUNT), (2, 0, INPUT_COUNT)])
+
+def send_keyframe(sid):
+    """Send the latest full frame to one client so it need not wait for the next keyframe."""
+    frame = _live_encoder.keyframe()
+    if frame is not None:
+        emit_counted('live_frame', frame, to=sid)
+
+@socketio.on('connect')
+def live_connect():
+    emit_counted('live_schema', LIVE_SCHEMA, to=request.sid)
+    send_keyframe(request.sid)
+    emit_counted('alarm_state', active_alarm_records(), to=request.sid)
+
+@socketio.on('live_resync')
+def live_resync():
+    """A client saw a gap in the frame sequence and asks for a keyframe."""
+    send_keyframe(request.sid)
 
+# --- Fetch Live Data from Modbus ---
+_read_latency = metrics.READ_LATENCY.labels(DEVICE_NAME)
+_read_errors = metrics.READ_ERRORS.labels(DEVICE_NAME)
+_read_timeouts = metrics.READ_TIMEOUTS.labels(DEVICE_NAME)
+_suppressed = metrics.SAMPLES_SUPPRESSED.labels(DEVICE_NAME)
+_deadband = DeadbandFilter.for_points(REGISTER_COUNT, INPUT_COUNT, REGISTER_DEADBANDS,
+                                      DEFAULT_DEADBAND, MAX_SILENCE,
+                                      [TAG_DEADBANDS.get(tag.name, (0, 0.0)) for tag in TAGS])
+_alarm_engine = alarms.AlarmEngine(ALARM_RULES, alarms.block_points(REGISTER_COUNT, INPUT_COUNT,
+                                                                    [tag.name for tag in TAGS]), DEVICE_NAME)
+
+writes.register_device(DEVICE_NAME, MODBUS_HOST, MODBUS_PORT, SLAVE_ID, WRITE_RATE_LIMIT, writable=WRITABLE)
+
+def active_alarm_records():
+    return [alarms.event_record(event, DEVICE_NAME) for event in _alarm_engine.active_alarms()]
+
+def read_modbus_sample():
+    """Read one sample from the PLC. Returns (registers, inputs), or None after emitting the error."""
+    registers = None
+    inputs = None
+    try:
+        with get_pool().connection(MODBUS_HOST, MODBUS_PORT, SLAVE_ID) as client:
+            if client is None:
+                _read_errors.inc()
+                emit_counted('live_error', {'error': 'Failed to connect to Modbus server'})
+                return
+
+            started = time.perf_counter()
+
+            # Read Holding Registers
+            reg_response = client.read_holding_registers(address=0, count=REGISTER_COUNT, slave=SLAVE_ID)
+
+            if reg_response.isError():
+                _read_errors.inc()
+                emit_counted('live_error', {'error': 'Error reading holding registers'})
+                return
+            elif hasattr(reg_response, 'registers') and len(reg_response.registers) == REGISTER_COUNT:
+                registers = reg_response.registers
+            else:
+                # Handle unexpected response or length mismatch
+                print(f"Unexpected response or length for Holding Registers: {reg_response}")
+                return
+
+            # Read Discrete Inputs
+            input_response = client.read_discrete_inputs(address=0, count=INPUT_COUNT, slave=SLAVE_ID)
+
+            if input_response.isError():
+                _read_errors.inc()
+                emit_counted('live_error', {'error': 'Error reading discrete inputs'})
+                return
+            elif hasattr(input_response, 'bits'):
+                actual_bits_returned = len(input_response.bits)
+                if actual_bits_returned >= INPUT_COUNT:
+                    # Store result under the 'inputs' key
+                    inputs = input_response.bits[:INPUT_COUNT]
+                else:
+                    # Handle receiving fewer bits than expected
+                    print(f"Warning: Requested {INPUT_COUNT} inputs, received {actual_bits_returned}. Storing received bits.")
+                    inputs = input_response.bits
+            else:
+                # Handle unexpected response object
+                print(f"Unexpected response object for Discrete Inputs: {input_response}")
+                return
+            _read_latency.observe(time.perf_counter() - started)
+    except ConnectionException as e:
+        # The pool has already dropped the broken socket; the next cycle reconnects
+        _read_errors.inc()
+        logging.error(f'Modbus connection lost: {e}')
+        emit_counted('live_error', {'error': 'Failed to connect to Modbus server'})
+        return
+    except ModbusIOException as e:
+        # No reply in time; the pool has dropped the socket so a late reply cannot be misread
+        _read_timeouts.inc()
+        logging.error(f'Modbus read timed out: {e}')
+        emit_counted('live_error', {'error': 'Modbus server did not respond'})
+        return
+    except ModbusException as e:
+        _read_errors.inc()
+        logging.error(f'Modbus read failed: {e}')
+        emit_counted('live_error', {'error': 'Modbus read failed'})
+        return
+    return registers, inputs
+
+# --- Shared Latest-Value Cache ---
+_cache_reader = None
+_last_cache_seq = None
+
+def get_cache_reader():
+    """Open the latest-value segment on first use; None while no publisher has created it."""
+    global _cache_reader
+    if _cache_reader is None:
         try:
-            # Insert data into holding_registers table
-            cursor.execute(f'''
-                INSERT INTO holding_registers (timestamp, {', '.join([f'register_{i}' for i in range(REGISTER_COUNT)])})
-                VALUES (?, {', '.join(['?' for _ in range(REGISTER_COUNT)])})
-            ''', [datetime.now()] + registers)
-
-            # Insert data into coil_status table
-            cursor.execute(f'''
-                INSERT INTO coil_status (timestamp, {', '.join([f'coil_{i}' for i in range(INPUT_COUNT)])})
-                VALUES (?, {', '.join(['?' for _ in range(INPUT_COUNT)])})
-            ''', [datetime.now()] + inputs)
-
-            conn.commit()
-        except Exception as e:
-            conn.rollback()
-            raise e
+            _cache_reader = latest_cache.LatestCacheReader(LATEST_CACHE_PATH)
+        except (OSError, ValueError) as e:
+            logging.warning(f'Latest-value cache unavailable: {e}')
+    return _cache_reader
+
+def read_cached_sample():
+    """Latest sample of DEVICE_NAME from the shared cache, or None if there is nothing new."""
+    global _last_cache_seq
+    reader = get_cache_reader()
+    try:
+        value = reader.read(DEVICE_NAME) if reader is not None else None
+    except (OSError, ValueError) as e:
+        # Slot rewritten too often to read, or the poller is re-initializing the segment
+        logging.warning(f'Latest-value cache unavailable: {e}')
+        emit_counted('live_error', {'error': 'Latest-value cache unavailable'})
+        return
+    if value is None:
+        emit_counted('live_error', {'error': f'No data published for {DEVICE_NAME}; is master.py running?'})
+        return
+    if time.time() - value.timestamp > latest_cache.STALE_AFTER:
+        emit_counted('live_error', {'error': f'Latest data for {DEVICE_NAME} is stale'})
+        return
+    if value.seq == _last_cache_seq:
+        return
+    _last_cache_seq = value.seq
+    if value.quality != latest_cache.Q_REGISTERS | latest_cache.Q_INPUTS:
+        emit_counted('live_error', {'error': f'Poller could not read {DEVICE_NAME}'})
+        return
+    return value.registers.tolist(), value.inputs.tolist()
 
-# --- Fetch Live Data from Modbus ---
+# --- Push and Store One Sample ---
 def fetch_live_data():
-    """Fetch live data from the Modbus server and update the database."""
-    client = ModbusTcpClient(MODBUS_HOST, port=MODBUS_PORT)
-    if not client.connect():
-        socketio.emit('live_data', {'error': 'Failed to connect to Modbus server'})
+    """Fetch the latest sample, push the points that changed and store it."""
+    sample = read_cached_sample() if LIVE_SOURCE == 'cache' else read_modbus_sample()
+    if sample is None:
+        return
+    # Cached samples were already stored by the process that polled them
+    publish_sample(*sample, store=LIVE_SOURCE != 'cache')
+
+def publish_sample(registers, inputs, timestamp=None, store=True):
+    """
+    Evaluate alarms, push the points that changed and store one sample.
+    timestamp is the sample's unix time; replayed samples pass their recorded
+    one, which then also drives deadband heartbeats and alarm delays.
+    """
+    if len(registers) != REGISTER_COUNT:
+        logging.error(f'Expected {REGISTER_COUNT} registers, but got {len(registers)}')
+    if len(inputs) != INPUT_COUNT:
+        logging.error(f'Expected {INPUT_COUNT} inputs, but got {len(inputs)}')
+
+    if len(registers) != REGISTER_COUNT or len(inputs) != INPUT_COUNT:
+        emit_counted('live_error', {'error': 'Incomplete read, live values not updated'})
+        return
+
+    # Engineering values of all TAGS in one vectorized pass over both blocks
+    tag_values, _ = _tag_decoder.decode([registers, inputs])
+    values = list(registers) + [int(bool(value)) for value in inputs] + tag_values.tolist()
+    now = time.monotonic() if timestamp is None else timestamp
+    timestamp = time.time() if timestamp is None else timestamp
+
+    # Alarms see every sample, including those the deadband suppresses below
+    if ALARM_RULES:
+        events = _alarm_engine.update(values, now, timestamp)
+        if events:
+            emit_counted('alarm_events', [alarms.event_record(event, DEVICE_NAME) for event in events])
+            if store:
+                alarms.store_events(DATABASE, DEVICE_NAME, events)
+
+    # Nothing moved past its deadband and no heartbeat is due: neither push nor store
+    report = _deadband.update_blocks(registers, inputs, REGISTER_COUNT, INPUT_COUNT, now, tag_values)
+    if not report.any():
+        _suppressed.inc()
         return
 
+    # Push only the reported points, as a binary delta frame
+    frame = _live_encoder.encode(values, timestamp, report)
+    emit_counted('live_frame', frame)
+
+    # Hand the sample to the write-behind writer; it batches inserts on its own thread
+    if not store:
+        return
     try:
-        # Read Holding Registers
-        reg_response = client.read_holding_registers(address=0, count=REGISTER_COUNT, slave=SLAVE_ID)
-        
-        if reg_response.isError():
-            socketio.emit('live_data', {'error': 'Error reading holding registers'})
-            return
-        elif hasattr(reg_response, 'registers') and len(reg_response.registers) == REGISTER_COUNT:
-            registers = reg_response.registers
-        else:
-            # Handle unexpected response or length mismatch
-             print(f"Unexpected response or length for Holding Registers: {reg_response}")
-
-
-        # Read Discrete Inputs
-        input_response = client.read_discrete_inputs(address=0, count=INPUT_COUNT, slave=SLAVE_ID)
-        
-        if input_response.isError():
-            socketio.emit('live_data', {'error': 'Error reading discrete inputs'})
-            return
-        elif hasattr(input_response, 'bits'):
-            actual_bits_returned = len(input_response.bits)
-            if actual_bits_returned >= INPUT_COUNT:
-                 # Store result under the 'inputs' key
-                inputs = input_response.bits[:INPUT_COUNT]
-                # print("Discrete Inputs read successfully.")
-            else:
-                # Handle receiving fewer bits than expected
-                print(f"Warning: Requested {INPUT_COUNT} inputs, received {actual_bits_returned}. Storing received bits.")
-                inputs = input_response.bits
-        else:
-            # Handle unexpected response object
-            print(f"Unexpected response object for Discrete Inputs: {input_response}")
-
-        
-        logging.debug(f'Inputs: {inputs}')
-        logging.debug(f'Number of inputs: {len(inputs)}')
-
-        if len(registers) != REGISTER_COUNT:
-            logging.error(f'Expected {REGISTER_COUNT} registers, but got {len(registers)}')
-        if len(inputs) != INPUT_COUNT:
-            logging.error(f'Expected {INPUT_COUNT} inputs, but got {len(inputs)}')
-
-        # Get current timestamp
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-
-        # Emit live data with labels and timestamp
-        data = {
-            'timestamp': timestamp,
-            'registers': [{'label': f'Register {i}', 'value': reg} for i, reg in enumerate(registers)],
-            'inputs': [{'label': f'Input {i}', 'value': input} for i, input in enumerate(inputs)],
-        }
-        socketio.emit('live_data', data)
-
-        # Start a new thread to insert data into the database
-        threading.Thread(target=insert_data_into_database, args=(registers, inputs), daemon=True).start()
-
-    finally:
-        client.close()
+        insert_data_into_database(registers, inputs, tag_values, storage.timestamp_ms(timestamp))
+    except ValueError as e:
+        logging.error(f'Sample not stored: {e}')
 
 # Start the background thread to fetch data
 def background_fetch(stop_event):
-    """Background task to fetch live data at regular intervals."""
-    while not stop_event.is_set():
-        fetch_live_data()
-        time.sleep(0.5)  # Adjust the sleep time as needed
+    """Background task to fetch live data every FETCH_INTERVAL on monotonic deadlines."""
+    timer = ScanTimer(FETCH_INTERVAL, name='live_fetch')
+    while not stop_event.wait(timer.due_in()):
+        timer.begin()
+        try:
+            fetch_live_data()
+        except Exception:
+            # This is the only fetch thread; one bad cycle must not end live push and storage
+            metrics.FETCH_ERRORS.inc()
+            logging.exception('Live data fetch failed')
+        finally:
+            timer.end()
+            metrics.FETCH_CYCLE.observe(timer.stats.last_duration)
+            if timer.stats.last_duration > FETCH_INTERVAL:
+                metrics.FETCH_OVERRUNS.inc()
 
 @app.before_first_request
 def start_data_fetch():
     """Initialize the background data fetch thread."""
-    stop_event = threading.Event()
-    thread = threading.Thread(target=background_fetch, args=(stop_event,), daemon=True)
-    thread.start()
-    atexit.register(lambda: stop_event.set())  # Ensure the thread stops when the application exits
+    if LIVE_SOURCE != 'replay':
+        stop_event = threading.Event()
+        thread = threading.Thread(target=background_fetch, args=(stop_event,), daemon=True)
+        thread.start()
+        atexit.register(lambda: stop_event.set())  # Ensure the thread stops when the application exits
+    atexit.register(get_pool().close_all)
+    atexit.register(close_writers)
+    atexit.register(writes.close_queues)  # registered last, so queued writes go out before the pool closes
+
+    # Keep the 1m/1h/1d rollups current and prune old rows off the request path
+    if ROLLUP_ENABLED:
+        rollup_job = rollup.RollupJob(DATABASE)
+        rollup_job.start()
+        atexit.register(rollup_job.stop)
 
 # --- Routes ---
 @app.route('/')
@@ -198,6 +388,212 @@ def dashboard():
 def live_data():
     return render_template('live_data.html')
 
+# --- Connection Pool Statistics ---
+@app.route('/api/pool_stats')
+def pool_stats():
+    return jsonify(get_pool().stats())
+
+# --- Prometheus Metrics ---
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+# --- Latest Values ---
+@app.route('/api/latest')
+def api_latest():
+    """Latest published sample of every device (or ?device=name), straight from shared memory."""
+    reader = get_cache_reader()
+    if reader is None:
+        return jsonify({'error': 'Latest-value cache not available; is master.py running?'}), 503
+    device = request.args.get('device')
+    try:
+        if device is None:
+            return jsonify([latest_cache.to_json(value) for value in reader.read_all()])
+        value = reader.read(device)
+    except (OSError, ValueError) as e:
+        return jsonify({'error': f'Latest-value cache unavailable: {e}'}), 503
+    if value is None:
+        return jsonify({'error': f'Unknown device {device!r}'}), 404
+    return jsonify(latest_cache.to_json(value))
+
+# --- Historical Data ---
+@app.route('/api/history')
+def api_history():
+    """
+    Downsampled history: /api/history?start=...&end=...&points=register_0,input_3&bucket=60
+    start/end are unix seconds or ISO 8601, bucket is in seconds. Each bucket
+    carries min/max/avg/last per point and is streamed as it is computed.
+    """
+    try:
+        start_ms = history.parse_time_ms(request.args['start'])
+        end_ms = history.parse_time_ms(request.args['end'])
+        bucket_ms = int(float(request.args.get('bucket', 60)) * 1000)
+        points = history.parse_points(request.args.get('points', ''))
+    except KeyError as e:
+        return jsonify({'error': f'Missing parameter {e}'}), 400
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    if end_ms <= start_ms or bucket_ms <= 0:
+        return jsonify({'error': 'Expected start < end and a positive bucket'}), 400
+    if (end_ms - start_ms) // bucket_ms > history.MAX_BUCKETS:
+        return jsonify({'error': f'Too many buckets; at most {history.MAX_BUCKETS} per request'}), 400
+
+    device = request.args.get('device', DEVICE_NAME)
+    device_id = storage.find_device_id(get_db(), device)
+    if device_id is None:
+        return jsonify({'error': f'Unknown device {device!r}'}), 404
+
+    # Served from the coarsest rollup tier that fits the bucket size, raw samples for the rest
+    chunks = rollup.history_stat_chunks(get_db(), device_id, start_ms, end_ms, bucket_ms, points)
+    header = {
+        'device': device,
+        'start': start_ms,
+        'end': end_ms,
+        'bucket_ms': bucket_ms,
+        'points': [name for name, _, _ in points],
+    }
+    body = history.stream_history_json(header, history.iter_buckets(chunks, bucket_ms))
+    return Response(stream_with_context(body), mimetype='application/json')
+
+# --- Alarms ---
+@app.route('/api/alarms')
+def api_alarms():
+    """Active alarms of this process's rules and the latest stored events: /api/alarms?since=...&limit=100"""
+    try:
+        since_ms = history.parse_time_ms(request.args['since']) if 'since' in request.args else None
+        limit = min(int(request.args.get('limit', 100)), 10000)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    device = request.args.get('device')
+    device_id = None
+    if device is not None:
+        device_id = storage.find_device_id(get_db(), device)
+        if device_id is None:
+            return jsonify({'error': f'Unknown device {device!r}'}), 404
+    return jsonify({
+        'active': active_alarm_records(),
+        'events': alarms.recent_events(get_db(), device_id, since_ms, limit),
+    })
+
+# --- Writes ---
+# Status code of each error a write can be refused with; the first match wins
+WRITE_ERROR_STATUS = ((PermissionError, 403), (writes.QueueFull, 503), (LookupError, 404),
+                      (ValueError, 400), (RuntimeError, 503))
+
+def submit_writes(data):
+    """
+    Queue the writes of an /api/write body or 'write' event and return their
+    tickets. Every write is checked before the first is queued.
+    """
+    if not isinstance(data, dict):
+        raise ValueError('Expected a JSON object')
+    queue = writes.get_queue(data.get('device', DEVICE_NAME))
+    items = data['writes'] if 'writes' in data else [data]
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        raise ValueError('Expected writes to be a list of objects')
+    requested = []
+    for item in items:
+        values = item['values'] if 'values' in item else [item.get('value')]
+        if not isinstance(values, list):
+            raise ValueError('Expected values to be a list')
+        queue.check(item.get('kind'), item.get('address'), values)
+        requested.append((item['kind'], item['address'], values))
+    return [writes.submit(queue.name, kind, address, values) for kind, address, values in requested]
+
+def write_error(e):
+    """(message, status) for an exception raised by submit_writes, or None to let it propagate."""
+    for error_type, status in WRITE_ERROR_STATUS:
+        if isinstance(e, error_type):
+            return {'error': str(e)}, status
+    return None
+
+@app.route('/api/write', methods=['POST'])
+def api_write():
+    """
+    Write coils and holding registers:
+        POST /api/write?wait=5
+        {"device": "plc-1", "writes": [{"kind": "register", "address": 100, "values": [1, 2]},
+                                       {"kind": "coil", "address": 3, "value": true}]}
+    A body may also be a single write. Waits up to wait seconds (default
+    writes.WRITE_TIMEOUT, 0 to not wait) and answers 200 once everything is
+    written, 202 while some writes are pending (see /api/write/<id>) and 502
+    if any failed.
+    """
+    try:
+        wait = max(0.0, min(float(request.args.get('wait', writes.WRITE_TIMEOUT)), writes.WRITE_TIMEOUT))
+        tickets = submit_writes(request.get_json(force=True))
+    except Exception as e:
+        error = write_error(e)
+        if error is None:
+            raise
+        return jsonify(error[0]), error[1]
+    done = writes.wait_all(tickets, wait) if wait else all(ticket.done() for ticket in tickets)
+    status = 202 if not done else (502 if any(ticket.state == writes.FAILED for ticket in tickets) else 200)
+    return jsonify({'writes': [ticket.as_dict() for ticket in tickets]}), status
+
+@app.route('/api/write/<int:ticket_id>')
+def api_write_status(ticket_id):
+    """State of a recent write, as returned by /api/write."""
+    ticket = writes.find_ticket(ticket_id)
+    if ticket is None:
+        return jsonify({'error': f'Unknown or expired write {ticket_id}'}), 404
+    return jsonify(ticket.as_dict())
+
+@socketio.on('write')
+def live_write(data):
+    """
+    Queue writes like /api/write. The acknowledgement carries the tickets;
+    'write_result' then goes to the sender as each of them completes.
+    """
+    sid = request.sid
+    try:
+        tickets = submit_writes(data)
+    except Exception as e:
+        error = write_error(e)
+        if error is None:
+            raise
+        return dict(error[0], status=error[1])
+    for ticket in tickets:
+        ticket.add_done_callback(lambda ticket: emit_counted('write_result', ticket.as_dict(), to=sid))
+    return {'writes': [ticket.as_dict() for ticket in tickets]}
+
+# --- Bulk Export ---
+@app.route('/api/export')
+def api_export():
+    """
+    Raw samples of a time range: /api/export?start=...&end=...&device=plc-1,plc-2&format=csv
+    device may be '*' for all devices; points (register_N/input_N) limits the
+    columns. CSV is gzip-compressed when the client accepts it. The response
+    is streamed chunk by chunk, so its size is not limited by memory.
+    """
+    try:
+        start_ms = history.parse_time_ms(request.args['start'])
+        end_ms = history.parse_time_ms(request.args['end'])
+        points = history.parse_points(request.args['points']) if 'points' in request.args else None
+        format = request.args.get('format', 'csv')
+        devices = export.resolve_devices(get_db(), request.args.get('device', DEVICE_NAME))
+        blocks = export.export(get_db(), devices, start_ms, end_ms, format, points)
+    except KeyError as e:
+        return jsonify({'error': f'Missing parameter {e}'}), 400
+    except LookupError as e:
+        return jsonify({'error': str(e)}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except RuntimeError as e:
+        return jsonify({'error': str(e)}), 501
+    if end_ms <= start_ms:
+        return jsonify({'error': 'Expected start < end'}), 400
+
+    filename = f'export-{start_ms // 1000}-{end_ms // 1000}.{format}'
+    headers = {'Content-Disposition': f'attachment; filename={filename}'}
+    if format == 'parquet':
+        return Response(stream_with_context(blocks), mimetype='application/vnd.apache.parquet', headers=headers)
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        headers['Content-Encoding'] = 'gzip'
+        blocks = export.gzip_stream(blocks)
+    return Response(stream_with_context(blocks), mimetype='text/csv', headers=headers)
+
 if __name__ == '__main__':
     initialize_database()
     eventlet.monkey_patch()
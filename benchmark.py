@@ -0,0 +1,260 @@
+"""
+End-to-end throughput benchmark: poll -> store -> push against the local simulator.
+
+    python benchmark.py --devices 1,10,100 --intervals 1.0,0.1 --duration 10
+    python benchmark.py --compare bench_results_old.json bench_results.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+# --- Configuration ---
+SIM_HOST = '127.0.0.1'
+SIM_PORT = 5030
+SIM_UNITS = 250                   # Unit ids the simulator serves; devices cycle through them
+DEVICE_COUNTS = [1, 10, 50, 100]
+POLL_INTERVALS = [1.0, 0.5, 0.1]  # Seconds per device cycle
+APP_RATES = [2, 10, 50]           # fetch_live_data calls per second
+DURATION = 10.0                   # Seconds per scenario
+DEFAULT_OUTPUT = 'bench_results.json'
+
+
+def percentiles(samples):
+    """p50/p95/p99/max of a list of seconds, reported in milliseconds."""
+    if not samples:
+        return {'p50': None, 'p95': None, 'p99': None, 'max': None}
+    values = np.asarray(samples) * 1000.0
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {'p50': round(float(p50), 3), 'p95': round(float(p95), 3),
+            'p99': round(float(p99), 3), 'max': round(float(values.max()), 3)}
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# --- Simulator ---
+def start_simulator(latency, jitter):
+    """Run simulator.py in a child process so it does not share our GIL."""
+    process = subprocess.Popen(
+        [sys.executable, 'simulator.py', '--host', SIM_HOST, '--port', str(SIM_PORT),
+         '--units', f'1-{SIM_UNITS}', '--latency', str(latency), '--jitter', str(jitter)],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # Wait until the port accepts connections
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((SIM_HOST, SIM_PORT), timeout=0.5).close()
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError('Simulator did not start')
+
+
+# --- Poller Scenario (master.run_modbus_logger path) ---
+def bench_poller(device_count, interval, duration, database):
+    """Poll device_count simulated devices through AsyncPoller and the batched writer."""
+    import master
+    from db_writer import get_writer
+    from poller import AsyncPoller, Device
+
+    master.DATABASE_NAME = database
+    master.initialize_database()
+    devices = [
+        Device(f'bench-{i}', SIM_HOST, port=SIM_PORT, slave=i % SIM_UNITS + 1, interval=interval,
+               reg_start=master.REG_START_ADDRESS, reg_count=master.REGISTER_COUNT,
+               input_start=master.INPUT_START_ADDRESS, input_count=master.INPUT_COUNT)
+        for i in range(device_count)
+    ]
+    latencies = []
+    connected = set()
+    reads = [0]
+
+    def on_sample(device, data):
+        # The first successful read of each device includes the TCP connect; leave it out
+        if 'latency' in data:
+            reads[0] += 1
+            if device.name in connected:
+                latencies.append(data['latency'])
+            connected.add(device.name)
+        master.store_sample(device.name, data.get('registers'), data.get('inputs'))
+
+    writer = get_writer(database)
+    rows_before = writer.stats['rows_written']
+    poller = AsyncPoller(devices, on_sample, max_concurrency=master.MAX_CONCURRENT_POLLS)
+
+    async def run():
+        asyncio.get_running_loop().call_later(duration, poller.stop)
+        await poller.run()
+
+    started = time.perf_counter()
+    asyncio.run(run())
+    writer.flush()
+    elapsed = time.perf_counter() - started
+
+    stats = poller.stats.values()
+    return {
+        'scenario': 'poller',
+        'devices': device_count,
+        'interval': interval,
+        'duration': round(elapsed, 3),
+        'target_polls_per_sec': round(device_count / interval, 2),
+        'polls_per_sec': round(reads[0] / elapsed, 2),
+        'timeouts': sum(s.timeouts for s in stats),
+        'errors': sum(s.errors for s in stats),
+        'missed_cycles': sum(s.missed_cycles for s in stats),
+        'read_latency_ms': percentiles(latencies),
+        'db_rows_per_sec': round((writer.stats['rows_written'] - rows_before) / elapsed, 2),
+    }
+
+
+# --- App Scenario (app.fetch_live_data path) ---
+def bench_app(rate, duration, database):
+    """Drive app.fetch_live_data at rate Hz with a Socket.IO test client attached."""
+    import app
+    from db_writer import get_writer
+
+    app.MODBUS_HOST, app.MODBUS_PORT, app.DATABASE = SIM_HOST, SIM_PORT, database
+    app.initialize_database()
+    client = app.socketio.test_client(app.app)
+
+    emit_latencies = []
+    emit_bytes = []
+    original_emit = app.socketio.emit
+
+    def timed_emit(event, *args, **kwargs):
+        started = time.perf_counter()
+        result = original_emit(event, *args, **kwargs)
+        emit_latencies.append(time.perf_counter() - started)
+        if args:
+            emit_bytes.append(len(args[0]) if isinstance(args[0], (bytes, bytearray)) else len(json.dumps(args[0])))
+        return result
+
+    app.socketio.emit = timed_emit
+    writer = get_writer(database)
+    rows_before = writer.stats['rows_written']
+    cycle_latencies = []
+    period = 1.0 / rate
+    try:
+        started = time.perf_counter()
+        deadline = time.monotonic()
+        end = deadline + duration
+        while deadline < end:
+            cycle_start = time.perf_counter()
+            app.fetch_live_data()
+            cycle_latencies.append(time.perf_counter() - cycle_start)
+            client.get_received()  # drain so the test client does not grow without bound
+            deadline += period
+            time.sleep(max(0.0, deadline - time.monotonic()))
+        writer.flush()
+        elapsed = time.perf_counter() - started
+    finally:
+        app.socketio.emit = original_emit
+        client.disconnect()
+
+    return {
+        'scenario': 'app',
+        'rate': rate,
+        'duration': round(elapsed, 3),
+        'fetches_per_sec': round(len(cycle_latencies) / elapsed, 2),
+        'fetch_latency_ms': percentiles(cycle_latencies),
+        'emit_latency_ms': percentiles(emit_latencies),
+        'emit_bytes_avg': round(float(np.mean(emit_bytes)), 1) if emit_bytes else None,
+        'db_rows_per_sec': round((writer.stats['rows_written'] - rows_before) / elapsed, 2),
+        'pool': app.get_pool().stats(),
+    }
+
+
+# --- Comparing Runs ---
+def compare(old_path, new_path):
+    """Print the change in the headline numbers of two result files."""
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+
+    def key(result):
+        return (result['scenario'], result.get('devices'), result.get('interval'), result.get('rate'))
+
+    old_results = {key(r): r for r in old['results']}
+    print(f"{old.get('revision')} -> {new.get('revision')}")
+    for result in new['results']:
+        before = old_results.get(key(result))
+        if before is None:
+            continue
+        latency_key = 'read_latency_ms' if result['scenario'] == 'poller' else 'fetch_latency_ms'
+        rate_key = 'polls_per_sec' if result['scenario'] == 'poller' else 'fetches_per_sec'
+        print(f"{key(result)}: {rate_key} {before[rate_key]} -> {result[rate_key]}, "
+              f"p99 {before[latency_key]['p99']} -> {result[latency_key]['p99']} ms, "
+              f"db rows/s {before['db_rows_per_sec']} -> {result['db_rows_per_sec']}")
+
+
+def _floats(spec):
+    return [float(part) for part in spec.split(',')]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--devices', default=','.join(map(str, DEVICE_COUNTS)))
+    parser.add_argument('--intervals', default=','.join(map(str, POLL_INTERVALS)))
+    parser.add_argument('--rates', default=','.join(map(str, APP_RATES)))
+    parser.add_argument('--duration', type=float, default=DURATION)
+    parser.add_argument('--latency', type=float, default=0.005, help='simulated device latency (s)')
+    parser.add_argument('--jitter', type=float, default=0.005, help='simulated device jitter (s)')
+    parser.add_argument('--skip-app', action='store_true', help='only run the poller scenarios')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT)
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files and exit')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    results = []
+    simulator = start_simulator(args.latency, args.jitter)
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            database = os.path.join(workdir, 'bench.db')
+            for device_count in (int(n) for n in _floats(args.devices)):
+                for interval in _floats(args.intervals):
+                    result = bench_poller(device_count, interval, args.duration, database)
+                    print(json.dumps(result))
+                    results.append(result)
+            if not args.skip_app:
+                for rate in _floats(args.rates):
+                    result = bench_app(rate, args.duration, database)
+                    print(json.dumps(result))
+                    results.append(result)
+            from db_writer import close_writers
+            close_writers()
+    finally:
+        simulator.terminate()
+        simulator.wait()
+
+    report = {
+        'revision': git_revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'simulator': {'latency': args.latency, 'jitter': args.jitter, 'units': SIM_UNITS},
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+if __name__ == '__main__':
+    main()
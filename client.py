@@ -1,17 +1,260 @@
+"""
+Push samples to ingest_server.py from a site that cannot be polled.
+
+    python client.py --server collector.example.com:9999 --device site-7 --modbus 127.0.0.1:502
+    python client.py --server localhost:9999 --device load --synthetic 100 --pushers 500
+
+Samples are packed as they are added and sent in batches of up to
+BATCH_SIZE, at least every FLUSH_INTERVAL. A batch stays buffered until the
+server acknowledges it. When the connection fails, the pusher reconnects
+with backoff and resends what was not acknowledged, so an outage delays
+samples instead of losing them (beyond MAX_BUFFERED the oldest are dropped).
+One batch is in flight at a time; samples added meanwhile make the next
+batch bigger, so throughput follows the link's round trip.
+"""
+import argparse
+import logging
+import math
 import socket
+import struct
+import threading
+import time
+from collections import deque
+import storage
+from ingest_server import (ACK, ACK_FRAME, MALFORMED, REFUSED, STORED, encode_batch, encode_hello)
+
+# --- Configuration ---
+SERVER_HOST = 'localhost'
+SERVER_PORT = 9999
+BATCH_SIZE = 500            # Samples per batch at most
+FLUSH_INTERVAL = 1.0        # Seconds a sample may wait for its batch to fill
+HEARTBEAT_INTERVAL = 30.0   # Send an empty batch after this long without samples (< the server's IDLE_TIMEOUT)
+MAX_BUFFERED = 100000       # Samples kept while the server is unreachable
+CONNECT_TIMEOUT = 5.0
+ACK_TIMEOUT = 10.0          # Seconds to wait for a batch to be acknowledged
+RECONNECT_BACKOFF_INITIAL = 0.5
+RECONNECT_BACKOFF_MAX = 30.0
+
+TIMESTAMP = struct.Struct('<q')
+
+logger = logging.getLogger(__name__)
+
+
+class Pusher:
+    """Buffers samples of one device and pushes them to an ingest server on its own thread."""
+
+    def __init__(self, host, port, device, tag_names=(), batch_size=BATCH_SIZE,
+                 flush_interval=FLUSH_INTERVAL, max_buffered=MAX_BUFFERED):
+        self.host = host
+        self.port = port
+        self.device = device
+        self.tag_names = tuple(tag_names)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+        self.stats = {'acked': 0, 'batches': 0, 'dropped': 0, 'refused': 0, 'reconnects': 0}
+        self._pending = deque()   # ((registers, inputs, tags) counts, packed record)
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._seq = 0
+        self._thread = threading.Thread(target=self._run, name=f'pusher-{device}', daemon=True)
+
+    def add(self, registers, inputs, ts=None, tag_values=None):
+        """Queue one sample; ts is unix milliseconds (default now), tag_values align with tag_names."""
+        if tag_values is not None and len(tag_values) != len(self.tag_names):
+            raise ValueError(f"Expected {len(self.tag_names)} tag values, got {len(tag_values)}")
+        record = b''.join((TIMESTAMP.pack(storage.timestamp_ms() if ts is None else ts),
+                           storage.pack_registers(registers), storage.pack_bits(inputs),
+                           b'' if tag_values is None else storage.pack_values(tag_values)))
+        layout = (len(registers), len(inputs), 0 if tag_values is None else len(tag_values))
+        with self._cond:
+            self._pending.append((layout, record))
+            if len(self._pending) > self.max_buffered:
+                self._pending.popleft()
+                self.stats['dropped'] += 1
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify()
+
+    def pending(self):
+        """Samples not yet acknowledged."""
+        return len(self._pending)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=ACK_TIMEOUT):
+        """Send what is buffered (within timeout) and stop."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self._thread.join(timeout)
+
+    # --- Sending ---
+    def _run(self):
+        backoff = 0.0
+        while True:
+            try:
+                with socket.create_connection((self.host, self.port), timeout=CONNECT_TIMEOUT) as sock:
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    sock.settimeout(ACK_TIMEOUT)
+                    sock.sendall(encode_hello(self.device, self.tag_names))
+                    backoff = 0.0
+                    self._push(sock)
+                    return
+            except OSError as e:
+                if self._stopping:
+                    logger.warning(f"{self.device}: stopping with {self.pending()} samples unsent ({e})")
+                    return
+                backoff = min(RECONNECT_BACKOFF_MAX, max(RECONNECT_BACKOFF_INITIAL, backoff * 2))
+                self.stats['reconnects'] += 1
+                logger.warning(f"{self.device}: push to {self.host}:{self.port} failed ({e}), "
+                               f"retrying in {backoff:.1f}s with {self.pending()} samples buffered")
+                time.sleep(backoff)
+
+    def _take_batch(self):
+        """Pop up to batch_size records of the same layout off the front of the buffer."""
+        layout = self._pending[0][0]
+        records = []
+        while self._pending and len(records) < self.batch_size and self._pending[0][0] == layout:
+            records.append(self._pending.popleft()[1])
+        return layout, records
+
+    def _push(self, sock):
+        """Send batches until stopped and drained; raises OSError when the connection fails."""
+        last_sent = time.monotonic()
+        while True:
+            with self._cond:
+                if len(self._pending) < self.batch_size and not self._stopping:
+                    self._cond.wait(self.flush_interval)
+                if self._pending:
+                    layout, records = self._take_batch()
+                elif self._stopping:
+                    return
+                elif time.monotonic() - last_sent >= HEARTBEAT_INTERVAL:
+                    layout, records = (0, 0, 0), []
+                else:
+                    continue
+            try:
+                status = self._send(sock, layout, records)
+            except BaseException:
+                self._requeue(layout, records)
+                raise
+            last_sent = time.monotonic()
+            if status == STORED:
+                self.stats['acked'] += len(records)
+            elif status == REFUSED:
+                # The server's database is backed up; hold on to the batch and slow down
+                self.stats['refused'] += 1
+                self._requeue(layout, records)
+                time.sleep(RECONNECT_BACKOFF_INITIAL)
+            else:
+                logger.error(f"{self.device}: server rejected a batch of {len(records)} samples as malformed")
+
+    def _send(self, sock, layout, records):
+        self._seq = (self._seq + 1) & 0xFFFFFFFF
+        sock.sendall(encode_batch(self._seq, *layout, records))
+        self.stats['batches'] += 1
+        ack = bytearray(ACK_FRAME.size)
+        view = memoryview(ack)
+        received = 0
+        while received < len(ack):
+            count = sock.recv_into(view[received:])
+            if not count:
+                raise ConnectionError("server closed the connection")
+            received += count
+        _, frame_type, seq, status = ACK_FRAME.unpack(ack)
+        if frame_type != ACK or seq != self._seq or status not in (STORED, REFUSED, MALFORMED):
+            raise ConnectionError(f"unexpected reply {bytes(ack)!r} to batch {self._seq}")
+        return status
+
+    def _requeue(self, layout, records):
+        with self._cond:
+            self._pending.extendleft((layout, record) for record in reversed(records))
+
+
+# --- Sample Sources ---
+def poll_modbus(pusher, host, port, slave, register_count, input_count, interval):
+    """Read holding registers and discrete inputs from 0 every interval and push them."""
+    from modbus_pool import get_pool
+    from pymodbus.exceptions import ModbusException
+    from scheduler import ScanTimer
+
+    timer = ScanTimer(interval, name='pusher')
+    while True:
+        time.sleep(timer.due_in())
+        timer.begin()
+        try:
+            with get_pool().connection(host, port, slave) as client:
+                if client is None:
+                    continue
+                registers = client.read_holding_registers(address=0, count=register_count, slave=slave)
+                inputs = client.read_discrete_inputs(address=0, count=input_count, slave=slave)
+            if registers.isError() or inputs.isError():
+                logger.warning(f"Modbus read failed: {registers if registers.isError() else inputs}")
+            else:
+                pusher.add(registers.registers, inputs.bits[:input_count])
+        except ModbusException as e:
+            logger.warning(f"Modbus read failed: {e}")
+        finally:
+            timer.end()
 
-# Create a TCP socket
-client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+def synthesize(pushers, rate, register_count, input_count, duration=None):
+    """Add rate sine-wave samples per second to every pusher (for load tests)."""
+    started = time.monotonic()
+    last_ts = {}
+    n = 0
+    while duration is None or time.monotonic() - started < duration:
+        phase = 2 * math.pi * n / max(rate, 1) / 10
+        registers = [int(1000 + 1000 * math.sin(phase + i / 3)) for i in range(register_count)]
+        inputs = [(n // 10 + i) % 2 == 0 for i in range(input_count)]
+        for pusher in pushers:
+            # Keep timestamps distinct so fast samples don't overwrite each other's rows
+            ts = max(storage.timestamp_ms(), last_ts.get(pusher, 0) + 1)
+            last_ts[pusher] = ts
+            pusher.add(registers, inputs, ts)
+        n += 1
+        time.sleep(max(0.0, started + n / rate - time.monotonic()))
 
-# Connect to the server
-client_socket.connect(('localhost', 9999))
 
-# Send a message to the server
-client_socket.send("Hello From Rahul".encode())
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--server', default=f'{SERVER_HOST}:{SERVER_PORT}', help='ingest server host:port')
+    parser.add_argument('--device', required=True, help='name the samples are stored under')
+    parser.add_argument('--modbus', metavar='HOST:PORT', help='poll this Modbus TCP device and push its samples')
+    parser.add_argument('--slave', type=int, default=1)
+    parser.add_argument('--interval', type=float, default=1.0, help='Modbus poll interval (s)')
+    parser.add_argument('--synthetic', type=float, metavar='RATE', help='push RATE generated samples per second')
+    parser.add_argument('--pushers', type=int, default=1,
+                        help='with --synthetic: this many connections, as devices DEVICE-0, DEVICE-1, ...')
+    parser.add_argument('--duration', type=float, help='with --synthetic: stop after this many seconds')
+    parser.add_argument('--registers', type=int, default=20)
+    parser.add_argument('--inputs', type=int, default=20)
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+    if (args.modbus is None) == (args.synthetic is None):
+        parser.error('give exactly one of --modbus and --synthetic')
+    logging.basicConfig(level=logging.INFO)
+    host, _, port = args.server.rpartition(':')
 
-# Receive a response from the server
-response = client_socket.recv(1024).decode()
-print(f"Received from server: {response}")
+    names = [args.device] if args.pushers == 1 or args.modbus else \
+        [f'{args.device}-{i}' for i in range(args.pushers)]
+    pushers = [Pusher(host, int(port), name, batch_size=args.batch_size).start() for name in names]
+    try:
+        if args.modbus:
+            modbus_host, _, modbus_port = args.modbus.rpartition(':')
+            poll_modbus(pushers[0], modbus_host, int(modbus_port), args.slave, args.registers, args.inputs,
+                        args.interval)
+        else:
+            synthesize(pushers, args.synthetic, args.registers, args.inputs, args.duration)
+    except KeyboardInterrupt:
+        pass
+    for pusher in pushers:
+        pusher.stop()
+    acked = sum(pusher.stats['acked'] for pusher in pushers)
+    unsent = sum(pusher.pending() for pusher in pushers)
+    dropped = sum(pusher.stats['dropped'] for pusher in pushers)
+    print(f"Pushed {acked} samples from {len(pushers)} pushers; {unsent} unsent, {dropped} dropped")
 
-# Close the client socket
-client_socket.close()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,370 @@
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+import metrics
+from spool import Spool, SpoolFull
+
+# --- Configuration ---
+QUEUE_SIZE = 20000      # Rows buffered before producers are made to wait
+BATCH_SIZE = 1000       # Flush once this many rows are pending...
+FLUSH_INTERVAL = 0.5    # ...or once the oldest pending row is this old (seconds)
+PUT_TIMEOUT = 5.0       # How long submit() blocks on a full queue before dropping
+BATCH_RETRIES = 5       # Retries of a batch the database is locked or busy for before it is dropped
+
+# --- Store-and-Forward ---
+# With the spool enabled rows go to an on-disk, memory-mapped log next to the
+# database (see spool.py) instead of the in-memory queue: submit() never waits
+# for SQLite, rows survive restarts and a database that is locked or slow only
+# delays them. Each process takes a free numbered slot under the spool directory.
+SPOOL_ENABLED = True
+SPOOL_SUFFIX = '-spool'       # modbus_data.db -> modbus_data.db-spool/0, /1, ...
+SPOOL_SLOTS = 8               # Processes that can spool for one database at a time
+REPLAY_BATCH_SIZE = 5000      # Rows per transaction when catching up on a backlog
+RETRY_INTERVAL_MAX = 30.0     # Longest wait between attempts while the database keeps failing
+SYNC_INTERVAL = 1.0           # How often spooled rows are written from the page cache to disk
+
+# Applied to every connection the writer opens. WAL lets readers (the web app,
+# exports) run while the writer commits; synchronous=NORMAL only fsyncs at
+# checkpoints, which is safe in WAL mode.
+PRAGMAS = (
+    'journal_mode=WAL',
+    'synchronous=NORMAL',
+    'temp_store=MEMORY',
+    'cache_size=-16000',
+    'busy_timeout=5000',
+    'wal_autocheckpoint=2000',
+)
+
+logger = logging.getLogger(__name__)
+
+_FLUSH = object()
+_STOP = object()
+
+
+def configure_connection(conn):
+    """Apply the writer's pragmas to an open sqlite3 connection."""
+    for pragma in PRAGMAS:
+        conn.execute(f'PRAGMA {pragma}')
+    return conn
+
+
+class BatchWriter(threading.Thread):
+    """
+    Single write-behind thread for one SQLite database.
+
+    Producers call submit(sql, params) and return immediately. The writer
+    drains the bounded queue, groups rows by statement and writes each group
+    with executemany inside one transaction, flushing when BATCH_SIZE rows are
+    pending or the oldest is FLUSH_INTERVAL old. When the database falls
+    behind the queue fills and submit() blocks, pushing back on acquisition.
+    A batch the database is locked or busy for is retried with backoff; rows
+    given up on are counted as dropped.
+    """
+
+    def __init__(self, database, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL,
+                 queue_size=QUEUE_SIZE):
+        super().__init__(name=f'db-writer:{database}', daemon=True)
+        self.database = database
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=queue_size)
+        self.stats = {'rows_written': 0, 'batches': 0, 'dropped': 0, 'errors': 0,
+                      'last_batch_size': 0, 'last_batch_seconds': 0.0}
+        self.last_error = None
+
+    def submit(self, sql, params, timeout=PUT_TIMEOUT):
+        """Queue one row for insertion. Returns False if the queue stayed full."""
+        try:
+            self._queue.put((sql, params), timeout=timeout)
+            return True
+        except queue.Full:
+            self.stats['dropped'] += 1
+            metrics.DB_DROPPED.inc()
+            logger.error(f"DB writer queue full for {timeout}s, dropping row")
+            return False
+
+    def has_room(self, count):
+        """Whether count more rows fit in the queue right now (without submitting them)."""
+        return self._queue.maxsize <= 0 or self._queue.maxsize - self._queue.qsize() >= count
+
+    def flush(self, timeout=None):
+        """Block until everything submitted so far has been committed."""
+        done = threading.Event()
+        self._queue.put((_FLUSH, done))
+        return done.wait(timeout)
+
+    def close(self, timeout=None):
+        """Flush pending rows and stop the writer thread."""
+        self._queue.put((_STOP, None))
+        self.join(timeout)
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def run(self):
+        conn = configure_connection(sqlite3.connect(self.database))
+        pending = []
+        oldest = None
+        try:
+            while True:
+                wait = None if oldest is None else max(0.0, oldest + self.flush_interval - time.monotonic())
+                try:
+                    sql, params = self._queue.get(timeout=wait)
+                except queue.Empty:
+                    sql = None
+
+                if sql is _STOP:
+                    self._commit(conn, pending)
+                    return
+                if sql is _FLUSH:
+                    self._commit(conn, pending)
+                    pending, oldest = [], None
+                    params.set()
+                    continue
+                if sql is not None:
+                    if oldest is None:
+                        oldest = time.monotonic()
+                    pending.append((sql, params))
+
+                if pending and (len(pending) >= self.batch_size or
+                                time.monotonic() - oldest >= self.flush_interval):
+                    self._commit(conn, pending)
+                    pending, oldest = [], None
+        finally:
+            conn.close()
+
+    def _commit(self, conn, rows):
+        """
+        Write rows, retrying with backoff while the database is locked or busy
+        (the queue fills meanwhile and pushes back on producers). Drops them
+        after BATCH_RETRIES, or at once if the database rejects the batch.
+        """
+        retry = self.flush_interval
+        for attempt in range(BATCH_RETRIES + 1):
+            if self._write_batch(conn, rows):
+                return True
+            if not isinstance(self.last_error, sqlite3.OperationalError) or attempt == BATCH_RETRIES:
+                break
+            time.sleep(retry)
+            retry = min(RETRY_INTERVAL_MAX, retry * 2)
+        self.stats['dropped'] += len(rows)
+        metrics.DB_DROPPED.inc(len(rows))
+        logger.error(f"Dropping {len(rows)} rows after {attempt + 1} failed attempts: {self.last_error}")
+        return False
+
+    def _write_batch(self, conn, rows):
+        """Write rows in one transaction, one executemany per distinct statement. Returns success."""
+        if not rows:
+            return True
+        grouped = {}
+        for sql, params in rows:
+            grouped.setdefault(sql, []).append(params)
+
+        started = time.perf_counter()
+        try:
+            with conn:
+                for sql, param_list in grouped.items():
+                    conn.executemany(sql, param_list)
+        except sqlite3.Error as e:
+            self.last_error = e
+            self.stats['errors'] += 1
+            metrics.DB_BATCH_ERRORS.inc()
+            logger.error(f"DB writer batch of {len(rows)} rows failed: {e}")
+            return False
+        self.stats['rows_written'] += len(rows)
+        self.stats['batches'] += 1
+        self.stats['last_batch_size'] = len(rows)
+        self.stats['last_batch_seconds'] = time.perf_counter() - started
+        metrics.DB_ROWS.inc(len(rows))
+        metrics.DB_BATCH_ROWS.observe(len(rows))
+        metrics.DB_BATCH_SECONDS.observe(self.stats['last_batch_seconds'])
+        return True
+
+
+class SpooledWriter(BatchWriter):
+    """
+    BatchWriter whose queue is a spool.Spool on disk.
+
+    submit() appends to the spool at memory speed and never waits for the
+    database. The writer thread replays the spool in batches of up to
+    REPLAY_BATCH_SIZE rows and only advances the spool's cursor once a batch
+    is committed; if the database is locked or failing it keeps the rows and
+    retries with backoff. Rows the database rejects outright are retried one
+    by one so a single bad row cannot block the backlog. Spools left behind
+    by earlier runs are replayed before new rows.
+    """
+
+    def __init__(self, database, spool, orphans=(), batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL,
+                 replay_batch_size=REPLAY_BATCH_SIZE):
+        super().__init__(database, batch_size, flush_interval)
+        self.spool = spool
+        self.replay_batch_size = replay_batch_size
+        self._orphans = list(orphans)
+        self._wake = threading.Event()
+        self._progress = threading.Condition()
+        self._stopping = False
+        self.stats['retries'] = 0
+
+    def submit(self, sql, params, timeout=None):
+        """Append one row to the spool. Returns False if the spool is full or cannot be written."""
+        try:
+            self.spool.append(sql, params)
+        except SpoolFull as e:
+            self.stats['dropped'] += 1
+            metrics.DB_DROPPED.inc()
+            logger.error(f"{e}, dropping row")
+            return False
+        except Exception as e:
+            # Callers sit on poll loops and the ingest event loop; a spool fault must not escape into them
+            self.stats['dropped'] += 1
+            metrics.DB_DROPPED.inc()
+            logger.error(f"Spool append failed ({e!r}), dropping row")
+            return False
+        if self.spool.pending_rows() >= self.batch_size:
+            self._wake.set()
+        return True
+
+    def has_room(self, count):
+        """Whether the spool can still take another segment of rows (it refuses new segments when full)."""
+        return self.spool.pending_bytes() + self.spool.segment_size <= self.spool.max_bytes
+
+    def flush(self, timeout=None):
+        """Block until everything submitted so far has been committed."""
+        target = self.spool.next_seq
+        self._wake.set()
+        with self._progress:
+            return self._progress.wait_for(lambda: self.spool.committed_seq >= target or not self.is_alive(),
+                                           timeout)
+
+    def close(self, timeout=None):
+        """Replay what the database will take and stop; anything left stays spooled for the next run."""
+        self._stopping = True
+        self._wake.set()
+        self.join(timeout)
+
+    def queue_depth(self):
+        return self.spool.pending_rows()
+
+    def run(self):
+        conn = configure_connection(sqlite3.connect(self.database))
+        retry = 0.0
+        last_sync = time.monotonic()
+        try:
+            while True:
+                self._wake.wait(retry or self.flush_interval)
+                self._wake.clear()
+                stopping = self._stopping
+                for spool in self._orphans + [self.spool]:
+                    if not self._replay(conn, spool):
+                        retry = min(RETRY_INTERVAL_MAX, max(self.flush_interval, retry * 2))
+                        self.stats['retries'] += 1
+                        break
+                else:
+                    retry = 0.0
+                    for orphan in self._orphans:
+                        orphan.close()
+                    self._orphans = []
+                if time.monotonic() - last_sync >= SYNC_INTERVAL:
+                    self.spool.sync()
+                    last_sync = time.monotonic()
+                if stopping:
+                    return
+        finally:
+            conn.close()
+            for spool in self._orphans + [self.spool]:
+                spool.sync()
+                spool.close()
+            with self._progress:
+                self._progress.notify_all()
+
+    def _replay(self, conn, spool):
+        """Commit everything spooled so far. Returns False if the database failed and the rest must wait."""
+        while True:
+            rows, position, last_seq = spool.read(spool.read_position, self.replay_batch_size)
+            if rows and not self._write_batch(conn, rows):
+                # Locked, busy, full or unreachable: keep the rows for the next attempt
+                if isinstance(self.last_error, sqlite3.OperationalError):
+                    return False
+                # The database works but refuses some of these rows; find and drop those
+                if not self._write_rows(conn, rows):
+                    return False
+            if position != spool.read_position:
+                spool.commit(position, last_seq)
+                with self._progress:
+                    self._progress.notify_all()
+            if len(rows) < self.replay_batch_size:
+                return True
+
+    def _write_rows(self, conn, rows):
+        """Write rows one transaction each, dropping those the database rejects. False if it became unavailable."""
+        for sql, params in rows:
+            try:
+                with conn:
+                    conn.execute(sql, params)
+            except sqlite3.OperationalError as e:
+                self.last_error = e
+                return False
+            except sqlite3.Error as e:
+                self.stats['dropped'] += 1
+                metrics.DB_DROPPED.inc()
+                logger.error(f"Dropping spooled row the database rejects: {e}")
+                continue
+            self.stats['rows_written'] += 1
+            metrics.DB_ROWS.inc()
+        return True
+
+
+# --- Shared Writers ---
+_writers = {}
+_writers_lock = threading.Lock()
+
+def get_writer(database):
+    """Return the running writer for database, starting it on first use."""
+    with _writers_lock:
+        writer = _writers.get(database)
+        if writer is None or not writer.is_alive():
+            writer = _open_writer(database)
+            writer.start()
+            _writers[database] = writer
+            metrics.DB_QUEUE_DEPTH.set_function(writer.queue_depth, database)
+            if isinstance(writer, SpooledWriter):
+                metrics.DB_SPOOL_BYTES.set_function(writer.spool.pending_bytes, database)
+                metrics.DB_SPOOL_LAG.set_function(writer.spool.replay_lag, database)
+        return writer
+
+def _open_writer(database):
+    """A SpooledWriter on the first free spool slot (adopting any other idle slot's backlog), else a BatchWriter."""
+    if not SPOOL_ENABLED:
+        return BatchWriter(database)
+    spool = None
+    orphans = []
+    for slot in range(SPOOL_SLOTS):
+        try:
+            candidate = Spool(os.path.join(database + SPOOL_SUFFIX, str(slot)))
+        except RuntimeError:
+            continue  # another process is spooling there
+        except (OSError, ValueError) as e:
+            logger.error(f"Spool slot {slot} of {database} unusable: {e}")
+            continue
+        if spool is None:
+            spool = candidate
+        elif candidate.pending_rows():
+            orphans.append(candidate)  # left by a process that is gone; replay it too
+        else:
+            candidate.close()
+    if spool is None:
+        logger.warning(f"No free spool slot for {database}; writing through the in-memory queue")
+        for orphan in orphans:
+            orphan.close()
+        return BatchWriter(database)
+    return SpooledWriter(database, spool, orphans)
+
+def close_writers():
+    """Flush and stop every writer started by get_writer()."""
+    with _writers_lock:
+        for writer in _writers.values():
+            writer.close()
+        _writers.clear()
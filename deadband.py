@@ -0,0 +1,84 @@
+import numpy as np
+
+# --- Configuration ---
+DEFAULT_DEADBAND = (0, 0.0)   # (absolute counts, percent of last reported value); 0, 0 = any change
+MAX_SILENCE = 60.0            # Report every point at least this often, changed or not (seconds)
+
+
+class DeadbandFilter:
+    """
+    Report-by-exception over a fixed list of points (registers, then inputs,
+    then any decoded tag values).
+
+    update() compares a whole sample against the last reported value of every
+    point at once and returns a boolean mask of the points worth reporting: the
+    first value seen, any value that moved by more than its deadband, and any
+    point that has been silent for max_silence. Register deadbands are the
+    larger of an absolute and a percent-of-last-value threshold; inputs report
+    on change only. Missing values (None blocks) are never reported and leave
+    the reference untouched.
+    """
+
+    def __init__(self, absolute, percent, max_silence=MAX_SILENCE):
+        self.absolute = np.asarray(absolute, dtype=np.float64)
+        self.percent = np.asarray(percent, dtype=np.float64) / 100.0
+        self.max_silence = max_silence
+        self.last = np.full(len(self.absolute), np.nan)
+        self.last_report = np.full(len(self.absolute), -np.inf)
+
+    @classmethod
+    def for_points(cls, register_count, input_count, register_deadbands=None,
+                   default=DEFAULT_DEADBAND, max_silence=MAX_SILENCE, tag_deadbands=()):
+        """
+        Build a filter from {register index: (absolute, percent)} overrides.
+        tag_deadbands holds one (absolute, percent) pair, in engineering units,
+        per decoded tag value that follows the inputs.
+        """
+        count = register_count + input_count + len(tag_deadbands)
+        absolute = np.zeros(count)
+        percent = np.zeros(count)
+        absolute[:register_count], percent[:register_count] = default
+        for index, (abs_band, pct_band) in (register_deadbands or {}).items():
+            if index < register_count:
+                absolute[index], percent[index] = abs_band, pct_band
+        if len(tag_deadbands):
+            absolute[register_count + input_count:], percent[register_count + input_count:] = \
+                np.asarray(tag_deadbands, dtype=np.float64).T
+        return cls(absolute, percent, max_silence)
+
+    def update(self, values, now):
+        """Return the report mask for one sample and advance the reference values of reported points."""
+        values = np.asarray(values, dtype=np.float64)
+        present = ~np.isnan(values)
+        threshold = np.maximum(self.absolute, self.percent * np.abs(np.nan_to_num(self.last)))
+        with np.errstate(invalid='ignore'):
+            moved = np.abs(values - self.last) > threshold
+        mask = present & (np.isnan(self.last) | moved | (now - self.last_report >= self.max_silence))
+        self.last[mask] = values[mask]
+        self.last_report[mask] = now
+        return mask
+
+    def update_blocks(self, registers, inputs, register_count, input_count, now, tag_values=None):
+        """
+        update() for a register block and an input block, either of which may
+        be None, followed by the decoded tag values (NaN where not read).
+        """
+        return self.update(block_values(len(self.last), registers, inputs, register_count, input_count,
+                                        tag_values), now)
+
+
+def block_values(count, registers, inputs, register_count, input_count, tag_values=None):
+    """
+    One float64 point vector of count entries: registers, then inputs, then
+    tag values, with NaN for blocks that are None or short.
+    """
+    values = np.full(count, np.nan)
+    if tag_values is not None:
+        values[register_count + input_count:] = tag_values
+    if registers is not None:
+        registers = registers[:register_count]
+        values[:len(registers)] = registers
+    if inputs is not None:
+        inputs = inputs[:input_count]
+        values[register_count:register_count + len(inputs)] = [bool(value) for value in inputs]
+    return values
@@ -0,0 +1,277 @@
+"""
+Stream stored samples out of modbus_data.db as CSV or Parquet.
+
+    python export.py --start 2024-05-01 --end 2024-06-01 --device plc-1 -o may.csv.gz
+    python export.py --start 1714521600 --end 1717200000 --device '*' --format parquet -o may.parquet
+
+Rows come off a range cursor CHUNK_SIZE at a time. Each chunk is unpacked
+with NumPy and written out before the next one is fetched, so memory stays
+flat however long the range is. app.py's /api/export streams the same
+chunks over HTTP. Parquet needs pyarrow, which is only imported when that
+format is asked for.
+"""
+import argparse
+import csv
+import gzip
+import io
+import sqlite3
+import sys
+import zlib
+from collections import namedtuple
+import numpy as np
+import history
+import storage
+from db_writer import configure_connection
+
+# --- Configuration ---
+CHUNK_SIZE = 10000          # Rows per fetch, CSV write and Parquet row group
+PARQUET_COMPRESSION = 'zstd'
+FORMATS = ('csv', 'parquet')
+
+# Columns of one export. registers/inputs are the point indices to write,
+# tags the tag names; tag_columns maps tag_sets.id -> column of each of its
+# tag_values entries in tags.
+ExportLayout = namedtuple('ExportLayout', 'registers inputs tags tag_columns')
+# One chunk of one device, as float64 matrices with NaN where a point was not read
+ExportChunk = namedtuple('ExportChunk', 'device timestamps registers inputs tags')
+
+
+# --- Layout ---
+def resolve_devices(conn, spec):
+    """[(id, name)] for a comma-separated list of device names, '*' meaning all of them."""
+    if spec.strip() == '*':
+        return conn.execute('SELECT id, name FROM devices ORDER BY name').fetchall()
+    devices = []
+    for name in (part.strip() for part in spec.split(',')):
+        if not name:
+            continue
+        device_id = storage.find_device_id(conn, name)
+        if device_id is None:
+            raise LookupError(f"Unknown device {name!r}")
+        devices.append((device_id, name))
+    if not devices:
+        raise ValueError("No devices requested")
+    return devices
+
+def export_layout(conn, devices, start_ms, end_ms, points=None):
+    """
+    Columns needed for the range: every register and input any sample in it
+    has (or just points, parsed by history.parse_points) plus every tag the
+    devices have logged. The widths come from one aggregate query per device,
+    which SQLite answers without holding the rows.
+    """
+    if points is not None:
+        return ExportLayout([index for _, kind, index in points if kind == 'register'],
+                            [index for _, kind, index in points if kind == 'input'], [], {})
+    register_count = input_count = 0
+    tags = {}
+    tag_columns = {}
+    for device_id, _ in devices:
+        row = conn.execute('SELECT max(length(registers)), max(input_count) FROM samples '
+                           'WHERE device_id = ? AND ts >= ? AND ts < ?', (device_id, start_ms, end_ms)).fetchone()
+        register_count = max(register_count, (row[0] or 0) // 2)
+        input_count = max(input_count, row[1] or 0)
+        for tag_set, in conn.execute('SELECT id FROM tag_sets WHERE device_id = ? ORDER BY id', (device_id,)):
+            names = storage.tag_set_names(conn, tag_set)
+            tag_columns[tag_set] = np.array([tags.setdefault(name, len(tags)) for name in names], dtype=np.intp)
+    return ExportLayout(list(range(register_count)), list(range(input_count)), list(tags), tag_columns)
+
+def header(layout):
+    return (['time', 'device'] + [f'register_{i}' for i in layout.registers]
+            + [f'input_{i}' for i in layout.inputs] + layout.tags)
+
+
+# --- Reading ---
+def iter_chunks(conn, devices, start_ms, end_ms, layout, chunk_size=CHUNK_SIZE):
+    """Yield an ExportChunk per chunk_size samples, device by device and in time order within each."""
+    columns = 'ts, registers, inputs, input_count, tag_set, tag_values'
+    for device_id, name in devices:
+        for ts, reg_blobs, input_blobs, input_counts, tag_sets, tag_blobs in storage.iter_sample_chunks(
+                conn, device_id, start_ms, end_ms, chunk_size, columns):
+            yield ExportChunk(
+                name,
+                np.array(ts, dtype=np.int64),
+                history.take_columns(history.blob_matrix(reg_blobs, '<u2'), layout.registers),
+                history.take_columns(history.bit_matrix(input_blobs, input_counts), layout.inputs),
+                _tag_matrix(layout, tag_sets, tag_blobs),
+            )
+
+def _tag_matrix(layout, tag_sets, tag_blobs):
+    """Scatter each row's tag_values into the export's tag columns by its tag set."""
+    out = np.full((len(tag_sets), len(layout.tags)), np.nan)
+    if not layout.tags:
+        return out
+    values = history.blob_matrix(tag_blobs, '<f8')
+    tag_sets = np.array([-1 if tag_set is None else tag_set for tag_set in tag_sets], dtype=np.int64)
+    for tag_set in np.unique(tag_sets).tolist():
+        columns = layout.tag_columns.get(tag_set)
+        if columns is None:
+            continue
+        rows = np.flatnonzero(tag_sets == tag_set)
+        width = min(len(columns), values.shape[1])
+        out[rows[:, None], columns[None, :width]] = values[rows, :width]
+    return out
+
+
+# --- CSV ---
+def _cells(matrix, integer):
+    """Object matrix for csv: ints or floats, None (an empty cell) where NaN."""
+    missing = np.isnan(matrix)
+    cells = (np.where(missing, 0, matrix).astype(np.int64) if integer else matrix).astype(object)
+    cells[missing] = None
+    return cells
+
+def csv_text(layout, chunks):
+    """Yield CSV text: the header, then one block of rows per chunk."""
+    buffer = io.StringIO()
+    out = csv.writer(buffer, lineterminator='\n')
+    out.writerow(header(layout))
+    for chunk in chunks:
+        times = np.datetime_as_string(chunk.timestamps.astype('datetime64[ms]'), unit='ms', timezone='UTC')
+        rows = np.concatenate([
+            times.astype(object)[:, None],
+            np.full((len(times), 1), chunk.device, dtype=object),
+            _cells(chunk.registers, True),
+            _cells(chunk.inputs, True),
+            _cells(chunk.tags, False),
+        ], axis=1)
+        out.writerows(rows.tolist())
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def gzip_stream(blocks, level=6):
+    """gzip-compress a stream of str/bytes blocks as it goes."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits 31 = gzip container
+    for block in blocks:
+        data = compressor.compress(block.encode() if isinstance(block, str) else block)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+# --- Parquet ---
+class _Drain:
+    """Write-only file that hands out what was written since the last drain()."""
+
+    def __init__(self):
+        self._parts = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self._parts)
+        self._parts = []
+        return data
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("Parquet export needs pyarrow (pip install pyarrow)") from None
+    return pyarrow, pyarrow.parquet
+
+def parquet_bytes(layout, chunks, compression=PARQUET_COMPRESSION):
+    """Yield a Parquet file in pieces, one row group per chunk. Points not read are null."""
+    pa, pq = _pyarrow()
+    names = header(layout)
+    types = ([pa.timestamp('ms', tz='UTC'), pa.dictionary(pa.int32(), pa.string())]
+             + [pa.uint16()] * len(layout.registers) + [pa.bool_()] * len(layout.inputs)
+             + [pa.float64()] * len(layout.tags))
+    schema = pa.schema(list(zip(names, types)))
+    # Samples of a point change slowly from row to row: store deltas, not dictionaries
+    encodings = {name: 'DELTA_BINARY_PACKED' for name in names[:1] + names[2:2 + len(layout.registers)]}
+    encodings.update((name, 'BYTE_STREAM_SPLIT') for name in layout.tags)
+    sink = _Drain()
+    writer = pq.ParquetWriter(sink, schema, compression=compression, use_dictionary=['device'],
+                              column_encoding=encodings)
+    try:
+        for chunk in chunks:
+            arrays = [
+                pa.array(chunk.timestamps, type=types[0]),
+                pa.DictionaryArray.from_arrays(np.zeros(len(chunk.timestamps), dtype=np.int32), [chunk.device]),
+            ]
+            for matrix, dtype, arrow_type in ((chunk.registers, np.uint16, pa.uint16()),
+                                             (chunk.inputs, np.bool_, pa.bool_()),
+                                             (chunk.tags, np.float64, pa.float64())):
+                missing = np.isnan(matrix)
+                values = np.where(missing, 0, matrix).astype(dtype)
+                arrays.extend(pa.array(values[:, i], type=arrow_type, mask=missing[:, i])
+                              for i in range(matrix.shape[1]))
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            data = sink.drain()
+            if data:
+                yield data
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+def export(conn, devices, start_ms, end_ms, format='csv', points=None, chunk_size=CHUNK_SIZE):
+    """Yield the export of a time range as text (CSV) or bytes (Parquet) blocks."""
+    if format not in FORMATS:
+        raise ValueError(f"Unknown format {format!r}; expected one of {', '.join(FORMATS)}")
+    if format == 'parquet':
+        _pyarrow()  # fail now rather than halfway into a streamed response
+    layout = export_layout(conn, devices, start_ms, end_ms, points)
+    chunks = iter_chunks(conn, devices, start_ms, end_ms, layout, chunk_size)
+    return csv_text(layout, chunks) if format == 'csv' else parquet_bytes(layout, chunks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--database', default='modbus_data.db')
+    parser.add_argument('--start', required=True, help='unix seconds or ISO 8601 local time')
+    parser.add_argument('--end', help='unix seconds or ISO 8601 local time (default: now)')
+    parser.add_argument('--device', default='*', help="comma-separated device names, '*' for all")
+    parser.add_argument('--points', help='only these points, e.g. register_0,input_3 (default: all, with tags)')
+    parser.add_argument('--format', choices=FORMATS, help='default: from the output name, else csv')
+    parser.add_argument('-o', '--output', help="file to write ('.gz' compresses CSV); default stdout")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+
+    start_ms = history.parse_time_ms(args.start)
+    end_ms = storage.timestamp_ms() if args.end is None else history.parse_time_ms(args.end)
+    points = None if args.points is None else history.parse_points(args.points)
+    format = args.format or ('parquet' if args.output and args.output.endswith('.parquet') else 'csv')
+
+    conn = configure_connection(sqlite3.connect(args.database))
+    try:
+        devices = resolve_devices(conn, args.device)
+        blocks = export(conn, devices, start_ms, end_ms, format, points, args.chunk_size)
+        if args.output is None:
+            out = sys.stdout.buffer
+        elif format == 'csv' and args.output.endswith('.gz'):
+            out = gzip.open(args.output, 'wb', compresslevel=6)
+        else:
+            out = open(args.output, 'wb')
+        try:
+            for block in blocks:
+                out.write(block.encode() if isinstance(block, str) else block)
+        finally:
+            if out is not sys.stdout.buffer:
+                out.close()
+    except (LookupError, ValueError, RuntimeError) as e:
+        parser.exit(1, f"export: {e}\n")
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    main()
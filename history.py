@@ -0,0 +1,186 @@
+import json
+from datetime import datetime
+import numpy as np
+from storage import iter_sample_chunks
+
+# --- Configuration ---
+CHUNK_SIZE = 5000       # Rows pulled from SQLite per vectorized step
+MAX_BUCKETS = 20000     # Refuse requests that would not downsample meaningfully
+
+# Every aggregate is carried as a dict of (rows x points) float arrays with these
+# keys, whether it comes from raw samples (one row per sample) or a rollup tier
+# (one row per bucket). NaN marks "no data" in min/max/last.
+STAT_KEYS = ('min', 'max', 'sum', 'count', 'last')
+
+
+def parse_time_ms(value):
+    """Parse unix seconds ('1712345678.5') or ISO 8601 local time into epoch milliseconds."""
+    try:
+        return int(float(value) * 1000)
+    except ValueError:
+        return int(datetime.fromisoformat(value).timestamp() * 1000)
+
+
+def parse_points(spec):
+    """
+    Parse 'register_0,register_5,input_2' into [(name, kind, index), ...].
+    Raises ValueError for anything that is not register_N or input_N.
+    """
+    points = []
+    for name in (part.strip() for part in spec.split(',')):
+        if not name:
+            continue
+        kind, _, index = name.rpartition('_')
+        if kind not in ('register', 'input') or not index.isdigit():
+            raise ValueError(f"Unknown point {name!r}; expected register_N or input_N")
+        points.append((name, kind, int(index)))
+    if not points:
+        raise ValueError("No points requested")
+    return points
+
+
+# --- Unpacking Blobs ---
+def blob_matrix(blobs, dtype, fill=np.nan, out_dtype=np.float64):
+    """
+    Stack packed 1-D array blobs into a (rows x widest) matrix.
+    Rows sharing a blob length are decoded with a single frombuffer; shorter
+    or missing blobs are padded with fill.
+    """
+    itemsize = np.dtype(dtype).itemsize
+    lengths = np.fromiter((0 if b is None else len(b) for b in blobs), dtype=np.int64, count=len(blobs))
+    out = np.full((len(blobs), int(lengths.max(initial=0)) // itemsize), fill, dtype=out_dtype)
+    for length in np.unique(lengths):
+        if length == 0:
+            continue
+        rows = np.flatnonzero(lengths == length)
+        packed = np.frombuffer(b''.join(blobs[i] for i in rows), dtype=dtype)
+        out[rows, :length // itemsize] = packed.reshape(len(rows), -1)
+    return out
+
+def bit_matrix(blobs, counts):
+    """Unpack bit-packed input blobs to a float 0/1 matrix, NaN past each row's input count."""
+    packed = blob_matrix(blobs, np.uint8, fill=0, out_dtype=np.uint8)
+    bits = np.unpackbits(packed, axis=1, bitorder='little').astype(np.float64)
+    counts = np.asarray(counts, dtype=np.int64)
+    bits[np.arange(bits.shape[1])[None, :] >= counts[:, None]] = np.nan
+    return bits
+
+def take_columns(matrix, indices):
+    """Select columns by index; indices past the matrix width come back as NaN."""
+    out = np.full((matrix.shape[0], len(indices)), np.nan)
+    for col, index in enumerate(indices):
+        if index < matrix.shape[1]:
+            out[:, col] = matrix[:, index]
+    return out
+
+
+# --- Aggregation ---
+def stats_from_values(values):
+    """Treat each raw sample as a one-sample aggregate."""
+    valid = ~np.isnan(values)
+    return {
+        'min': values,
+        'max': values,
+        'sum': np.where(valid, values, 0.0),
+        'count': valid.astype(np.float64),
+        'last': values,
+    }
+
+def raw_point_stats(reg_blobs, input_blobs, input_counts, points):
+    """Unpack one chunk of raw samples into per-point stats for the requested points."""
+    values = np.full((len(reg_blobs), len(points)), np.nan)
+    reg_cols = [col for col, (_, kind, _) in enumerate(points) if kind == 'register']
+    bit_cols = [col for col, (_, kind, _) in enumerate(points) if kind == 'input']
+    if reg_cols:
+        registers = blob_matrix(reg_blobs, '<u2')
+        values[:, reg_cols] = take_columns(registers, [points[col][2] for col in reg_cols])
+    if bit_cols:
+        bits = bit_matrix(input_blobs, input_counts)
+        values[:, bit_cols] = take_columns(bits, [points[col][2] for col in bit_cols])
+    return stats_from_values(values)
+
+def reduce_stats(bucket_ids, stats):
+    """
+    Combine consecutive rows that share a bucket id with reduceat.
+    Returns (bucket ids, reduced stats); bucket_ids must be sorted.
+    """
+    starts = np.flatnonzero(np.r_[True, bucket_ids[1:] != bucket_ids[:-1]])
+    last = stats['last']
+    row_index = np.where(~np.isnan(last), np.arange(len(last))[:, None], -1)
+    last_index = np.maximum.reduceat(row_index, starts, axis=0)
+    picked = last[np.maximum(last_index, 0), np.arange(last.shape[1])]
+    return bucket_ids[starts], {
+        'min': np.fmin.reduceat(stats['min'], starts, axis=0),
+        'max': np.fmax.reduceat(stats['max'], starts, axis=0),
+        'sum': np.add.reduceat(stats['sum'], starts, axis=0),
+        'count': np.add.reduceat(stats['count'], starts, axis=0),
+        'last': np.where(last_index >= 0, picked, np.nan),
+    }
+
+def _merge(carry, part):
+    """Fold one more partial aggregate into the bucket carried over from the previous chunk."""
+    return {
+        'min': np.fmin(carry['min'], part['min']),
+        'max': np.fmax(carry['max'], part['max']),
+        'sum': carry['sum'] + part['sum'],
+        'count': carry['count'] + part['count'],
+        'last': np.where(np.isnan(part['last']), carry['last'], part['last']),
+    }
+
+
+def _bucket_record(bucket_ms, bucket, stats):
+    count = stats['count']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        avg = stats['sum'] / count
+
+    def as_list(array):
+        return [None if np.isnan(v) else float(v) for v in array]
+
+    return {
+        't': int(bucket) * bucket_ms,
+        'count': [int(c) for c in count],
+        'min': as_list(stats['min']),
+        'max': as_list(stats['max']),
+        'avg': as_list(avg),
+        'last': as_list(stats['last']),
+    }
+
+
+def raw_stat_chunks(conn, device_id, start_ms, end_ms, points, chunk_size=CHUNK_SIZE):
+    """Yield (timestamps, stats) for raw samples of one device, one chunk at a time."""
+    for ts, reg_blobs, input_blobs, input_counts in iter_sample_chunks(conn, device_id, start_ms, end_ms, chunk_size):
+        yield np.asarray(ts, dtype=np.int64), raw_point_stats(reg_blobs, input_blobs, input_counts, points)
+
+
+def iter_buckets(chunks, bucket_ms):
+    """
+    Yield one downsampled record per non-empty bucket from a time-ordered
+    stream of (timestamps, stats) chunks. Buckets are aligned to multiples of
+    bucket_ms since the epoch and may span chunks (or sources); only one open
+    bucket is held between chunks.
+    """
+    carry = None
+    carry_bucket = None
+    for ts, stats in chunks:
+        if not len(ts):
+            continue
+        buckets, part = reduce_stats(ts // bucket_ms, stats)
+        for i, bucket in enumerate(buckets):
+            row = {key: part[key][i] for key in STAT_KEYS}
+            if carry is not None and bucket == carry_bucket:
+                row = _merge(carry, row)
+            elif carry is not None:
+                yield _bucket_record(bucket_ms, carry_bucket, carry)
+            carry, carry_bucket = row, bucket
+    if carry is not None:
+        yield _bucket_record(bucket_ms, carry_bucket, carry)
+
+
+def stream_history_json(header, buckets):
+    """Stream the history response as JSON text, one bucket at a time."""
+    yield json.dumps(header)[:-1] + ', "buckets": ['
+    first = True
+    for record in buckets:
+        yield ('' if first else ',\n') + json.dumps(record)
+        first = False
+    yield ']}\n'
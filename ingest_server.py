@@ -0,0 +1,341 @@
+"""
+Telemetry ingest server for sites that push samples instead of being polled.
+
+    python ingest_server.py --listen 0.0.0.0:9999 --database modbus_data.db
+
+Pushers (client.py) keep one long-lived TCP connection each. asyncio reads
+every connection straight into its own buffer (a BufferedProtocol), and
+frames are parsed in place through a memoryview. The only copy is the
+register/input blob each row needs for the database. Rows are submitted to
+the same batched writer as master.py's, and each batch is acknowledged once
+all of its rows are in the writer's spool file, from where they reach the
+database even if a write fails or the server restarts. Without a spool an
+acknowledged batch could still be lost, so the server refuses to start
+(db_writer.SPOOL_ENABLED off, or every spool slot taken).
+
+Framing, little-endian: uint32 length, then length bytes of uint8 type and
+payload.
+
+    HELLO  client -> server, once: uint8 version, uint16 name length, device name (UTF-8),
+           uint16 tag count, then per tag a uint16 length and the tag name (UTF-8)
+    BATCH  client -> server: uint32 seq, uint16 registers, uint16 inputs, uint16 tags (0 or the
+           HELLO's count), uint32 samples, then per sample an int64 unix time in ms, the registers
+           as uint16, the inputs packed LSB first ((inputs + 7) // 8 bytes) and the tag values as
+           float64. A batch without samples is a heartbeat.
+    ACK    server -> client: uint32 seq, uint8 status (STORED, REFUSED = retry later, MALFORMED)
+
+A pusher resends batches that were not acknowledged after it reconnects.
+The sample upsert makes such repeats harmless.
+"""
+import argparse
+import asyncio
+import logging
+import sqlite3
+import struct
+import time
+import numpy as np
+import metrics
+import storage
+from db_writer import SpooledWriter, configure_connection, close_writers, get_writer
+
+# --- Configuration ---
+LISTEN_HOST = '0.0.0.0'
+LISTEN_PORT = 9999
+DATABASE = 'modbus_data.db'
+ALLOWED_DEVICES = None          # Device names accepted in HELLO; None accepts any
+MAX_FRAME = 16 * 1024 * 1024    # Larger frames close the connection
+INITIAL_BUFFER = 64 * 1024      # Per-connection receive buffer; grows up to one frame
+IDLE_TIMEOUT = 120.0            # Close connections silent for this long (pushers send heartbeats)
+METRICS_PORT = 9103             # Serve Prometheus /metrics here (None to disable)
+
+# --- Protocol ---
+VERSION = 1
+HELLO = 1
+BATCH = 2
+ACK = 3
+STORED = 0
+REFUSED = 1
+MALFORMED = 2
+
+LENGTH = struct.Struct('<I')
+HELLO_HEADER = struct.Struct('<BBH')   # type, version, name length
+COUNT = struct.Struct('<H')
+BATCH_HEADER = struct.Struct('<BIHHHI')  # type, seq, registers, inputs, tags, samples
+ACK_FRAME = struct.Struct('<IBIB')     # length, type, seq, status
+
+logger = logging.getLogger(__name__)
+
+INGEST_CONNECTIONS = metrics.gauge('ingest_connections', 'Connected pushers')
+INGEST_SAMPLES = metrics.counter('ingest_samples_total', 'Samples received from pushers')
+INGEST_BATCHES = metrics.counter('ingest_batches_total', 'Batches received from pushers, by ACK status', ['status'])
+INGEST_BYTES = metrics.counter('ingest_bytes_total', 'Bytes received from pushers')
+INGEST_ERRORS = metrics.counter('ingest_errors_total', 'Connections closed for a protocol error or timeout', ['reason'])
+
+
+def record_size(register_count, input_count, tag_count):
+    """Bytes of one sample in a BATCH with these counts."""
+    return 8 + 2 * register_count + (input_count + 7) // 8 + 8 * tag_count
+
+def encode_hello(device, tag_names=()):
+    body = [HELLO_HEADER.pack(HELLO, VERSION, len(device.encode())), device.encode(), COUNT.pack(len(tag_names))]
+    for name in tag_names:
+        body += [COUNT.pack(len(name.encode())), name.encode()]
+    body = b''.join(body)
+    return LENGTH.pack(len(body)) + body
+
+def encode_batch(seq, register_count, input_count, tag_count, records):
+    """A BATCH frame of already packed sample records (see record_size)."""
+    body = BATCH_HEADER.pack(BATCH, seq, register_count, input_count, tag_count, len(records))
+    size = len(body) + sum(map(len, records))
+    return b''.join([LENGTH.pack(size), body, *records])
+
+
+class ProtocolError(Exception):
+    """The pusher sent something that is not a valid frame."""
+
+
+class IngestProtocol(asyncio.BufferedProtocol):
+    """One pusher connection: receive buffer, frame parser and its device."""
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.peer = None
+        self.device = None
+        self.device_id = None
+        self.tag_names = ()
+        self.tag_set = None
+        self.last_seen = time.monotonic()
+        self._buffer = bytearray(INITIAL_BUFFER)
+        self._view = memoryview(self._buffer)
+        self._start = 0     # first unparsed byte
+        self._end = 0       # end of the received data
+        self._resolving = False
+
+    # --- Transport callbacks ---
+    def connection_made(self, transport):
+        self.transport = transport
+        self.peer = transport.get_extra_info('peername')
+        self.server.connections.add(self)
+        INGEST_CONNECTIONS.set(len(self.server.connections))
+
+    def connection_lost(self, exc):
+        self.server.connections.discard(self)
+        INGEST_CONNECTIONS.set(len(self.server.connections))
+
+    def get_buffer(self, sizehint):
+        if self._end == len(self._buffer):
+            self._make_room(len(self._buffer) // 2)
+        return self._view[self._end:]
+
+    def buffer_updated(self, nbytes):
+        self._end += nbytes
+        self.last_seen = time.monotonic()
+        INGEST_BYTES.inc(nbytes)
+        try:
+            self._parse()
+        except ProtocolError as e:
+            self.close('malformed', f"{self.peer}: {e}")
+
+    def close(self, reason, message):
+        INGEST_ERRORS.labels(reason).inc()
+        logger.warning(f"Closing ingest connection: {message}")
+        self.transport.close()
+
+    # --- Buffer ---
+    def _make_room(self, needed):
+        """Make at least needed bytes free after the received data, compacting or growing the buffer."""
+        pending = self._end - self._start
+        if len(self._buffer) - pending >= needed:
+            # Move the partial frame to the front; slicing copies, so the regions may overlap
+            self._buffer[:pending] = self._buffer[self._start:self._end]
+        else:
+            buffer = bytearray(max(2 * len(self._buffer), pending + needed))
+            buffer[:pending] = self._view[self._start:self._end]
+            self._buffer, self._view = buffer, memoryview(buffer)
+        self._start, self._end = 0, pending
+
+    def _parse(self):
+        """Handle every complete frame in the buffer."""
+        while not self._resolving and self._end - self._start >= LENGTH.size:
+            length, = LENGTH.unpack_from(self._buffer, self._start)
+            if not 0 < length <= MAX_FRAME:
+                raise ProtocolError(f"frame of {length} bytes")
+            frame_end = self._start + LENGTH.size + length
+            if frame_end > self._end:
+                if frame_end > len(self._buffer):
+                    self._make_room(LENGTH.size + length - (self._end - self._start))
+                return
+            frame = self._view[self._start + LENGTH.size:frame_end]
+            self._start = frame_end
+            if frame[0] == BATCH:
+                self._batch(frame)
+            elif frame[0] == HELLO:
+                self._hello(frame)
+            else:
+                raise ProtocolError(f"unknown frame type {frame[0]}")
+        if self._start == self._end:
+            self._start = self._end = 0
+
+    # --- Frames ---
+    def _hello(self, frame):
+        if self.device is not None:
+            raise ProtocolError("second HELLO")
+        try:
+            _, version, name_length = HELLO_HEADER.unpack_from(frame)
+            offset = HELLO_HEADER.size
+            device = str(frame[offset:offset + name_length], 'utf-8')
+            offset += name_length
+            tag_count, = COUNT.unpack_from(frame, offset)
+            offset += COUNT.size
+            tag_names = []
+            for _ in range(tag_count):
+                length, = COUNT.unpack_from(frame, offset)
+                tag_names.append(str(frame[offset + COUNT.size:offset + COUNT.size + length], 'utf-8'))
+                offset += COUNT.size + length
+        except (struct.error, UnicodeDecodeError) as e:
+            raise ProtocolError(f"bad HELLO: {e}")
+        if version != VERSION:
+            raise ProtocolError(f"protocol version {version}, expected {VERSION}")
+        if not device or (ALLOWED_DEVICES is not None and device not in ALLOWED_DEVICES):
+            raise ProtocolError(f"device {device!r} is not accepted")
+        if len(set(tag_names)) != len(tag_names):
+            raise ProtocolError("duplicate tag names")
+        self.device = device
+        self.tag_names = tuple(tag_names)
+
+        # Looking up the ids may hit SQLite; do it off the event loop and hold frames meanwhile
+        self._resolving = True
+        self.transport.pause_reading()
+        future = asyncio.get_running_loop().run_in_executor(None, self.server.resolve, device, self.tag_names)
+        future.add_done_callback(self._resolved)
+
+    def _resolved(self, future):
+        self._resolving = False
+        if self.transport.is_closing():
+            return
+        try:
+            self.device_id, self.tag_set = future.result()
+        except sqlite3.Error as e:
+            self.close('database', f"cannot register {self.device}: {e}")
+            return
+        self.transport.resume_reading()
+        try:
+            self._parse()
+        except ProtocolError as e:
+            self.close('malformed', f"{self.peer}: {e}")
+
+    def _batch(self, frame):
+        if self.device_id is None:
+            raise ProtocolError("BATCH before HELLO")
+        try:
+            _, seq, register_count, input_count, tag_count, count = BATCH_HEADER.unpack_from(frame)
+        except struct.error:
+            raise ProtocolError("short BATCH header")
+        size = record_size(register_count, input_count, tag_count)
+        if (len(frame) != BATCH_HEADER.size + count * size
+                or tag_count not in (0, len(self.tag_names))):
+            self._ack(seq, MALFORMED)
+            return
+        status = self.server.store(self, frame[BATCH_HEADER.size:], count, register_count, input_count, tag_count)
+        self._ack(seq, status)
+
+    def _ack(self, seq, status):
+        INGEST_BATCHES.labels(status).inc()
+        self.transport.write(ACK_FRAME.pack(ACK_FRAME.size - LENGTH.size, ACK, seq, status))
+
+
+class IngestServer:
+    """Accepts pushers and hands their samples to the database's batched writer."""
+
+    def __init__(self, database=DATABASE):
+        self.database = database
+        self.connections = set()
+        self._writer = get_writer(database)
+        if not isinstance(self._writer, SpooledWriter):
+            # The pusher forgets a batch once it is acknowledged; only the spool keeps it safe from there
+            raise RuntimeError(f"Ingest needs a spooled writer for {database}, but no spool slot is usable")
+        self._server = None
+
+    def resolve(self, device, tag_names):
+        """(device id, tag set id or None) of a pusher; runs in an executor thread."""
+        device_id = storage.get_device_id(self.database, device)
+        tag_set = storage.get_tag_set_id(self.database, device_id, list(tag_names)) if tag_names else None
+        return device_id, tag_set
+
+    def store(self, connection, body, count, register_count, input_count, tag_count):
+        """Submit the samples of a BATCH body (a memoryview); returns the ACK status."""
+        if not count:
+            return STORED
+        # Refuse the whole batch up front rather than have the writer log and count every
+        # row it cannot take as dropped; the pusher keeps the batch and resends it
+        if not self._writer.has_room(count):
+            return REFUSED
+        size = record_size(register_count, input_count, tag_count)
+        registers_end = 8 + 2 * register_count
+        inputs_end = registers_end + (input_count + 7) // 8
+        # Timestamps of every record at once, as a strided view over the buffer
+        timestamps = np.ndarray((count,), '<i8', body, 0, (size,)).tolist()
+        tag_set = connection.tag_set if tag_count else None
+        device_id = connection.device_id
+        submit = self._writer.submit
+        sql = storage.SAMPLE_INSERT_SQL
+        for i, ts in enumerate(timestamps):
+            offset = i * size
+            # The columns of storage.sample_row; the wire format is already the packed blob format
+            row = (device_id, ts,
+                   bytes(body[offset + 8:offset + registers_end]) if register_count else None,
+                   bytes(body[offset + registers_end:offset + inputs_end]) if input_count else None,
+                   input_count,
+                   tag_set,
+                   bytes(body[offset + inputs_end:offset + size]) if tag_count else None)
+            # Never block the event loop if other producers filled the queue meanwhile
+            if not submit(sql, row, timeout=0):
+                return REFUSED
+        INGEST_SAMPLES.inc(count)
+        return STORED
+
+    async def serve(self, host=LISTEN_HOST, port=LISTEN_PORT):
+        loop = asyncio.get_running_loop()
+        self._server = await loop.create_server(lambda: IngestProtocol(self), host, port)
+        logger.info(f"Ingest server listening on {host}:{port}, storing to {self.database}")
+        async with self._server:
+            await asyncio.gather(self._server.serve_forever(), self._reap_idle())
+
+    async def _reap_idle(self):
+        """Close connections that went quiet; one sweep for all of them instead of a timer each."""
+        while True:
+            await asyncio.sleep(IDLE_TIMEOUT / 4)
+            deadline = time.monotonic() - IDLE_TIMEOUT
+            for connection in [c for c in self.connections if c.last_seen < deadline]:
+                connection.close('idle', f"{connection.peer} ({connection.device}) silent for {IDLE_TIMEOUT:.0f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--listen', default=f'{LISTEN_HOST}:{LISTEN_PORT}', help='host:port to accept pushers on')
+    parser.add_argument('--database', default=DATABASE)
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT)
+    args = parser.parse_args()
+    host, _, port = args.listen.rpartition(':')
+
+    logging.basicConfig(level=logging.INFO)
+    conn = sqlite3.connect(args.database)
+    storage.initialize_schema(configure_connection(conn))
+    conn.close()
+    if args.metrics_port:
+        metrics.start_http_server(args.metrics_port)
+    try:
+        server = IngestServer(args.database)
+    except RuntimeError as e:
+        close_writers()
+        parser.exit(1, f"{e}\n")
+    try:
+        asyncio.run(server.serve(host or LISTEN_HOST, int(port)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        close_writers()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+"""
+Shared-memory cache of the latest sample of every device.
+
+One poller process (master.py) owns the segment and publishes each poll into
+a fixed slot per device; any number of web workers and CLI tools map the same
+file read-only and never touch Modbus. Every slot is guarded by a seqlock:
+the writer makes seq odd, updates the slot and makes it even again, and a
+reader copies the slot between two reads of seq and retries if they differ or
+are odd. Readers never block the writer.
+
+    python latest_cache.py            # print the cache contents
+"""
+import argparse
+import fcntl
+import json
+import mmap
+import os
+import tempfile
+import time
+from collections import namedtuple
+import numpy as np
+
+# --- Configuration ---
+CACHE_PATH = os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(),
+                          'modbus_latest.cache')
+MAX_DEVICES = 256
+REGISTER_CAPACITY = 128    # Registers kept per device slot
+INPUT_CAPACITY = 128       # Discrete inputs kept per device slot
+STALE_AFTER = 5.0          # Seconds without a publish before a device is reported stale
+READ_TIMEOUT = 0.1         # Give up on a slot the writer keeps rewriting after this long (seconds)
+
+MAGIC = b'MBLC'
+VERSION = 1
+HEADER_SIZE = 64
+HEADER_DTYPE = np.dtype([
+    ('magic', 'S4'), ('version', '<u4'), ('generation', '<u4'), ('slot_count', '<u4'),
+    ('register_capacity', '<u4'), ('input_capacity', '<u4'), ('device_count', '<u4'),
+])
+
+# Quality flags stored with every slot
+Q_REGISTERS = 0x01   # registers came from the latest poll
+Q_INPUTS = 0x02      # inputs came from the latest poll
+
+LatestValue = namedtuple('LatestValue', 'name seq timestamp last_good quality registers inputs')
+
+
+def slot_dtype(register_capacity, input_capacity):
+    return np.dtype([
+        ('seq', '<u8'),
+        ('name', 'S32'),
+        ('timestamp', '<f8'),      # time of the latest poll, good or not
+        ('last_good', '<f8'),      # time of the latest poll that returned data
+        ('quality', '<u4'),
+        ('register_count', '<u2'),
+        ('input_count', '<u2'),
+        ('registers', '<u2', (register_capacity,)),
+        ('inputs', 'u1', (input_capacity,)),
+    ], align=True)
+
+
+def _map(fd, size, access):
+    mm = mmap.mmap(fd, size, access=access)
+    header = np.ndarray((), dtype=HEADER_DTYPE, buffer=mm)
+    return mm, header
+
+def _slots(mm, header):
+    dtype = slot_dtype(int(header['register_capacity']), int(header['input_capacity']))
+    return np.ndarray((int(header['slot_count']),), dtype=dtype, buffer=mm, offset=HEADER_SIZE)
+
+
+class LatestCacheWriter:
+    """
+    The single publisher of a cache file. Holds an exclusive flock on it so a
+    second poller cannot corrupt the seqlocks; creating a writer resets the
+    segment and bumps its generation so readers drop their slot lookups.
+    """
+
+    def __init__(self, path=CACHE_PATH, max_devices=MAX_DEVICES,
+                 register_capacity=REGISTER_CAPACITY, input_capacity=INPUT_CAPACITY):
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(self._fd)
+            raise RuntimeError(f"Another process is already publishing to {path}")
+
+        size = HEADER_SIZE + max_devices * slot_dtype(register_capacity, input_capacity).itemsize
+        # Never shrink the file: readers may still map the old, larger layout
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._mm, self._header = _map(self._fd, size, mmap.ACCESS_WRITE)
+        header = self._header
+        if header['magic'] == MAGIC:
+            # Readers may be mapped right now: keep the header valid while the slots are
+            # reset, and bump the generation only once the new layout is in place
+            generation = int(header['generation']) + 1
+            header['device_count'] = 0
+            self._mm[HEADER_SIZE:] = bytes(size - HEADER_SIZE)
+        else:
+            generation = 0
+            self._mm[:] = bytes(size)
+        header['version'] = VERSION
+        header['slot_count'] = max_devices
+        header['register_capacity'] = register_capacity
+        header['input_capacity'] = input_capacity
+        header['generation'] = generation
+        header['magic'] = MAGIC
+        self._slots = _slots(self._mm, self._header)
+        self._index = {}
+
+    def _slot_for(self, name):
+        index = self._index.get(name)
+        if index is None:
+            index = len(self._index)
+            if index >= len(self._slots):
+                raise ValueError(f"Latest-value cache is full ({len(self._slots)} devices)")
+            encoded = name.encode()
+            if len(encoded) > 32:
+                raise ValueError(f"Device name {name!r} is longer than 32 bytes")
+            self._slots['name'][index] = encoded
+            self._index[name] = index
+            # Publish the slot to readers only once its name is in place
+            self._header['device_count'] = index + 1
+        return index
+
+    def publish(self, name, registers, inputs, timestamp=None):
+        """Store one poll of a device. registers/inputs may be None if that read failed."""
+        index = self._slot_for(name)
+        timestamp = time.time() if timestamp is None else timestamp
+        slots = self._slots
+        quality = 0
+        seq = slots['seq']
+        seq[index] += 1  # odd: slot is being written
+        try:
+            if registers is not None:
+                registers = registers[:slots['registers'].shape[1]]
+                slots['registers'][index, :len(registers)] = registers
+                slots['register_count'][index] = len(registers)
+                quality |= Q_REGISTERS
+            if inputs is not None:
+                inputs = inputs[:slots['inputs'].shape[1]]
+                slots['inputs'][index, :len(inputs)] = inputs
+                slots['input_count'][index] = len(inputs)
+                quality |= Q_INPUTS
+            slots['timestamp'][index] = timestamp
+            if quality:
+                slots['last_good'][index] = timestamp
+            slots['quality'][index] = quality
+        finally:
+            seq[index] += 1  # even: slot is consistent again
+
+    def close(self):
+        self._slots = self._header = None
+        self._mm.close()
+        os.close(self._fd)
+
+
+class LatestCacheReader:
+    """Read-only view of a cache file; cheap to keep open for the life of a process."""
+
+    def __init__(self, path=CACHE_PATH):
+        self.path = path
+        self._fd = os.open(path, os.O_RDONLY)
+        self._mm = None
+        try:
+            self._remap()
+        except BaseException:
+            os.close(self._fd)
+            raise
+
+    def _remap(self):
+        """
+        Map the file's current layout. Raises FileNotFoundError or ValueError
+        while no publisher has initialized it; the next call tries again.
+        """
+        if self._mm is not None:
+            self._slots = self._header = None  # release the buffer exports before closing
+            self._mm.close()
+            self._mm = None
+        size = os.fstat(self._fd).st_size
+        if size < HEADER_SIZE:
+            raise FileNotFoundError(f"{self.path} has not been initialized by a publisher")
+        mm, header = _map(self._fd, size, mmap.ACCESS_READ)
+        try:
+            if header['magic'] != MAGIC or header['version'] != VERSION:
+                raise ValueError(f"{self.path} is not a version {VERSION} latest-value cache")
+            generation = int(header['generation'])
+            needed = HEADER_SIZE + int(header['slot_count']) * slot_dtype(
+                int(header['register_capacity']), int(header['input_capacity'])).itemsize
+            if needed > size:
+                raise ValueError(f"{self.path} is being initialized by a publisher")
+            slots = _slots(mm, header)
+        except BaseException:
+            header = None
+            mm.close()
+            raise
+        self._mm, self._header, self._slots = mm, header, slots
+        self._generation = generation
+        self._index = {}
+
+    def _check_generation(self):
+        """The publisher restarted: the layout may differ and slots were reassigned."""
+        header = self._header
+        if self._mm is None or header['magic'] != MAGIC or int(header['generation']) != self._generation:
+            self._remap()
+
+    def names(self):
+        self._check_generation()
+        count = int(self._header['device_count'])
+        return [name.decode() for name in self._slots['name'][:count]]
+
+    def read(self, name):
+        """Consistent copy of one device's latest sample, or None if it has never been published."""
+        self._check_generation()
+        index = self._index.get(name)
+        if index is None:
+            names = self.names()
+            if name not in names:
+                return None
+            index = self._index[name] = names.index(name)
+
+        seq = self._slots['seq']
+        deadline = time.monotonic() + READ_TIMEOUT
+        while time.monotonic() < deadline:
+            before = int(seq[index])
+            if before & 1:
+                time.sleep(0)  # mid-write: let a writer sharing our CPU finish
+                continue
+            slot = self._slots[index:index + 1].copy()[0]
+            if int(seq[index]) == before:
+                return LatestValue(
+                    name, before, float(slot['timestamp']), float(slot['last_good']), int(slot['quality']),
+                    slot['registers'][:slot['register_count']], slot['inputs'][:slot['input_count']].astype(bool))
+        raise TimeoutError(f"Could not get a consistent read of {name!r} from {self.path}")
+
+    def read_all(self):
+        return [value for value in (self.read(name) for name in self.names()) if value is not None]
+
+    def close(self):
+        self._slots = self._header = None
+        if self._mm is not None:
+            self._mm.close()
+        os.close(self._fd)
+
+
+def to_json(value, now=None):
+    """JSON-ready dict of a LatestValue, including quality flags and staleness."""
+    now = time.time() if now is None else now
+    return {
+        'device': value.name,
+        'timestamp': value.timestamp,
+        'last_good': value.last_good or None,
+        'quality': {
+            'registers': bool(value.quality & Q_REGISTERS),
+            'inputs': bool(value.quality & Q_INPUTS),
+            'stale': now - value.timestamp > STALE_AFTER,
+        },
+        'registers': value.registers.tolist(),
+        'inputs': value.inputs.tolist(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Print the latest published value of every device')
+    parser.add_argument('--path', default=CACHE_PATH)
+    parser.add_argument('--device', help='only this device')
+    args = parser.parse_args()
+
+    reader = LatestCacheReader(args.path)
+    try:
+        values = [reader.read(args.device)] if args.device else reader.read_all()
+        print(json.dumps([to_json(value) for value in values if value is not None], indent=2))
+    finally:
+        reader.close()
+
+if __name__ == '__main__':
+    main()
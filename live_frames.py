@@ -0,0 +1,115 @@
+"""
+Binary delta frames for the live data Socket.IO stream.
+
+Clients receive the point schema once ('live_schema', JSON) and then binary
+'live_frame' messages laid out as, little-endian:
+
+    uint8   version
+    uint8   flags          (bit 0: keyframe, bit 1: float64 values)
+    uint16  count          points carried by this frame
+    uint32  seq            increments by one per frame
+    float64 timestamp      unix seconds
+    uint16  index[count]   point indices; omitted in keyframes (all points, in order)
+    uint16  value[count]   or float64 when flag bit 1 is set (schemas with decoded tags)
+
+Delta frames carry only the points that changed since the previous frame.
+A keyframe is sent every KEYFRAME_INTERVAL frames, and on request, so a
+client that joins late or sees a gap in seq can resynchronise.
+"""
+import struct
+import threading
+import numpy as np
+
+# --- Configuration ---
+FRAME_VERSION = 1
+KEYFRAME_INTERVAL = 20   # Frames between keyframes (10 s at the 0.5 s fetch interval)
+
+HEADER = struct.Struct('<BBHId')
+FLAG_KEYFRAME = 0x01
+FLAG_FLOAT64 = 0x02
+
+
+def build_schema(register_count, input_count, tags=()):
+    """
+    Point list shared by the encoder and the browser; indices follow this order.
+    Decoded tags (read_plan.Tag) follow the inputs as engineering values.
+    """
+    points = ([{'label': f'Register {i}', 'group': 'registers', 'type': 'uint16'} for i in range(register_count)] +
+              [{'label': f'Input {i}', 'group': 'inputs', 'type': 'bool'} for i in range(input_count)] +
+              [{'label': tag.name, 'group': 'tags', 'type': 'bool' if tag.kind == 'bool' else 'float64'}
+               for tag in tags])
+    return {'version': FRAME_VERSION, 'keyframe_interval': KEYFRAME_INTERVAL, 'points': points,
+            'float64': bool(tags)}
+
+
+class LiveFrameEncoder:
+    """
+    Turns successive full samples into keyframes and change-only delta frames.
+    Values go out as uint16, or as float64 when float64 is set (use the
+    schema's 'float64' entry), which engineering values need.
+    """
+
+    def __init__(self, point_count, keyframe_interval=KEYFRAME_INTERVAL, float64=False):
+        self.point_count = point_count
+        self.keyframe_interval = keyframe_interval
+        self.dtype = np.dtype('<f8' if float64 else '<u2')
+        self._flags = FLAG_FLOAT64 if float64 else 0
+        self._last = None
+        self._last_timestamp = 0.0
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def encode(self, values, timestamp, mask=None):
+        """
+        Encode the next sample (one value per schema point) as a keyframe or
+        delta frame. Delta frames carry the points set in mask, or every
+        point that differs from the last frame when no mask is given.
+        """
+        values = np.asarray(values, dtype=self.dtype)
+        if values.shape != (self.point_count,):
+            raise ValueError(f"Expected {self.point_count} values, got {values.shape[0]}")
+        with self._lock:
+            self._seq = (self._seq + 1) & 0xFFFFFFFF
+            if self._last is None or self._seq % self.keyframe_interval == 0:
+                frame = self._keyframe(values, timestamp, self._seq)
+            else:
+                if mask is None:
+                    # NaN never equals itself; a point that stays unread has not changed
+                    mask = (values != self._last) & ~(np.isnan(values) & np.isnan(self._last)) \
+                        if self._flags else values != self._last
+                changed = np.flatnonzero(mask).astype('<u2')
+                frame = (HEADER.pack(FRAME_VERSION, self._flags, len(changed), self._seq, timestamp) +
+                         changed.tobytes() + values[changed].tobytes())
+                # Resync keyframes must show what clients were sent, not values a mask held back
+                sent = self._last.copy()
+                sent[changed] = values[changed]
+                values = sent
+            self._last = values
+            self._last_timestamp = timestamp
+            return frame
+
+    def keyframe(self):
+        """Keyframe of the latest sample, for a newly connected or resyncing client; None before the first sample."""
+        with self._lock:
+            if self._last is None:
+                return None
+            return self._keyframe(self._last, self._last_timestamp, self._seq)
+
+    def _keyframe(self, values, timestamp, seq):
+        return HEADER.pack(FRAME_VERSION, FLAG_KEYFRAME | self._flags, len(values), seq, timestamp) + values.tobytes()
+
+
+def decode_frame(frame):
+    """Decode a frame into (seq, timestamp, keyframe, indices, values), the inverse of the encoder."""
+    version, flags, count, seq, timestamp = HEADER.unpack_from(frame)
+    if version != FRAME_VERSION:
+        raise ValueError(f"Unsupported frame version {version}")
+    keyframe = bool(flags & FLAG_KEYFRAME)
+    offset = HEADER.size
+    if keyframe:
+        indices = np.arange(count)
+    else:
+        indices = np.frombuffer(frame, dtype='<u2', count=count, offset=offset)
+        offset += 2 * count
+    values = np.frombuffer(frame, dtype='<f8' if flags & FLAG_FLOAT64 else '<u2', count=count, offset=offset)
+    return seq, timestamp, keyframe, indices, values
@@ -1,6 +1,19 @@
 # debug_inputs.py
+"""
+Modbus debugger: polls one discrete input range, or maps a device with --profile.
+
+    python main.py
+    python main.py --profile --host 10.0.0.5 --slave 3
+"""
+import argparse
+import logging
+import math
 import time
-from pymodbus.client import ModbusTcpClient
+import numpy as np
+from modbus_pool import get_pool
+from scheduler import ScanTimer
+from read_plan import (BIT_FUNCTIONS, MAX_BITS_PER_READ, MAX_REGISTERS_PER_READ, ReadRequest,
+                       issue_read, response_values)
 from pymodbus.exceptions import ModbusException, ConnectionException
 
 # --- Configuration (Modify these values) ---
@@ -16,6 +29,16 @@ INPUT_COUNT = 20          # Number of discrete inputs (input status) to read
 # --- Timing ---
 READ_INTERVAL_SECONDS = 2 # How often to poll (in seconds)
 CONNECTION_TIMEOUT = 3    # How long to wait for connection/response
+
+# --- Profiling (--profile) ---
+PROFILE_FUNCTIONS = (1, 2, 3, 4)  # Function codes to map
+PROBE_STRIDE = 256        # Addresses between coarse probes; a range shorter than this can fall between two
+ADDRESS_SPACE = 65536
+PROBE_TIMEOUT = 1.0       # Response timeout while profiling; devices that ignore bad addresses cost this per probe
+MAX_SILENT_PROBES = 4     # Give up on a function code after this many probes in a row without an answer
+BLOCK_SIZES = (1, 8, 32, 64, 125, 256, 1000, 2000)  # Block sizes timed (up to the largest the device accepts)
+LATENCY_SAMPLES = 20      # Reads per function code and block size
+POLL_HEADROOM = 2.0       # Suggested poll interval = this x the p90 time of one scan
 # --- End Configuration ---
 
 def run_input_debugger():
@@ -31,17 +54,16 @@ def run_input_debugger():
     print(f"Polling every {READ_INTERVAL_SECONDS} seconds. Press Ctrl+C to stop.")
     print("-" * 60) # Made separator wider
 
-    # Initialize the Modbus TCP client
-    client = ModbusTcpClient(
-        MODBUS_HOST,
-        port=MODBUS_PORT,
-        timeout=CONNECTION_TIMEOUT
-    )
+    # Use the shared connection pool so the debugger reuses one socket
+    pool = get_pool()
+    pool.timeout = CONNECTION_TIMEOUT
 
     try:
         # Attempt to connect
         print(f"Connecting to {MODBUS_HOST}:{MODBUS_PORT}...")
-        if not client.connect():
+        with pool.connection(MODBUS_HOST, MODBUS_PORT, SLAVE_ID) as client:
+            connected = client is not None
+        if not connected:
             print("*** CONNECTION FAILED ***")
             print("Please check:")
             print(f"  - Is the device IP address '{MODBUS_HOST}' correct?")
@@ -52,19 +74,25 @@ def run_input_debugger():
         print("Connection successful!")
         print("-" * 60)
 
-        # Main polling loop
+        # Main polling loop, on monotonic deadlines so read time doesn't stretch the interval
+        timer = ScanTimer(READ_INTERVAL_SECONDS, name='debug_inputs')
         while True:
+            time.sleep(timer.due_in())
+            timer.begin()
             try:
                 # --- Attempt to read discrete inputs ---
                 # Updated log message
                 print(f"Reading {INPUT_COUNT} discrete inputs from address {INPUT_START_ADDRESS}...")
 
                 # !!! KEY CHANGE: Use read_discrete_inputs for Function Code 02 !!!
-                read_response = client.read_discrete_inputs(
-                    address=INPUT_START_ADDRESS,
-                    count=INPUT_COUNT,
-                    slave=SLAVE_ID
-                )
+                with pool.connection(MODBUS_HOST, MODBUS_PORT, SLAVE_ID) as client:
+                    if client is None:
+                        raise ConnectionException(f"{MODBUS_HOST}:{MODBUS_PORT} is not reachable")
+                    read_response = client.read_discrete_inputs(
+                        address=INPUT_START_ADDRESS,
+                        count=INPUT_COUNT,
+                        slave=SLAVE_ID
+                    )
 
                 # --- Analyze the response ---
                 print(f"  Raw Response: {read_response}") # Still crucial for debugging
@@ -87,7 +115,7 @@ def run_input_debugger():
                     # If response is not an error but lacks expected data structure
                     print(f"  *** Error: Valid response received, but it has no '.bits' attribute! Unexpected response format. ***")
 
-               else:
+                else:
                     # --- Success Case ---
                     received_bits = read_response.bits[:INPUT_COUNT] # Slice to requested count
                     print(f"  Success! Received {len(received_bits)} bits.")
@@ -107,9 +135,9 @@ def run_input_debugger():
                 # Catch any other unexpected errors during the loop
                 print(f"  *** An unexpected error occurred: {e} ***")
 
-            # --- Wait before next poll ---
+            # --- Wait for the next poll ---
             print("-" * 60)
-            time.sleep(READ_INTERVAL_SECONDS)
+            timer.end()
 
     except KeyboardInterrupt:
         print("\nCtrl+C detected. Stopping polling.")
@@ -118,11 +146,286 @@ def run_input_debugger():
         print(f"*** An unexpected error occurred: {e} ***")
     finally:
         # Ensure the connection is closed gracefully
-        if client.is_socket_open():
-            print("Closing Modbus connection.")
-            client.close()
+        stats = pool.stats()
+        print(f"Closing Modbus connection (reconnects: {stats['reconnects']}).")
+        pool.close_all()
         print("Debugger finished.")
 
+
+# --- Profiling Mode ---
+FUNCTION_NAMES = {1: 'coils', 2: 'discrete inputs', 3: 'holding registers', 4: 'input registers'}
+
+# Probe outcomes
+OK = 'ok'
+ILLEGAL = 'illegal'          # exception response: address or count not accepted
+UNSUPPORTED = 'unsupported'  # exception code 1: the device does not implement the function
+NO_ANSWER = 'no answer'      # timeout or garbled response
+
+
+class FunctionProfile:
+    """What profiling found out about one function code."""
+
+    def __init__(self, function_code):
+        self.function_code = function_code
+        self.status = OK
+        self.ranges = []       # [(start, count)] of readable addresses
+        self.max_block = None  # largest count accepted in one read
+        self.latency = {}      # block size -> array of round-trip seconds
+        self.overhead = None   # fitted seconds per request...
+        self.per_point = None  # ...plus seconds per point read
+
+    @property
+    def name(self):
+        return f"FC{self.function_code:02d} {FUNCTION_NAMES[self.function_code]}"
+
+    def predict(self, count, percentile=90):
+        """Round-trip time of a read of count points, interpolated from the measured percentile."""
+        if not self.latency:
+            raise ValueError(f"No read of {self.name} succeeded; nothing to predict from")
+        sizes = sorted(self.latency)
+        times = [np.percentile(self.latency[size], percentile) for size in sizes]
+        return float(np.interp(count, sizes, times))
+
+
+class DeviceProfiler:
+    """
+    Maps a device through a connected sync client: which addresses each
+    function code can read, the largest block it accepts and how long reads
+    take. Readable addresses between two successful coarse probes are assumed
+    contiguous; boundaries are then found by binary search.
+    """
+
+    def __init__(self, client, slave, stride=PROBE_STRIDE, address_space=ADDRESS_SPACE,
+                 samples=LATENCY_SAMPLES):
+        self.client = client
+        self.slave = slave
+        self.stride = stride
+        self.address_space = address_space
+        self.samples = samples
+        self.probes = 0
+        self._readable = {}  # (function code, address) -> outcome of a single-point read
+
+    def probe(self, function_code, address, count=1):
+        """Read once; returns (outcome, round-trip seconds)."""
+        request = ReadRequest(function_code, address, count, [])
+        self.probes += 1
+        started = time.perf_counter()
+        try:
+            response = issue_read(self.client, request, self.slave)
+        except ConnectionException:
+            raise
+        except ModbusException:
+            return NO_ANSWER, time.perf_counter() - started
+        elapsed = time.perf_counter() - started
+        if response_values(request, response) is not None:
+            return OK, elapsed
+        if getattr(response, 'exception_code', None) == 1:
+            return UNSUPPORTED, elapsed
+        return ILLEGAL, elapsed
+
+    def readable(self, function_code, address):
+        key = (function_code, address)
+        if key not in self._readable:
+            self._readable[key] = self.probe(function_code, address)[0]
+        return self._readable[key] == OK
+
+    def profile(self, function_code):
+        """Map, size and time one function code."""
+        result = FunctionProfile(function_code)
+        result.status, result.ranges = self.find_ranges(function_code)
+        if not result.ranges:
+            return result
+        start, count = max(result.ranges, key=lambda r: r[1])
+        result.max_block = self.max_block(function_code, start, count)
+        for size in [size for size in BLOCK_SIZES if size < result.max_block] + [result.max_block]:
+            times = [elapsed for outcome, elapsed in (self.probe(function_code, start, size)
+                                                      for _ in range(self.samples)) if outcome == OK]
+            if times:
+                result.latency[size] = np.array(times)
+        if len(result.latency) > 1:
+            sizes = np.array(sorted(result.latency), dtype=np.float64)
+            medians = np.array([np.median(result.latency[size]) for size in sorted(result.latency)])
+            per_point, overhead = np.polyfit(sizes, medians, 1)
+            result.per_point, result.overhead = max(0.0, float(per_point)), max(0.0, float(overhead))
+        return result
+
+    def find_ranges(self, function_code):
+        """(status, [(start, count)]) of the readable address ranges."""
+        points = list(range(0, self.address_space, self.stride))
+        if points[-1] != self.address_space - 1:
+            points.append(self.address_space - 1)
+        found = []
+        silent = 0
+        for address in points:
+            outcome = self._readable[(function_code, address)] = self.probe(function_code, address)[0]
+            if outcome == UNSUPPORTED:
+                return UNSUPPORTED, []
+            silent = silent + 1 if outcome == NO_ANSWER else 0
+            if silent >= MAX_SILENT_PROBES and not any(found):
+                return NO_ANSWER, []
+            found.append(outcome == OK)
+
+        ranges = []
+        start = None
+        for i, (address, ok) in enumerate(zip(points, found)):
+            previous_ok = i > 0 and found[i - 1]
+            if ok and not previous_ok:
+                start = address if i == 0 else self._first_readable(function_code, points[i - 1], address)
+            elif not ok and previous_ok:
+                end = self._last_readable(function_code, points[i - 1], address)
+                ranges.append((start, end - start + 1))
+        if found[-1]:
+            ranges.append((start, points[-1] - start + 1))
+        return OK, ranges
+
+    def _first_readable(self, function_code, bad, good):
+        while good - bad > 1:
+            middle = (bad + good) // 2
+            if self.readable(function_code, middle):
+                good = middle
+            else:
+                bad = middle
+        return good
+
+    def _last_readable(self, function_code, good, bad):
+        while bad - good > 1:
+            middle = (good + bad) // 2
+            if self.readable(function_code, middle):
+                good = middle
+            else:
+                bad = middle
+        return good
+
+    def max_block(self, function_code, start, count):
+        """Largest count read from start in one request, up to the protocol limit and the range."""
+        limit = min(count, MAX_BITS_PER_READ if function_code in BIT_FUNCTIONS else MAX_REGISTERS_PER_READ)
+        if self.probe(function_code, start, limit)[0] == OK:
+            return limit
+        good, bad = 1, limit
+        while bad - good > 1:
+            middle = (good + bad) // 2
+            if self.probe(function_code, start, middle)[0] == OK:
+                good = middle
+            else:
+                bad = middle
+        return good
+
+
+def suggest_read_plan(profiles):
+    """ReadRequests covering every readable range in blocks of at most the device's max_block."""
+    plan = []
+    for profile in profiles:
+        for start, count in profile.ranges:
+            for address in range(start, start + count, profile.max_block):
+                plan.append(ReadRequest(profile.function_code, address,
+                                        min(profile.max_block, start + count - address), []))
+    return plan
+
+def suggest_poll_interval(profiles, plan):
+    """
+    (p90 seconds of one sequential scan of plan, suggested poll interval in
+    seconds). Requests of a function no read succeeded for are not counted.
+    """
+    by_function = {profile.function_code: profile for profile in profiles if profile.latency}
+    scan = sum(by_function[request.function_code].predict(request.count)
+               for request in plan if request.function_code in by_function)
+    interval = scan * POLL_HEADROOM
+    if interval > 0:
+        # Round up to two significant digits
+        scale = 10 ** (math.floor(math.log10(interval)) - 1)
+        interval = math.ceil(interval / scale) * scale
+    return scan, interval
+
+def print_profile(profile):
+    print(f"{profile.name}: ", end='')
+    if not profile.ranges:
+        print('no readable addresses' if profile.status == OK else profile.status)
+        return
+    print(', '.join(f"{start}-{start + count - 1}" for start, count in profile.ranges)
+          + f"; up to {profile.max_block} per read")
+    print(f"  {'block':>6} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for size in sorted(profile.latency):
+        p50, p90, p99 = np.percentile(profile.latency[size], [50, 90, 99]) * 1000
+        print(f"  {size:>6} {p50:>8.2f} {p90:>8.2f} {p99:>8.2f} {profile.latency[size].max() * 1000:>8.2f}")
+    if profile.overhead is not None:
+        print(f"  ~{profile.overhead * 1000:.2f} ms per request + {profile.per_point * 1e6:.1f} us per point")
+
+def run_profiler(functions=PROFILE_FUNCTIONS, stride=PROBE_STRIDE, samples=LATENCY_SAMPLES):
+    """Map the device's address space, time its reads and print a suggested read plan and poll rate."""
+    print("--- Modbus Device Profiler ---")
+    print(f"Target: {MODBUS_HOST}:{MODBUS_PORT}, Slave ID: {SLAVE_ID}")
+    print(f"Probing every {stride} addresses of FC {', '.join(map(str, functions))}, "
+          f"{samples} timed reads per block size. Press Ctrl+C to stop.")
+    print("-" * 60)
+
+    pool = get_pool()
+    pool.timeout = PROBE_TIMEOUT
+    # pymodbus logs every exception response, and probing provokes hundreds of them
+    pymodbus_log = logging.getLogger('pymodbus.logging')
+    log_level = pymodbus_log.level
+    pymodbus_log.setLevel(logging.CRITICAL)
+    started = time.perf_counter()
+    try:
+        with pool.connection(MODBUS_HOST, MODBUS_PORT, SLAVE_ID) as client:
+            if client is None:
+                print("*** CONNECTION FAILED ***")
+                return
+            profiler = DeviceProfiler(client, SLAVE_ID, stride, samples=samples)
+            profiles = []
+            for function_code in functions:
+                profile = profiler.profile(function_code)
+                print_profile(profile)
+                profiles.append(profile)
+    except ConnectionException as e:
+        print(f"*** Connection lost while profiling: {e} ***")
+        return
+    except KeyboardInterrupt:
+        print("\nCtrl+C detected. Stopping profiling.")
+        return
+    finally:
+        pymodbus_log.setLevel(log_level)
+        pool.close_all()
+    print("-" * 60)
+    print(f"{profiler.probes} requests in {time.perf_counter() - started:.1f}s")
+
+    profiles = [profile for profile in profiles if profile.latency]
+    if not profiles:
+        print("Nothing readable; no read plan to suggest.")
+        return
+    plan = suggest_read_plan(profiles)
+    scan, interval = suggest_poll_interval(profiles, plan)
+    print(f"Suggested read plan covering every readable address ({len(plan)} requests):")
+    for profile in profiles:
+        for start, count in profile.ranges:
+            print(f"  {profile.name} {start}-{start + count - 1}: "
+                  f"{math.ceil(count / profile.max_block)} reads of up to {profile.max_block}")
+    print(f"One sequential scan takes ~{scan * 1000:.1f} ms (p90); "
+          f"suggested poll interval {interval:g}s ({1 / interval:.1f} Hz)")
+    # Reading a hole costs per_point per address, a separate request costs overhead
+    for name, functions_of_kind, limit in (('MAX_REGISTER_GAP', (3, 4), MAX_REGISTERS_PER_READ),
+                                           ('MAX_BIT_GAP', BIT_FUNCTIONS, MAX_BITS_PER_READ)):
+        gaps = [profile.overhead / profile.per_point for profile in profiles
+                if profile.function_code in functions_of_kind and profile.per_point]
+        if gaps:
+            print(f"For tag-based plans (read_plan.build_read_plan): {name} = {min(int(min(gaps)), limit - 1)}")
+
 if __name__ == "__main__":
-    # Optional: Add basic validation for config if desired
-    run_input_debugger()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default=MODBUS_HOST)
+    parser.add_argument('--port', type=int, default=MODBUS_PORT)
+    parser.add_argument('--slave', type=int, default=SLAVE_ID)
+    parser.add_argument('--profile', action='store_true',
+                        help='map readable addresses, block sizes and latencies, then suggest a read plan')
+    parser.add_argument('--functions', default=','.join(map(str, PROFILE_FUNCTIONS)),
+                        help='function codes to profile, e.g. 3,4')
+    parser.add_argument('--stride', type=int, default=PROBE_STRIDE, help='addresses between coarse probes')
+    parser.add_argument('--samples', type=int, default=LATENCY_SAMPLES, help='timed reads per block size')
+    args = parser.parse_args()
+    MODBUS_HOST, MODBUS_PORT, SLAVE_ID = args.host, args.port, args.slave
+    if args.profile:
+        functions = tuple(int(code) for code in args.functions.split(','))
+        if not set(functions) <= set(FUNCTION_NAMES):
+            parser.error('--functions takes read function codes 1-4')
+        run_profiler(functions, args.stride, args.samples)
+    else:
+        run_input_debugger()
\ No newline at end of file
@@ -1,8 +1,18 @@
+import asyncio
 import sqlite3
+import numpy as np
 import time
 from datetime import datetime
-from pymodbus.client import ModbusTcpClient
-from pymodbus.exceptions import ModbusException, ConnectionException
+from poller import AsyncPoller, Device
+from read_plan import Tag
+from db_writer import close_writers
+from deadband import DeadbandFilter, block_values
+from alarms import Rule
+import alarms
+import metrics
+import latest_cache
+import storage
+import rollup
 
 # --- Configuration ---
 DATABASE_NAME = 'modbus_data.db'
@@ -19,227 +29,203 @@ REGISTER_COUNT = 20
 INPUT_START_ADDRESS = 0  # Start address for discrete inputs (0-based)
 INPUT_COUNT = 20         # Number of discrete inputs to read
 
+# --- Tag Configuration ---
+# One tag per point: (name, function code, 0-based address, type). The read plan
+# merges neighbouring tags into as few requests as the protocol limits allow;
+# each poller Device builds it once and reuses it every scan. Pass
+# scan_class='fast' (or any name in scheduler.SCAN_CLASSES) to poll a tag at
+# that rate instead of POLL_INTERVAL; each scan class gets its own plan and
+# phase-staggered schedule.
+# Typed tags decode to engineering values with byte/word order, scale, offset
+# and bitfields, e.g. a word-swapped float32 in kW:
+#     Tag('power_kw', 3, 100, 'float32', word_order='little', scale=0.001)
+# Tags that are more than the raw point are stored with each sample as well.
+TAGS = (
+    [Tag(f'register_{i}', 3, REG_START_ADDRESS + i, 'uint16') for i in range(REGISTER_COUNT)] +
+    [Tag(f'input_{i}', 2, INPUT_START_ADDRESS + i, 'bool') for i in range(INPUT_COUNT)]
+)
+
+# --- Polling Configuration ---
+POLL_INTERVAL = 1.0      # Cycle time per device (seconds)
+MAX_CONCURRENT_POLLS = 50
+# Requests of one scan sent at once per device. Above 1 a scan of several
+# blocks costs about one round trip instead of one per block, which matters on
+# slow links; devices that cannot pipeline are detected and read one request
+# at a time automatically.
+PIPELINE_DEPTH = 1
+ROLLUP_ENABLED = True    # Maintain 1m/1h/1d rollups and apply retention while logging (only here; see app.py)
+# --- Report-by-Exception ---
+# A sample is stored only when some point moved past its deadband or has been
+# silent for MAX_SILENCE; inputs report on change. Static plants then cost
+# one row per MAX_SILENCE instead of one per poll.
+DEFAULT_DEADBAND = (0, 0.0)   # (absolute counts, percent of last reported value) for registers
+REGISTER_DEADBANDS = {}       # {device name: {register index: (absolute, percent)}}
+TAG_DEADBANDS = {}            # {tag name: (absolute, percent)} in engineering units; default any change
+MAX_SILENCE = 60.0            # Seconds before an unchanged point is stored anyway
+
+# --- Alarms ---
+# {device name: [Rule, ...]} on 'register_N', 'input_N' or typed tag names,
+# evaluated on every poll before the deadband; state changes go to the
+# alarm_events table, e.g.
+#     {'plc-1': [Rule('tank_high', 'register_3', 'high', limit=900, hysteresis=20, on_delay=5)]}
+ALARM_RULES = {}
+
+# Publish every poll to the shared-memory latest-value cache, which app.py
+# (LIVE_SOURCE = 'cache'), /api/latest and latest_cache.py read
+LATEST_CACHE_ENABLED = True
+LATEST_CACHE_PATH = latest_cache.CACHE_PATH
+
+METRICS_PORT = 9102      # Serve Prometheus /metrics here while logging (None to disable)
+
+# Devices polled concurrently by run_modbus_logger; add one entry per PLC
+DEVICES = [
+    Device('plc-1', MODBUS_HOST, port=MODBUS_PORT, slave=SLAVE_ID, interval=POLL_INTERVAL,
+           reg_start=REG_START_ADDRESS, reg_count=REGISTER_COUNT,
+           input_start=INPUT_START_ADDRESS, input_count=INPUT_COUNT, tags=TAGS, pipeline=PIPELINE_DEPTH),
+]
+
 # --- Database Initialization ---
 def initialize_database():
-    """Create tables with proper schema"""
+    """Create the packed sample schema (see storage.py)"""
     conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-
-    # Create holding registers table
-    cursor.execute(f'''
-        CREATE TABLE IF NOT EXISTS holding_registers (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp DATETIME NOT NULL,
-            {', '.join([f'register_{i} INTEGER' for i in range(REGISTER_COUNT)])}
-        )
-    ''')
-
-    # Create table for input status
-    # NOTE: Table/column names kept as 'coil_status'/'coil_i' for simplicity,
-    # but it now stores Discrete Input (FC02) data.
-    cursor.execute(f'''
-        CREATE TABLE IF NOT EXISTS coil_status (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp DATETIME NOT NULL,
-            {', '.join([f'coil_{i} INTEGER' for i in range(INPUT_COUNT)])}
-        )
-    ''')
-    # ^-- IMPORTANT: Used INPUT_COUNT here for column generation
-
-    conn.commit()
-    conn.close()
-
-# --- Data Storage Functions ---
-def store_register_data(data):
-    """Store register data with transaction handling"""
-    if data is None or len(data) != REGISTER_COUNT:
-        print(f"Invalid or mismatched register data. Expected {REGISTER_COUNT}, got: {data}")
-        return False
-
-    conn = None
     try:
-        conn = sqlite3.connect(DATABASE_NAME)
-        cursor = conn.cursor()
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
-        columns = ['timestamp'] + [f'register_{i}' for i in range(REGISTER_COUNT)]
-        placeholders = ', '.join(['?'] * len(columns))
-        cursor.execute(f'''
-            INSERT INTO holding_registers ({', '.join(columns)})
-            VALUES ({placeholders})
-        ''', [timestamp] + data)
-        conn.commit()
-        return True
-    except sqlite3.Error as e:
-        print(f"Register DB error: {e}")
-        if conn: conn.rollback()
-        return False
+        # Samples are stored one row per device per poll with registers and
+        # discrete inputs packed into blobs; run migrate_db.py to convert
+        # databases created with the old holding_registers/coil_status tables.
+        storage.initialize_schema(conn)
+        rollup.initialize_rollups(conn)
+        alarms.initialize_alarms(conn)
     finally:
-        if conn: conn.close()
-
-# Renamed function for clarity
-def store_input_data(data):
-    """Store discrete input data (FC02) with proper boolean conversion"""
-    # Use INPUT_COUNT for validation
-    if data is None or len(data) != INPUT_COUNT:
-        # Updated error message
-        print(f"Invalid or mismatched Discrete Input data. Expected {INPUT_COUNT}, got: {data}")
-        return False
-
-    # Convert boolean values (True/False) to integers (2/0)
-    int_data = [int(bool(value)) for value in data]
+        conn.close()
 
-    conn = None
-    try:
-        conn = sqlite3.connect(DATABASE_NAME)
-        cursor = conn.cursor()
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
-        # NOTE: Still using 'coil_{i}' column names as per initialize_database
-        columns = ['timestamp'] + [f'coil_{i}' for i in range(INPUT_COUNT)]
-        placeholders = ', '.join(['?'] * len(columns))
-
-        # NOTE: Still inserting into 'coil_status' table
-        cursor.execute(f'''
-            INSERT INTO coil_status ({', '.join(columns)})
-            VALUES ({placeholders})
-        ''', [timestamp] + int_data)
-
-        conn.commit()
-        return True
-    except sqlite3.Error as e:
-        # Updated error message
-        print(f"Discrete Input DB error: {e}")
-        if conn: conn.rollback()
+# --- Data Storage Functions ---
+def store_sample(device_name, registers, inputs, tag_names=None, tag_values=None):
+    """Queue one sample (registers and/or discrete inputs, plus typed tag values) for the batched writer"""
+    if registers is None and inputs is None:
         return False
-    finally:
-        if conn: conn.close()
-
-# --- Modbus Reading Function ---
-def read_modbus_data(client):
-    """
-    Read both holding registers (FC03) and discrete inputs (FC02) sequentially.
-    Returns a dictionary {'registers': list|None, 'inputs': list|None}.
-    """
-    # Changed dictionary key name for clarity ('coils' -> 'inputs')
-    data = {'registers': None, 'inputs': None}
-
-    if not client.is_socket_open():
-        print("Cannot read: Modbus connection is not open.")
-        return data
-
-    # --- Read Holding Registers (FC03) ---
-    try:
-        # (Register reading logic remains the same)
-        reg_response = client.read_holding_registers(
-            address=REG_START_ADDRESS,
-            count=REGISTER_COUNT,
-            slave=SLAVE_ID
-        )
-        if reg_response.isError():
-            print(f"Modbus Error reading Holding Registers: {reg_response}")
-        elif hasattr(reg_response, 'registers') and len(reg_response.registers) == REGISTER_COUNT:
-            data['registers'] = reg_response.registers
-        else:
-            # Handle unexpected response or length mismatch
-             print(f"Unexpected response or length for Holding Registers: {reg_response}")
-
-    except ModbusException as e:
-        print(f"Modbus exception during Holding Register read: {e}")
-    except Exception as e:
-         print(f"General exception during Holding Register read: {e}")
-
-
-    # --- Read Discrete Inputs (FC02) ---
-    # Runs after register read attempt
-    try:
-        # Updated print message
-        # print(f"Reading {INPUT_COUNT} discrete inputs from address {INPUT_START_ADDRESS}...")
-
-        # !!! KEY CHANGE: Use read_discrete_inputs !!!
-        input_response = client.read_discrete_inputs(
-            address=INPUT_START_ADDRESS,
-            count=INPUT_COUNT,
-            slave=SLAVE_ID
-        )
-
-        if input_response.isError():
-            # Updated error message
-            print(f"Modbus Error reading Discrete Inputs: {input_response}")
-        elif hasattr(input_response, 'bits'):
-            actual_bits_returned = len(input_response.bits)
-            if actual_bits_returned >= INPUT_COUNT:
-                 # Store result under the 'inputs' key
-                data['inputs'] = input_response.bits[:INPUT_COUNT]
-                # print("Discrete Inputs read successfully.")
-            else:
-                # Handle receiving fewer bits than expected
-                print(f"Warning: Requested {INPUT_COUNT} inputs, received {actual_bits_returned}. Storing received bits.")
-                data['inputs'] = input_response.bits
-        else:
-            # Handle unexpected response object
-            print(f"Unexpected response object for Discrete Inputs: {input_response}")
-
-    except ModbusException as e:
-         # Updated error message
-        print(f"Modbus exception during Discrete Input read: {e}")
-    except Exception as e:
-         # Updated error message
-        print(f"General exception during Discrete Input read: {e}")
-
-    return data
+    # Convert boolean values (True/False) to integers (1/0)
+    int_inputs = None if inputs is None else [int(bool(value)) for value in inputs]
+    return storage.store_sample(DATABASE_NAME, device_name, registers, int_inputs,
+                                tag_names=tag_names, tag_values=tag_values)
 
 # --- Main Loop ---
-def run_modbus_logger():
+_latest_writer = None
+_deadbands = {}  # device name -> DeadbandFilter; only touched from the poller's sink thread
+_alarm_engines = {}  # device name -> AlarmEngine, same thread
+_stored_tags = {}  # device name -> (names, index into device.tags) of the tags stored with samples
+
+def stored_tags(device):
+    """Names and positions of the device's typed tags, whose values are stored alongside the blocks."""
+    stored = _stored_tags.get(device.name)
+    if stored is None:
+        index = np.array([i for i, tag in enumerate(device.tags) if not tag.raw], dtype=np.intp)
+        stored = _stored_tags[device.name] = ([device.tags[i].name for i in index], index)
+    return stored
+
+def report_mask(device, values, now):
+    """Deadband mask of the points in this sample (see sample_values) worth storing."""
+    deadband = _deadbands.get(device.name)
+    if deadband is None:
+        names, _ = stored_tags(device)
+        deadband = _deadbands[device.name] = DeadbandFilter.for_points(
+            device.reg_count, device.input_count, REGISTER_DEADBANDS.get(device.name),
+            DEFAULT_DEADBAND, MAX_SILENCE, [TAG_DEADBANDS.get(name, (0, 0.0)) for name in names])
+    return deadband.update(values, now)
+
+def sample_values(device, registers, inputs, tag_values=None):
+    """Point vector of one sample: registers, inputs, then the stored tags' values."""
+    names, _ = stored_tags(device)
+    return block_values(device.reg_count + device.input_count + len(names), registers, inputs,
+                        device.reg_count, device.input_count, tag_values)
+
+def check_alarms(device, values, now):
+    """Evaluate the device's ALARM_RULES on one sample and queue the state changes for storage."""
+    engine = _alarm_engines.get(device.name)
+    if engine is None:
+        names, _ = stored_tags(device)
+        engine = _alarm_engines[device.name] = alarms.AlarmEngine(
+            ALARM_RULES.get(device.name, ()), alarms.block_points(device.reg_count, device.input_count, names),
+            device.name)
+    events = engine.update(values, now)
+    for event in events:
+        print(f"{device.name}: alarm {event.rule.name} {event.state} ({event.rule.point} = {event.value:g})")
+    alarms.store_events(DATABASE_NAME, device.name, events)
+
+def handle_sample(device, modbus_data):
+    """Store one polled sample; called by the poller for every device cycle."""
+    timestamp_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    registers = modbus_data.get('registers')
+    inputs = modbus_data.get('inputs')
+
+    if registers is None:
+        print(f"[{timestamp_str}] {device.name}: No valid Holding Register data received.")
+    if inputs is None:
+        print(f"[{timestamp_str}] {device.name}: No valid Discrete Input data received.")
+    if _latest_writer is not None:
+        _latest_writer.publish(device.name, registers, inputs)
+    if registers is None and inputs is None:
+        return
+    tag_names, index = stored_tags(device)
+    tag_values = modbus_data['tag_values'][index] if len(index) and 'tag_values' in modbus_data else None
+    values = sample_values(device, registers, inputs, tag_values)
+    now = time.monotonic()
+    if device.name in ALARM_RULES:
+        check_alarms(device, values, now)
+    if not report_mask(device, values, now).any():
+        metrics.SAMPLES_SUPPRESSED.labels(device.name).inc()
+        return
+
+    # Successful samples are counted in /metrics rather than printed, which
+    # would cost more than the store itself at high poll rates
+    if not store_sample(device.name, registers, inputs, tag_names, tag_values):
+        print(f"[{timestamp_str}] {device.name}: Sample storage failed.")
+
+def open_latest_cache(devices):
+    """Become the publisher of the latest-value cache, sized for devices."""
+    try:
+        return latest_cache.LatestCacheWriter(
+            LATEST_CACHE_PATH,
+            max_devices=max(latest_cache.MAX_DEVICES, len(devices)),
+            register_capacity=max([latest_cache.REGISTER_CAPACITY] + [d.reg_count for d in devices]),
+            input_capacity=max([latest_cache.INPUT_CAPACITY] + [d.input_count for d in devices]))
+    except (OSError, RuntimeError) as e:
+        print(f"Latest-value cache disabled: {e}")
+        return None
+
+def run_modbus_logger(devices=None):
+    global _latest_writer
     initialize_database()
-    print(f"Attempting to connect to Modbus TCP server at {MODBUS_HOST}:{MODBUS_PORT}...")
-    client = ModbusTcpClient(MODBUS_HOST, port=MODBUS_PORT, retries=3, timeout=5)
+    devices = DEVICES if devices is None else devices
+    if LATEST_CACHE_ENABLED:
+        _latest_writer = open_latest_cache(devices)
+    print(f"Polling {len(devices)} Modbus device(s), up to {MAX_CONCURRENT_POLLS} at a time...")
+    poller = AsyncPoller(devices, handle_sample, max_concurrency=MAX_CONCURRENT_POLLS)
+    if METRICS_PORT:
+        metrics.start_http_server(METRICS_PORT)
+        print(f"Metrics available at http://0.0.0.0:{METRICS_PORT}/metrics")
+    rollup_job = rollup.RollupJob(DATABASE_NAME) if ROLLUP_ENABLED else None
+    if rollup_job:
+        rollup_job.start()
 
     try:
-        if not client.connect():
-            print(f"Connection failed to {MODBUS_HOST}:{MODBUS_PORT}. Exiting.")
-            return
-        print("Modbus connection successful.")
-
-        while True:
-            start_time = time.time()
-            current_timestamp_obj = datetime.now()
-            timestamp_str = current_timestamp_obj.strftime('%Y-%m-%d %H:%M:%S')
-
-            modbus_data = read_modbus_data(client)
-
-            # Process registers
-            if modbus_data.get('registers') is not None:
-                success = store_register_data(modbus_data['registers'])
-                status = "stored successfully" if success else "storage failed"
-                print(f"[{timestamp_str}] Holding Registers data {status}.")
-            else:
-                print(f"[{timestamp_str}] No valid Holding Register data received.")
-
-            # Process discrete inputs (using the 'inputs' key now)
-            if modbus_data.get('inputs') is not None:
-                # Call the renamed storage function
-                success = store_input_data(modbus_data['inputs'])
-                status = "stored successfully" if success else "storage failed"
-                # Updated print message
-                print(f"[{timestamp_str}] Discrete Input data {status}.")
-            else:
-                # Updated print message
-                print(f"[{timestamp_str}] No valid Discrete Input data received.")
-
-            # Timing loop
-            elapsed = time.time() - start_time
-            sleep_time = max(0, 1.0 - elapsed)
-            time.sleep(sleep_time)
-
+        asyncio.run(poller.run())
     except KeyboardInterrupt:
         print("\nStopping logger due to KeyboardInterrupt...")
     except Exception as e:
         print(f"\nAn unexpected error occurred in the main loop: {e}")
     finally:
-        if client.is_socket_open():
-            print("Closing Modbus connection.")
-            client.close()
-        else:
-            print("Modbus connection was already closed.")
+        if rollup_job:
+            rollup_job.stop()
+        close_writers()
+        if _latest_writer is not None:
+            _latest_writer.close()
+            _latest_writer = None
+        for name, stats in poller.stats.items():
+            print(f"{name}: polls={stats.polls}, timeouts={stats.timeouts}, "
+                  f"errors={stats.errors}, missed cycles={stats.missed_cycles}")
+            for scan_class, scan in stats.scans.items():
+                print(f"  {scan_class}: runs={scan.runs}, overruns={scan.overruns}, "
+                      f"jitter mean={scan.mean_jitter * 1000:.1f} ms max={scan.max_jitter * 1000:.1f} ms")
 
 if __name__ == "__main__":
     run_modbus_logger()
\ No newline at end of file
@@ -0,0 +1,306 @@
+"""
+Raw Modbus TCP (MBAP) framing and a minimal asyncio client that exchanges
+PDUs as bytes. Used where the pymodbus object model gets in the way, such as
+the gateway, which forwards requests and responses without decoding them,
+and the poller's pipelined mode, which keeps several requests on the wire at
+once (pymodbus clients wait for each answer before sending the next).
+"""
+import asyncio
+import itertools
+import logging
+import struct
+from modbus_pool import RECONNECT_BACKOFF_INITIAL, RECONNECT_BACKOFF_MAX
+
+# --- Configuration ---
+REQUEST_TIMEOUT = 2.0
+CONNECT_TIMEOUT = 3.0
+PIPELINE_DEPTH = 1             # Requests in flight per connection by default (1 = no pipelining)
+PIPELINE_FAULT_LIMIT = 3       # Pipelined timeouts/drops before a connection falls back to one at a time
+PIPELINE_FAULT_RESET = 100     # Pipelined responses without a fault that clear the count again
+
+MBAP_HEADER = struct.Struct('>HHHB')  # transaction id, protocol id (0), length, unit id
+MAX_PDU_SIZE = 253
+
+# Exception codes (Modbus application protocol, section 7)
+ILLEGAL_FUNCTION = 0x01
+ILLEGAL_DATA_ADDRESS = 0x02
+ILLEGAL_DATA_VALUE = 0x03
+SLAVE_DEVICE_FAILURE = 0x04
+GATEWAY_PATH_UNAVAILABLE = 0x0A
+GATEWAY_TARGET_NO_RESPONSE = 0x0B
+
+READ_FUNCTION_CODES = (1, 2, 3, 4)
+
+logger = logging.getLogger(__name__)
+
+
+class FrameError(ValueError):
+    """The peer sent something that is not a Modbus TCP frame."""
+
+
+async def read_frame(reader):
+    """
+    Read one MBAP frame. Returns (transaction id, unit id, pdu bytes).
+    Raises asyncio.IncompleteReadError when the peer closes the connection.
+    """
+    header = await reader.readexactly(MBAP_HEADER.size)
+    transaction_id, protocol_id, length, unit_id = MBAP_HEADER.unpack(header)
+    if protocol_id != 0 or not 2 <= length <= MAX_PDU_SIZE + 1:
+        raise FrameError(f"Bad MBAP header: protocol {protocol_id}, length {length}")
+    pdu = await reader.readexactly(length - 1)
+    return transaction_id, unit_id, pdu
+
+def encode_frame(transaction_id, unit_id, pdu):
+    return MBAP_HEADER.pack(transaction_id, 0, len(pdu) + 1, unit_id) + pdu
+
+def exception_pdu(function_code, exception_code):
+    return bytes((function_code | 0x80, exception_code))
+
+def read_request_pdu(function_code, address, count):
+    return struct.pack('>BHH', function_code, address, count)
+
+def is_exception(pdu):
+    return bool(pdu) and pdu[0] & 0x80
+
+def decode_read_response(function_code, count, pdu):
+    """
+    Bits (FC01/02) or registers (FC03/04) of a read response PDU, or None if it
+    is an exception or does not have the shape the request asked for.
+    """
+    size = (count + 7) // 8 if function_code in (1, 2) else 2 * count
+    if len(pdu) != 2 + size or pdu[0] != function_code or pdu[1] != size:
+        return None
+    if function_code in (1, 2):
+        return [bool(pdu[2 + (i >> 3)] >> (i & 7) & 1) for i in range(count)]
+    return list(struct.unpack_from(f'>{count}H', pdu, 2))
+
+
+class MbapClient:
+    """
+    One Modbus TCP connection that sends request PDUs and returns response
+    PDUs, matched to their requests by MBAP transaction id.
+
+    With max_in_flight=1 requests go out one at a time in the order request()
+    was called (asyncio.Semaphore is FIFO), which is what keeps forwarded
+    writes ordered. With more, up to max_in_flight requests share the socket
+    at once and a scan costs about one round trip instead of one per request.
+    Many devices and serial gateways do not implement that part of the spec,
+    so pipelining is probed on first connect and the client falls back to one
+    request at a time for good if the device fails the probe, answers with a
+    transaction id that was never asked for, or repeatedly drops or times out
+    pipelined requests.
+
+    The connection is opened on first use and reopened after failures with
+    exponential backoff.
+    """
+
+    def __init__(self, host, port=502, timeout=REQUEST_TIMEOUT, max_in_flight=PIPELINE_DEPTH):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.max_in_flight = max(1, max_in_flight)
+        self._reader = None
+        self._writer = None
+        self._reader_task = None
+        self._slots = asyncio.Semaphore(self.max_in_flight)
+        self._sequential = asyncio.Lock()  # taken on top of a slot once pipelining is off
+        self._connect_lock = asyncio.Lock()
+        self._pending = {}       # transaction id -> Future of the response pdu
+        self._abandoned = set()  # ids of cancelled requests whose answer may still arrive
+        self._transaction_ids = itertools.cycle(range(1, 0x10000))
+        self._verified = self.max_in_flight == 1
+        self._faults = 0
+        self._clean = 0
+        self._backoff = 0.0
+        self._next_connect = 0.0
+        self.stats = {'requests': 0, 'timeouts': 0, 'errors': 0, 'connects': 0,
+                      'late_responses': 0, 'pipeline_faults': 0}
+
+    @property
+    def connected(self):
+        return self._writer is not None and not self._writer.is_closing()
+
+    @property
+    def pipelined(self):
+        """True while more than one request may be in flight."""
+        return self.max_in_flight > 1
+
+    async def connect(self):
+        """Open the connection now. Returns False if that failed, like the pymodbus clients."""
+        try:
+            await self._ensure_connected()
+        except ConnectionError as e:
+            logger.warning(str(e))
+            return False
+        return True
+
+    async def _ensure_connected(self):
+        async with self._connect_lock:
+            if self.connected:
+                return
+            await self._connect()
+            if not self._verified:
+                try:
+                    await self._probe()
+                except BaseException:
+                    self.close()  # never leave an unverified connection behind
+                    raise
+
+    async def _connect(self):
+        loop = asyncio.get_running_loop()
+        if loop.time() < self._next_connect:
+            raise ConnectionError(f"{self.host}:{self.port} unreachable, retrying in "
+                                  f"{self._next_connect - loop.time():.1f}s")
+        try:
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), CONNECT_TIMEOUT)
+        except (OSError, asyncio.TimeoutError) as e:
+            self._backoff = min(RECONNECT_BACKOFF_MAX, max(RECONNECT_BACKOFF_INITIAL, self._backoff * 2))
+            self._next_connect = loop.time() + self._backoff
+            raise ConnectionError(f"Connection to {self.host}:{self.port} failed: {e}") from e
+        self._backoff = 0.0
+        self.stats['connects'] += 1
+        self._reader_task = asyncio.create_task(self._read_responses(self._reader))
+
+    async def _probe(self):
+        """
+        Send two Diagnostics / Return Query Data requests back to back. A
+        device that pipelines answers both, each under its own transaction id
+        (an exception response is fine too); anything else means it does not.
+        """
+        loop = asyncio.get_running_loop()
+        probes = {}
+        for marker in (0x5A01, 0x5A02):
+            pdu = struct.pack('>BHH', 0x08, 0x0000, marker)
+            transaction_id = self._next_transaction_id()
+            probes[transaction_id] = pdu
+            self._pending[transaction_id] = loop.create_future()
+            self._writer.write(encode_frame(transaction_id, 0, pdu))
+        futures = {transaction_id: self._pending[transaction_id] for transaction_id in probes}
+        try:
+            await asyncio.wait(futures.values(), timeout=self.timeout)
+        finally:
+            for transaction_id in probes:
+                self._pending.pop(transaction_id, None)
+        reason = None
+        for transaction_id, future in futures.items():
+            if not future.done():
+                reason = f"probe {transaction_id} timed out"
+            elif future.exception() is not None:
+                reason = f"probe {transaction_id} failed: {future.exception()}"
+            elif future.result() != probes[transaction_id] and not is_exception(future.result()):
+                reason = f"probe {transaction_id} was answered with {future.result().hex()}"
+        if reason is None:
+            self._verified = True
+            return
+        self._pipeline_fault(reason, fatal=True)
+        # The stream may still carry answers to the probes; start over on a clean one
+        self.close()
+        self._next_connect = 0.0
+        await self._connect()
+
+    def _next_transaction_id(self):
+        while True:
+            transaction_id = next(self._transaction_ids)
+            if transaction_id not in self._pending and transaction_id not in self._abandoned:
+                return transaction_id
+
+    async def request(self, unit_id, pdu):
+        """
+        Send one request PDU and return the response PDU (which may be a Modbus
+        exception response). Raises ConnectionError or asyncio.TimeoutError.
+        """
+        async with self._slots:
+            await self._ensure_connected()
+            if self.pipelined:
+                return await self._exchange(unit_id, pdu)
+            # Also covers requests that got a slot before a fallback
+            async with self._sequential:
+                await self._ensure_connected()
+                return await self._exchange(unit_id, pdu)
+
+    async def _exchange(self, unit_id, pdu):
+        transaction_id = self._next_transaction_id()
+        future = self._pending[transaction_id] = asyncio.get_running_loop().create_future()
+        self.stats['requests'] += 1
+        try:
+            self._writer.write(encode_frame(transaction_id, unit_id, pdu))
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            self.stats['timeouts'] += 1
+            if len(self._pending) > 1 and self.pipelined:
+                self._pipeline_fault(f"request timed out with {len(self._pending)} in flight")
+            self.close()
+            raise
+        except ConnectionError:
+            raise  # the connection was already closed by _read_responses
+        except OSError as e:
+            self.stats['errors'] += 1
+            self.close()
+            raise ConnectionError(f"{self.host}:{self.port}: {e}") from e
+        finally:
+            # Still pending means neither answered nor failed by close(): the caller
+            # cancelled, and the answer may still come and must not look foreign
+            if self._pending.pop(transaction_id, None) is not None:
+                self._abandoned.add(transaction_id)
+
+    async def _read_responses(self, reader):
+        """Hand every response on this connection to the request waiting for its transaction id."""
+        try:
+            while True:
+                transaction_id, _, response = await read_frame(reader)
+                future = self._pending.pop(transaction_id, None)
+                if future is not None:
+                    if not future.done():
+                        future.set_result(response)
+                    if self._pending and self.pipelined:
+                        self._pipeline_ok()
+                elif transaction_id in self._abandoned:
+                    self._abandoned.discard(transaction_id)
+                    self.stats['late_responses'] += 1
+                else:
+                    raise FrameError(f"Response to transaction {transaction_id}, which is not in flight")
+        except asyncio.CancelledError:
+            raise
+        except (OSError, asyncio.IncompleteReadError, FrameError) as e:
+            if reader is not self._reader:
+                return
+            self.stats['errors'] += 1
+            if self.pipelined:
+                if isinstance(e, FrameError):
+                    self._pipeline_fault(str(e), fatal=True)
+                elif len(self._pending) > 1:
+                    self._pipeline_fault(f"connection lost with {len(self._pending)} requests in flight")
+            self.close(ConnectionError(f"{self.host}:{self.port}: {e}"))
+
+    def _pipeline_ok(self):
+        self._clean += 1
+        if self._clean >= PIPELINE_FAULT_RESET:
+            self._faults = self._clean = 0
+
+    def _pipeline_fault(self, reason, fatal=False):
+        """Count a failure that pipelining may have caused; fall back once there are enough."""
+        if not self.pipelined:
+            return
+        self.stats['pipeline_faults'] += 1
+        self._faults += 1
+        self._clean = 0
+        if not fatal and self._faults < PIPELINE_FAULT_LIMIT:
+            return
+        logger.warning(f"{self.host}:{self.port} does not handle pipelined requests ({reason}); "
+                       f"sending one at a time from now on")
+        self.max_in_flight = 1
+        self._verified = True
+
+    def close(self, error=None):
+        if self._reader_task is not None and self._reader_task is not asyncio.current_task():
+            self._reader_task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = self._reader_task = None
+        error = error or ConnectionError(f"Connection to {self.host}:{self.port} closed")
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self._pending.clear()
+        self._abandoned.clear()
@@ -0,0 +1,262 @@
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# --- Configuration ---
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+SIZE_BUCKETS = (1, 10, 50, 100, 250, 500, 1000, 2500, 5000)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """
+    Base for labelled metrics. labels(...) returns a child that call sites
+    should keep a reference to, so the hot path is a lock and an addition.
+    """
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def labels(self, *values):
+        values = tuple(str(v) for v in values)
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        for values, child in list(self._children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+    def _render_child(self, values, child):
+        return [f'{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.get())}']
+
+
+class _Value:
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self._value -= amount
+
+    def set(self, value):
+        self._value = value
+
+    def get(self):
+        return self._value
+
+
+class _CallbackValue:
+    """Value read from a function at scrape time (queue depths, pool counters)."""
+
+    def __init__(self, function):
+        self._function = function
+
+    def get(self):
+        return self._function()
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def _new_child(self):
+        return _Value()
+
+    def set(self, value):
+        self._default.set(value)
+
+    def set_function(self, function, *label_values):
+        """Report function() at scrape time instead of a stored value."""
+        with self._lock:
+            self._children[tuple(str(v) for v in label_values)] = _CallbackValue(function)
+
+
+class CallbackCounter(Gauge):
+    """A counter whose value is owned elsewhere and read at scrape time."""
+    type = 'counter'
+
+
+class _HistogramValue:
+    def __init__(self, bounds):
+        self._bounds = bounds
+        self._counts = [0] * (len(bounds) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self._bounds, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def snapshot(self):
+        with self._lock:
+            return list(self._counts), self._sum
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labelnames)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def _render_child(self, values, child):
+        counts, total = child.snapshot()
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            labels = _format_labels(self.labelnames, values, ('le', _format_value(float(bound))))
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+        labels = _format_labels(self.labelnames, values)
+        lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+        lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+# --- Registry ---
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """Add a metric, or return the one already registered under its name."""
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def render(self):
+        """Prometheus text exposition of every registered metric."""
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+def counter(name, help, labelnames=()):
+    return REGISTRY.register(Counter(name, help, labelnames))
+
+def gauge(name, help, labelnames=()):
+    return REGISTRY.register(Gauge(name, help, labelnames))
+
+def callback_counter(name, help, labelnames=()):
+    return REGISTRY.register(CallbackCounter(name, help, labelnames))
+
+def histogram(name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+    return REGISTRY.register(Histogram(name, help, labelnames, buckets))
+
+def render():
+    return REGISTRY.render()
+
+
+# --- Standalone Exporter ---
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_http_server(port, host='0.0.0.0'):
+    """Serve /metrics on a daemon thread, for processes without a web app (master.py)."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    return server
+
+
+# --- Shared Metrics ---
+# Defined here so every module that records them agrees on names and labels.
+READ_LATENCY = histogram('modbus_read_latency_seconds', 'Time to read one device scan', ['device'])
+READ_TIMEOUTS = counter('modbus_read_timeouts_total', 'Device scans that timed out', ['device'])
+READ_ERRORS = counter('modbus_read_errors_total', 'Device scans that failed with an error', ['device'])
+MISSED_CYCLES = counter('modbus_missed_cycles_total', 'Poll cycles skipped because a scan overran or could not start in time', ['device'])
+SAMPLES_SUPPRESSED = counter('samples_suppressed_total', 'Samples within every deadband, neither stored nor pushed', ['device'])
+
+FETCH_CYCLE = histogram('live_fetch_cycle_seconds', 'Duration of one background_fetch cycle')
+FETCH_OVERRUNS = counter('live_fetch_overruns_total', 'background_fetch cycles that took longer than the period')
+FETCH_ERRORS = counter('live_fetch_errors_total', 'background_fetch cycles that raised an unexpected exception')
+
+DB_BATCH_ROWS = histogram('db_batch_rows', 'Rows per committed insert batch', buckets=SIZE_BUCKETS)
+DB_BATCH_SECONDS = histogram('db_batch_seconds', 'Time to write and commit one insert batch')
+DB_ROWS = counter('db_rows_written_total', 'Rows committed by the batched writer')
+DB_DROPPED = counter('db_rows_dropped_total', 'Rows dropped because the writer queue or spool stayed full, or the row was rejected')
+DB_QUEUE_DEPTH = gauge('db_queue_depth', 'Rows waiting in the writer queue or spool', ['database'])
+DB_BATCH_ERRORS = counter('db_batch_errors_total', 'Insert batches the database refused')
+DB_SPOOL_BYTES = gauge('db_spool_bytes', 'Bytes in the store-and-forward spool not yet in the database', ['database'])
+DB_SPOOL_LAG = gauge('db_spool_replay_lag_seconds', 'Age of the oldest spooled row not yet in the database', ['database'])
+
+ALARM_EVAL_SECONDS = histogram('alarm_eval_seconds', 'Time to evaluate every alarm rule against one sample', ['device'],
+                               buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1))
+ALARM_EVENTS = counter('alarm_events_total', 'Alarm state changes and edge events', ['device', 'state'])
+ALARMS_ACTIVE = gauge('alarms_active', 'Alarms active now', ['device'])
+
+WRITE_FRAMES = counter('modbus_write_frames_total', 'Write requests sent to devices', ['device', 'function'])
+WRITE_POINTS = counter('modbus_write_points_total', 'Coils and registers submitted for writing', ['device'])
+WRITE_COALESCED = counter('modbus_write_coalesced_total', 'Submitted points overwritten by a later write before they went out', ['device'])
+WRITE_ERRORS = counter('modbus_write_errors_total', 'Write requests that failed', ['device'])
+WRITE_LATENCY = histogram('modbus_write_latency_seconds', 'Time from submitting a write to its completion', ['device'])
+WRITE_QUEUE_DEPTH = gauge('modbus_write_queue_depth', 'Points waiting in the write queue', ['device'])
+
+SOCKETIO_EMITS = counter('socketio_emits_total', 'Socket.IO messages emitted', ['event'])
+SOCKETIO_BYTES = counter('socketio_emit_bytes_total', 'Payload bytes emitted over Socket.IO', ['event'])
@@ -0,0 +1,103 @@
+"""
+Convert the wide holding_registers/coil_status tables of an existing
+modbus_data.db into the packed 'samples' table used by storage.py.
+
+    python migrate_db.py modbus_data.db --device plc-1 --drop-old
+"""
+import argparse
+import os
+import sqlite3
+from datetime import datetime
+from storage import SAMPLE_INSERT_SQL, initialize_schema, sample_row
+
+# --- Configuration ---
+DEFAULT_DEVICE = 'plc-1'
+MERGE_WINDOW_MS = 500   # Register and input rows closer than this become one sample
+BATCH_SIZE = 5000
+
+
+def _legacy_columns(conn, table, prefix):
+    """Return the point columns of a legacy table, ordered by point index."""
+    columns = [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+    points = [c for c in columns if c.startswith(prefix)]
+    return sorted(points, key=lambda c: int(c[len(prefix):]))
+
+def _legacy_rows(conn, table, prefix):
+    """Yield (ts_ms, values) from a legacy wide table in time order."""
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                          (table,)).fetchone()
+    if not exists:
+        return
+    columns = _legacy_columns(conn, table, prefix)
+    cursor = conn.execute(f"SELECT timestamp, {', '.join(columns)} FROM {table} ORDER BY timestamp")
+    for row in cursor:
+        # Stored as 'YYYY-MM-DD HH:MM:SS[.ffffff]' local time by both app.py and master.py
+        ts = int(datetime.fromisoformat(str(row[0])).timestamp() * 1000)
+        yield ts, [0 if value is None else value for value in row[1:]]
+
+def _merged_samples(registers, inputs):
+    """Pair register and input rows taken within MERGE_WINDOW_MS of each other."""
+    reg = next(registers, None)
+    inp = next(inputs, None)
+    while reg is not None or inp is not None:
+        if inp is None or (reg is not None and reg[0] < inp[0] - MERGE_WINDOW_MS):
+            yield reg[0], reg[1], None
+            reg = next(registers, None)
+        elif reg is None or inp[0] < reg[0] - MERGE_WINDOW_MS:
+            yield inp[0], None, inp[1]
+            inp = next(inputs, None)
+        else:
+            yield min(reg[0], inp[0]), reg[1], inp[1]
+            reg = next(registers, None)
+            inp = next(inputs, None)
+
+def migrate(database, device=DEFAULT_DEVICE, drop_old=False):
+    """Copy legacy rows into 'samples'. Returns the number of samples written."""
+    read_conn = sqlite3.connect(database)
+    conn = sqlite3.connect(database)
+    initialize_schema(conn)
+    conn.execute('INSERT OR IGNORE INTO devices (name) VALUES (?)', (device,))
+    device_id = conn.execute('SELECT id FROM devices WHERE name = ?', (device,)).fetchone()[0]
+
+    written = 0
+    batch = []
+    samples = _merged_samples(_legacy_rows(read_conn, 'holding_registers', 'register_'),
+                              _legacy_rows(read_conn, 'coil_status', 'coil_'))
+    for ts, registers, inputs in samples:
+        batch.append(sample_row(device_id, registers, inputs, ts))
+        if len(batch) >= BATCH_SIZE:
+            with conn:
+                conn.executemany(SAMPLE_INSERT_SQL, batch)
+            written += len(batch)
+            batch = []
+    if batch:
+        with conn:
+            conn.executemany(SAMPLE_INSERT_SQL, batch)
+        written += len(batch)
+    read_conn.close()
+
+    if drop_old:
+        with conn:
+            conn.execute('DROP TABLE IF EXISTS holding_registers')
+            conn.execute('DROP TABLE IF EXISTS coil_status')
+        # Give the freed pages back to the filesystem
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        conn.execute('VACUUM')
+    conn.close()
+    return written
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('database', nargs='?', default='modbus_data.db')
+    parser.add_argument('--device', default=DEFAULT_DEVICE, help='device name to file the rows under')
+    parser.add_argument('--drop-old', action='store_true', help='drop the wide tables and VACUUM afterwards')
+    args = parser.parse_args()
+
+    size_before = os.path.getsize(args.database)
+    written = migrate(args.database, args.device, args.drop_old)
+    size_after = os.path.getsize(args.database)
+    print(f"Migrated {written} samples for device '{args.device}'.")
+    print(f"Database size: {size_before / 1024:.0f} KiB -> {size_after / 1024:.0f} KiB")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from pymodbus.client import ModbusTcpClient
+from pymodbus.exceptions import ConnectionException, ModbusIOException
+import metrics
+
+# --- Configuration ---
+CONNECTION_TIMEOUT = 3          # Seconds to wait for connect/response
+IDLE_TIMEOUT = 60.0             # Close connections unused for this long (seconds)
+EVICTION_INTERVAL = 5.0         # How often idle connections are swept (seconds)
+RECONNECT_BACKOFF_INITIAL = 0.5 # First delay after a failed connect (seconds)
+RECONNECT_BACKOFF_MAX = 30.0    # Upper bound for the reconnect delay (seconds)
+
+logger = logging.getLogger(__name__)
+
+
+class PooledConnection:
+    """A persistent client for one (host, port, unit id) plus its reconnect state."""
+
+    def __init__(self, host, port, slave, timeout):
+        self.key = (host, port, slave)
+        self.client = ModbusTcpClient(host, port=port, timeout=timeout)
+        self.lock = threading.Lock()  # pymodbus sync clients are not thread-safe
+        self.last_used = time.monotonic()
+        self.has_connected = False
+        self.backoff = 0.0
+        self.next_attempt = 0.0
+
+
+class ModbusConnectionPool:
+    """
+    Keeps Modbus TCP sockets open between polls instead of connecting per read.
+    Connections are keyed by (host, port, unit id), reconnected with
+    exponential backoff and closed after IDLE_TIMEOUT. The checkout health
+    check is only is_socket_open(): a peer that went away without closing the
+    socket shows up as the next request failing, which drops the socket so
+    the checkout after it reconnects.
+    """
+
+    def __init__(self, timeout=CONNECTION_TIMEOUT, idle_timeout=IDLE_TIMEOUT):
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self._connections = {}
+        self._lock = threading.Lock()
+        self._last_eviction = time.monotonic()
+        self._stats = {'hits': 0, 'misses': 0, 'reconnects': 0,
+                       'connect_failures': 0, 'evictions': 0}
+
+    def _get_entry(self, host, port, slave):
+        key = (host, port, slave)
+        with self._lock:
+            entry = self._connections.get(key)
+            if entry is None:
+                entry = PooledConnection(host, port, slave, self.timeout)
+                self._connections[key] = entry
+            return entry
+
+    def _checkout(self, host, port, slave):
+        """Return the pooled entry for (host, port, slave) with its lock held."""
+        while True:
+            entry = self._get_entry(host, port, slave)
+            entry.lock.acquire()
+            with self._lock:
+                # evict_idle may have closed and dropped the entry before its lock was taken
+                if self._connections.get(entry.key) is entry:
+                    return entry
+            entry.lock.release()
+
+    def _count(self, key):
+        # Checkouts of different entries run concurrently
+        with self._lock:
+            self._stats[key] += 1
+
+    def _ensure_connected(self, entry):
+        """Return True if the entry's socket is usable, reconnecting if allowed."""
+        if entry.client.is_socket_open():
+            self._count('hits')
+            return True
+
+        self._count('misses')
+        now = time.monotonic()
+        if now < entry.next_attempt:
+            # Still backing off from the last failure; don't hammer the device
+            return False
+
+        if entry.has_connected:
+            self._count('reconnects')
+            logger.info(f"Reconnecting to Modbus device {entry.key}")
+
+        if entry.client.connect():
+            entry.has_connected = True
+            entry.backoff = 0.0
+            entry.next_attempt = 0.0
+            return True
+
+        self._count('connect_failures')
+        entry.backoff = min(RECONNECT_BACKOFF_MAX,
+                            max(RECONNECT_BACKOFF_INITIAL, entry.backoff * 2))
+        entry.next_attempt = now + entry.backoff
+        logger.warning(f"Connection to {entry.key} failed, retrying in {entry.backoff:.1f}s")
+        return False
+
+    @contextmanager
+    def connection(self, host, port, slave):
+        """
+        Check out the connection for (host, port, slave).
+        Yields a connected ModbusTcpClient, or None if the device is unreachable.
+        """
+        self.evict_idle()
+        entry = self._checkout(host, port, slave)
+        try:
+            client = entry.client if self._ensure_connected(entry) else None
+            yield client
+        except (ConnectionException, ModbusIOException):
+            # Drop the broken (or timed out, possibly half-open) socket so the next checkout
+            # reconnects instead of reading a stale response off it
+            entry.client.close()
+            raise
+        finally:
+            entry.last_used = time.monotonic()
+            entry.lock.release()
+
+    def evict_idle(self, force=False):
+        """Close connections that have not been used within idle_timeout."""
+        now = time.monotonic()
+        if not force and now - self._last_eviction < EVICTION_INTERVAL:
+            return
+        self._last_eviction = now
+
+        with self._lock:
+            idle = [key for key, entry in self._connections.items()
+                    if now - entry.last_used > self.idle_timeout]
+            for key in idle:
+                entry = self._connections[key]
+                # Skip connections that are checked out right now
+                if not entry.lock.acquire(blocking=False):
+                    continue
+                try:
+                    entry.client.close()
+                    del self._connections[key]
+                    self._stats['evictions'] += 1
+                finally:
+                    entry.lock.release()
+
+    def stats(self):
+        """Return a snapshot of pool counters."""
+        with self._lock:
+            open_count = sum(1 for entry in self._connections.values()
+                             if entry.client.is_socket_open())
+            snapshot = dict(self._stats)
+            snapshot['pooled'] = len(self._connections)
+            snapshot['open'] = open_count
+        return snapshot
+
+    def close_all(self):
+        """Close every pooled connection."""
+        with self._lock:
+            for entry in self._connections.values():
+                entry.client.close()
+            self._connections.clear()
+
+
+# --- Shared Pool ---
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """Return the process-wide connection pool shared by app, main, writes and client."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ModbusConnectionPool()
+            _register_pool_metrics(_pool)
+        return _pool
+
+def _register_pool_metrics(pool):
+    """Expose the pool's own counters at scrape time; nothing is added to checkout."""
+    for key in ('hits', 'misses', 'reconnects', 'connect_failures', 'evictions'):
+        metrics.callback_counter(f'modbus_pool_{key}_total', f'Connection pool {key.replace("_", " ")}') \
+            .set_function(lambda key=key: pool._stats[key])
+    metrics.gauge('modbus_pool_open_connections', 'Pooled Modbus sockets currently open') \
+        .set_function(lambda: pool.stats()['open'])
@@ -0,0 +1,274 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from pymodbus.client import AsyncModbusTcpClient
+from pymodbus.exceptions import ModbusException
+from modbus_pool import RECONNECT_BACKOFF_INITIAL, RECONNECT_BACKOFF_MAX
+from mbap import MbapClient
+import metrics
+from read_plan import Tag, build_read_plan, execute_read_plan_async, execute_read_plan_pipelined, update_block
+from scheduler import DEFAULT_POLICY, SCAN_CLASSES, ScanTimer, stagger
+from tag_decoder import TagDecoder, output_layout, to_dict
+
+# --- Configuration ---
+MAX_CONCURRENCY = 50      # Maximum number of devices being read at the same time
+REQUEST_TIMEOUT = 2.0     # Upper bound for one device's read cycle (seconds)
+DEFAULT_INTERVAL = 1.0    # Default cycle time per device (seconds)
+DEADLINE_MARGIN = 0.9     # Fraction of the time left in a cycle a read may use
+
+logger = logging.getLogger(__name__)
+
+
+class Device:
+    """
+    A Modbus TCP slave to poll and the blocks to read from it.
+    Tags are grouped by scan class and each group gets its own read plan,
+    built once when the device is configured. Tags without a scan class
+    are read every interval seconds.
+
+    pipeline > 1 sends up to that many requests of a scan at once over a raw
+    MBAP connection (see mbap.MbapClient), which falls back to one at a time
+    by itself if the device turns out not to support it.
+    """
+
+    def __init__(self, name, host, port=502, slave=1, interval=DEFAULT_INTERVAL,
+                 reg_start=0, reg_count=20, input_start=0, input_count=20, tags=None,
+                 scan_classes=None, policy=DEFAULT_POLICY, pipeline=1):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.slave = slave
+        self.interval = interval
+        self.reg_start = reg_start
+        self.reg_count = reg_count
+        self.input_start = input_start
+        self.input_count = input_count
+        if tags is None:
+            tags = ([Tag(f'register_{i}', 3, reg_start + i) for i in range(reg_count)] +
+                    [Tag(f'input_{i}', 2, input_start + i) for i in range(input_count)])
+        self.tags = list(tags)
+        self.tag_index = {tag.name: i for i, tag in enumerate(self.tags)}
+        self.layout = output_layout(self.tags)
+        self.scan_classes = dict(SCAN_CLASSES if scan_classes is None else scan_classes)
+        self.policy = policy
+        self.pipeline = pipeline
+        self.scan_groups = self._group_tags()
+
+    def _group_tags(self):
+        """[(scan class name, interval, read plan)] for every scan class the tags use."""
+        groups = {}
+        for tag in self.tags:
+            groups.setdefault(tag.scan_class, []).append(tag)
+        scan_groups = []
+        for name, tags in groups.items():
+            if name is None:
+                scan_groups.append(('device', self.interval, build_read_plan(tags)))
+            elif name in self.scan_classes:
+                scan_groups.append((name, self.scan_classes[name], build_read_plan(tags)))
+            else:
+                raise ValueError(f"{self!r}: unknown scan class {name!r} on tag {tags[0].name!r}")
+        return scan_groups
+
+    def __repr__(self):
+        return f"Device({self.name!r}, {self.host}:{self.port}, slave={self.slave})"
+
+
+class DeviceStats:
+    """Per-device counters kept by the poller, with jitter/overrun stats per scan class."""
+
+    def __init__(self):
+        self.polls = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.last_latency = None
+        self.scans = {}  # scan class name -> scheduler.ScanStats
+
+    @property
+    def missed_cycles(self):
+        return sum(scan.missed_cycles for scan in self.scans.values())
+
+
+class _DeviceState:
+    """Connection and last known values of one device, shared by its scan loops."""
+
+    def __init__(self, device, timeout):
+        if device.pipeline > 1:
+            self.client = MbapClient(device.host, device.port, timeout, max_in_flight=device.pipeline)
+            self.execute = execute_read_plan_pipelined
+        else:
+            self.client = AsyncModbusTcpClient(device.host, port=device.port, timeout=timeout, retries=0)
+            self.execute = execute_read_plan_async
+        self.lock = asyncio.Lock()  # one request at a time per device, across scan classes
+        self.backoff = 0.0
+        self.next_connect = 0.0
+        self.registers = [None] * device.reg_count
+        self.inputs = [None] * device.input_count
+        # Engineering value of every device tag, in device.tags order, as last read
+        self.tag_values = np.full(len(device.tags), np.nan)
+        self.tag_valid = np.zeros(len(device.tags), dtype=bool)
+
+
+class AsyncPoller:
+    """
+    Polls many devices concurrently on pymodbus's asyncio client.
+
+    Every (device, scan class) pair runs its own loop on a scheduler.ScanTimer,
+    so a slow or timed-out read never shifts the schedule of that loop or any
+    other, and loops sharing an interval are phase-staggered across it.
+    A semaphore caps how many reads are in flight at once.
+    Samples are handed to on_sample(device, data) on a single worker thread,
+    keeping blocking storage code off the event loop and in order. A sample
+    carries the device's full register/input image and the decoded value of
+    every tag ('tag_values', aligned with device.tags, NaN until first read;
+    'values', by name), with the points of slower scan classes as last read.
+    """
+
+    def __init__(self, devices, on_sample, max_concurrency=MAX_CONCURRENCY,
+                 timeout=REQUEST_TIMEOUT):
+        self.devices = list(devices)
+        self.on_sample = on_sample
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.stats = {device.name: DeviceStats() for device in self.devices}
+        self._sink = ThreadPoolExecutor(max_workers=1, thread_name_prefix='poller-sink')
+        self._semaphore = None
+        self._stop = None
+
+    async def run(self):
+        """Poll all devices until stop() is called."""
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._stop = asyncio.Event()
+        loops = [(device, group) for device in self.devices for group in device.scan_groups]
+        # Stagger first scans across one period so loops don't fire in lockstep
+        offsets = stagger([interval for _, (_, interval, _) in loops])
+        states = {device.name: _DeviceState(device, self.timeout) for device in self.devices}
+        tasks = [
+            asyncio.create_task(self._scan_loop(device, states[device.name], group, offset))
+            for (device, group), offset in zip(loops, offsets)
+        ]
+        try:
+            await self._stop.wait()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for state in states.values():
+                state.client.close()
+            self._sink.shutdown(wait=True)
+
+    def stop(self):
+        """Ask run() to finish; safe to call from the event loop thread."""
+        if self._stop is not None:
+            self._stop.set()
+
+    async def _scan_loop(self, device, state, group, offset):
+        loop = asyncio.get_running_loop()
+        name, interval, plan = group
+        stats = self.stats[device.name]
+        timer = ScanTimer(interval, phase=offset, policy=device.policy, name=name, clock=loop.time)
+        decoder = TagDecoder.for_plan(plan)
+        positions = np.array([device.tag_index[tag.name] for tag in decoder.tags], dtype=np.intp)
+        stats.scans[name] = timer.stats
+        # Metric children are looked up once so each update is a single locked add
+        latency_metric = metrics.READ_LATENCY.labels(device.name)
+        timeout_metric = metrics.READ_TIMEOUTS.labels(device.name)
+        error_metric = metrics.READ_ERRORS.labels(device.name)
+        missed_metric = metrics.MISSED_CYCLES.labels(device.name)
+
+        while True:
+            delay = timer.due_in()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            timer.begin()
+
+            data = {'registers': None, 'inputs': None, 'scan_class': name}
+            if state.client.connected or loop.time() >= state.next_connect:
+                started = loop.time()
+                # Never let one cycle's work run into the next deadline
+                budget = min(self.timeout, (timer.deadline + interval - started) * DEADLINE_MARGIN)
+                talking = []  # set once this scan owns the connection
+                try:
+                    if not state.client.connected:
+                        # Connecting can take longer than a fast scan's budget; give it the
+                        # full timeout and let the timer account for the overrun
+                        await asyncio.wait_for(self._connect(state, device, talking), self.timeout)
+                        budget = self.timeout
+                    results = await asyncio.wait_for(self._poll_once(state, device, plan, talking), budget)
+                    data = self._merge(device, state, results, name, decoder, positions)
+                    stats.last_latency = data['latency'] = loop.time() - started
+                    latency_metric.observe(data['latency'])
+                    state.backoff = 0.0
+                except (asyncio.TimeoutError, ModbusException, OSError) as e:
+                    if not talking:
+                        # Queued for the whole budget behind MAX_CONCURRENCY other reads or another
+                        # scan class of this device; the connection is fine, the cycle is missed
+                        timer.miss()
+                        missed_metric.inc()
+                        logger.warning(f"{device!r} {name} scan could not start within {budget:.2f}s "
+                                       f"(device busy or {self.max_concurrency} reads already in flight)")
+                        data = None
+                    else:
+                        if isinstance(e, asyncio.TimeoutError):
+                            stats.timeouts += 1
+                            timeout_metric.inc()
+                            logger.warning(f"{device!r} {name} scan timed out after {budget:.2f}s")
+                        else:
+                            stats.errors += 1
+                            error_metric.inc()
+                            logger.warning(f"{device!r} {name} scan failed: {e}")
+                        state.client.close()
+                        state.backoff = min(RECONNECT_BACKOFF_MAX, max(RECONNECT_BACKOFF_INITIAL, state.backoff * 2))
+                        state.next_connect = loop.time() + state.backoff
+            if data is not None:
+                stats.polls += 1
+                self._sink.submit(self._deliver, device, data)
+
+            # Cycles that were overrun are skipped or coalesced per the device's policy, never queued
+            missed = timer.stats.missed_cycles
+            timer.end()
+            if timer.stats.missed_cycles > missed:
+                missed_metric.inc(timer.stats.missed_cycles - missed)
+
+    async def _connect(self, state, device, talking):
+        """Open the device's shared connection unless another scan class already has."""
+        async with state.lock:
+            talking.append(True)
+            if not state.client.connected and not await state.client.connect():
+                raise ModbusException(f"Connection to {device.host}:{device.port} failed")
+
+    async def _poll_once(self, state, device, plan, talking):
+        """Run one scan class's read plan on the device's shared connection."""
+        async with self._semaphore, state.lock:
+            talking.append(True)
+            if not state.client.connected:
+                raise ModbusException(f"Connection to {device.host}:{device.port} was lost")
+            results = await state.execute(state.client, plan, device.slave)
+
+        for request, values in results:
+            if values is None:
+                logger.warning(f"{device!r} Modbus error or short response for {request}")
+        return results
+
+    @staticmethod
+    def _merge(device, state, results, name, decoder, positions):
+        """Fold one scan's results into the device image and return the sample to deliver."""
+        update_block(state.registers, results, 3, device.reg_start)
+        update_block(state.inputs, results, 2, device.input_start)
+        values, valid = decoder.decode_results(results)
+        state.tag_values[positions[valid]] = values[valid]
+        state.tag_valid[positions[valid]] = True
+        return {
+            # Blocks are only delivered once every point in them has been read
+            'registers': list(state.registers) if device.reg_count and None not in state.registers else None,
+            'inputs': list(state.inputs) if device.input_count and None not in state.inputs else None,
+            'tag_values': state.tag_values.copy(),
+            'values': to_dict(device.layout, state.tag_values, state.tag_valid),
+            'scan_class': name,
+        }
+
+    def _deliver(self, device, data):
+        try:
+            self.on_sample(device, data)
+        except Exception as e:
+            logger.error(f"Sample handler failed for {device!r}: {e}")
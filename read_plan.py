@@ -0,0 +1,289 @@
+import asyncio
+import logging
+import struct
+from pymodbus.exceptions import ModbusException
+from mbap import decode_read_response, read_request_pdu
+
+logger = logging.getLogger(__name__)
+
+# --- Protocol Limits (Modbus Application Protocol v1.1b3) ---
+MAX_REGISTERS_PER_READ = 125   # FC03 / FC04
+MAX_BITS_PER_READ = 2000       # FC01 / FC02
+
+# --- Planner Defaults ---
+MAX_REGISTER_GAP = 8   # Unused registers worth reading to avoid an extra request
+MAX_BIT_GAP = 64       # Unused bits worth reading to avoid an extra request
+
+BIT_FUNCTIONS = (1, 2)       # Read Coils, Read Discrete Inputs
+REGISTER_FUNCTIONS = (3, 4)  # Read Holding Registers, Read Input Registers
+
+# Width in registers and big-endian struct format for each register type
+REGISTER_TYPES = {
+    'uint16': (1, '>H'),
+    'int16': (1, '>h'),
+    'uint32': (2, '>I'),
+    'int32': (2, '>i'),
+    'float32': (2, '>f'),
+    'uint64': (4, '>Q'),
+    'int64': (4, '>q'),
+    'float64': (4, '>d'),
+}
+
+
+BYTE_ORDERS = ('big', 'little')
+
+
+class Tag:
+    """
+    A named point: function code, 0-based start address and data type.
+    scan_class names the rate it is polled at (see scheduler.SCAN_CLASSES);
+    None means the device's own interval.
+
+    Register tags can also describe how to get the engineering value:
+    byte_order is the order of the two bytes inside each register and
+    word_order the order of the registers of a 32/64-bit value ('big' is the
+    Modbus convention, ABCD; word_order='little' is the common word-swapped
+    CDAB layout). bits picks a bitfield out of an integer value, either one
+    bit index (the tag is then a bool) or (first bit, bit count). The result
+    is value * scale + offset.
+    """
+
+    def __init__(self, name, function_code, address, type=None, scan_class=None,
+                 byte_order='big', word_order='big', scale=1.0, offset=0.0, bits=None):
+        if function_code in BIT_FUNCTIONS:
+            type = type or 'bool'
+            if type != 'bool':
+                raise ValueError(f"Tag {name!r}: FC{function_code:02d} only supports 'bool', got {type!r}")
+            if bits is not None or scale != 1.0 or offset != 0.0:
+                raise ValueError(f"Tag {name!r}: bits, scale and offset only apply to register tags")
+        elif function_code in REGISTER_FUNCTIONS:
+            type = type or 'uint16'
+            if type not in REGISTER_TYPES:
+                raise ValueError(f"Tag {name!r}: unknown register type {type!r}")
+        else:
+            raise ValueError(f"Tag {name!r}: unsupported function code {function_code}")
+        if address < 0:
+            raise ValueError(f"Tag {name!r}: address must be >= 0")
+        if byte_order not in BYTE_ORDERS or word_order not in BYTE_ORDERS:
+            raise ValueError(f"Tag {name!r}: byte and word order must be one of {BYTE_ORDERS}")
+        if bits is not None:
+            if type.startswith('float'):
+                raise ValueError(f"Tag {name!r}: bitfields need an integer type, got {type!r}")
+            first, count = (bits, 1) if isinstance(bits, int) else bits
+            if first < 0 or count < 1 or first + count > 16 * REGISTER_TYPES[type][0]:
+                raise ValueError(f"Tag {name!r}: bitfield {bits!r} does not fit in {type}")
+
+        self.name = name
+        self.function_code = function_code
+        self.address = address
+        self.type = type
+        self.scan_class = scan_class
+        self.byte_order = byte_order
+        self.word_order = word_order
+        self.scale = scale
+        self.offset = offset
+        self.bits = bits
+
+    @property
+    def width(self):
+        """Number of registers (or bits) the tag occupies."""
+        return 1 if self.type == 'bool' else REGISTER_TYPES[self.type][0]
+
+    @property
+    def kind(self):
+        """Python type of the decoded value: 'bool', 'int' or 'float'."""
+        if self.type == 'bool' or isinstance(self.bits, int):
+            return 'bool'
+        if self.type.startswith('float') or self.scale != 1.0 or self.offset != 0.0:
+            return 'float'
+        return 'int'
+
+    @property
+    def raw(self):
+        """True if the value is just the point as read, already in the register/input blocks."""
+        return (self.type in ('bool', 'uint16') and self.byte_order == 'big' and self.bits is None
+                and self.scale == 1.0 and self.offset == 0.0)
+
+    def __repr__(self):
+        return f"Tag({self.name!r}, FC{self.function_code:02d}, {self.address}, {self.type!r})"
+
+
+class ReadRequest:
+    """One Modbus read covering a contiguous address range and the tags inside it."""
+
+    def __init__(self, function_code, address, count, tags):
+        self.function_code = function_code
+        self.address = address
+        self.count = count
+        self.tags = tags
+
+    def __repr__(self):
+        return (f"ReadRequest(FC{self.function_code:02d}, address={self.address}, "
+                f"count={self.count}, tags={len(self.tags)})")
+
+
+def build_read_plan(tags, max_register_gap=MAX_REGISTER_GAP, max_bit_gap=MAX_BIT_GAP):
+    """
+    Merge tags into the fewest reads per function code.
+
+    Tags are sorted by address and greedily packed into one request while the
+    hole before the next tag is at most the gap tolerance and the request stays
+    within the protocol limit. Build the plan once and reuse it every scan.
+    """
+    names = set()
+    by_function = {}
+    for tag in tags:
+        if tag.name in names:
+            raise ValueError(f"Duplicate tag name {tag.name!r}")
+        names.add(tag.name)
+        by_function.setdefault(tag.function_code, []).append(tag)
+
+    plan = []
+    for function_code in sorted(by_function):
+        if function_code in BIT_FUNCTIONS:
+            limit, max_gap = MAX_BITS_PER_READ, max_bit_gap
+        else:
+            limit, max_gap = MAX_REGISTERS_PER_READ, max_register_gap
+
+        start = end = None
+        members = []
+        for tag in sorted(by_function[function_code], key=lambda t: t.address):
+            tag_end = tag.address + tag.width
+            if members and tag.address - end <= max_gap and max(end, tag_end) - start <= limit:
+                end = max(end, tag_end)
+                members.append(tag)
+                continue
+            if members:
+                plan.append(ReadRequest(function_code, start, end - start, members))
+            start, end, members = tag.address, tag_end, [tag]
+        if members:
+            plan.append(ReadRequest(function_code, start, end - start, members))
+    return plan
+
+
+def describe_plan(plan):
+    """Human readable summary of a read plan."""
+    return '\n'.join(repr(request) for request in plan)
+
+
+# --- Executing a Plan ---
+def issue_read(client, request, slave):
+    """Send the pymodbus call for request; returns a response (or awaitable for async clients)."""
+    kwargs = {'address': request.address, 'count': request.count, 'slave': slave}
+    if request.function_code == 1:
+        return client.read_coils(**kwargs)
+    if request.function_code == 2:
+        return client.read_discrete_inputs(**kwargs)
+    if request.function_code == 3:
+        return client.read_holding_registers(**kwargs)
+    return client.read_input_registers(**kwargs)
+
+def response_values(request, response):
+    """Return the raw bits/registers of a response, or None if it is unusable."""
+    if response.isError():
+        return None
+    if request.function_code in BIT_FUNCTIONS:
+        values = getattr(response, 'bits', None)
+    else:
+        values = getattr(response, 'registers', None)
+    if values is None or len(values) < request.count:
+        return None
+    return values[:request.count]
+
+def execute_read_plan(client, plan, slave):
+    """
+    Run every request of plan on a connected sync client.
+    Returns a list of (request, values) where values is None for failed reads.
+    """
+    results = []
+    for request in plan:
+        try:
+            values = response_values(request, issue_read(client, request, slave))
+        except ModbusException as e:
+            logger.warning(f"Modbus exception during {request}: {e}")
+            values = None
+        results.append((request, values))
+    return results
+
+async def execute_read_plan_async(client, plan, slave):
+    """Same as execute_read_plan for pymodbus's asyncio clients."""
+    results = []
+    for request in plan:
+        values = response_values(request, await issue_read(client, request, slave))
+        results.append((request, values))
+    return results
+
+async def execute_read_plan_pipelined(client, plan, slave):
+    """
+    Same as execute_read_plan_async for an mbap.MbapClient. All requests are
+    handed to the client at once; it keeps as many on the wire as the device
+    allows, so on a high-latency link the scan takes about one round trip
+    instead of one per request.
+    """
+    responses = await asyncio.gather(
+        *(client.request(slave, read_request_pdu(request.function_code, request.address, request.count))
+          for request in plan),
+        return_exceptions=True)
+    for response in responses:
+        if isinstance(response, BaseException):
+            raise response
+    return [(request, decode_read_response(request.function_code, request.count, response))
+            for request, response in zip(plan, responses)]
+
+
+# --- Extracting Values ---
+def decode_tag(tag, words):
+    """
+    Decode one tag from its raw words. Reference implementation of the rules
+    tag_decoder.TagDecoder applies to whole scans at once.
+    """
+    if tag.type == 'bool':
+        return bool(words[0])
+    width, fmt = REGISTER_TYPES[tag.type]
+    if tag.raw:
+        return words[0]
+    words = list(words)
+    if tag.word_order == 'little':
+        words.reverse()
+    value = struct.unpack(fmt, struct.pack(('>' if tag.byte_order == 'big' else '<') + f'{width}H', *words))[0]
+    if tag.bits is not None:
+        first, count = (tag.bits, 1) if isinstance(tag.bits, int) else tag.bits
+        value = (value >> first) & ((1 << count) - 1)
+    if tag.kind == 'bool':
+        return bool(value)
+    if tag.kind == 'float':
+        return float(value * tag.scale + tag.offset)
+    return value
+
+def tag_values(results):
+    """Map tag name -> decoded value for every tag whose read succeeded."""
+    values = {}
+    for request, raw in results:
+        if raw is None:
+            continue
+        for tag in request.tags:
+            offset = tag.address - request.address
+            values[tag.name] = decode_tag(tag, raw[offset:offset + tag.width])
+    return values
+
+def update_block(block, results, function_code, address):
+    """Copy whatever plan results overlap [address, address + len(block)) into block, in place."""
+    count = len(block)
+    for request, raw in results:
+        if raw is None or request.function_code != function_code:
+            continue
+        lo = max(address, request.address)
+        hi = min(address + count, request.address + request.count)
+        if lo < hi:
+            block[lo - address:hi - address] = raw[lo - request.address:hi - request.address]
+    return block
+
+def read_block(results, function_code, address, count):
+    """
+    Reassemble the raw values for [address, address + count) from plan results.
+    Returns None if any part of the range was not read successfully.
+    """
+    block = update_block([None] * count, results, function_code, address)
+    if any(value is None for value in block):
+        return None
+    return block
@@ -0,0 +1,243 @@
+"""
+Replay recorded samples through app.py's live push and storage path.
+
+    python replay.py --start 2024-05-01T08:00 --end 2024-05-01T09:00 --speed 10
+    python replay.py --start 2024-05-01 --speed 0 --headless --store-to /tmp/replayed.db
+
+Samples of one device are read from the packed samples table of --database
+a chunk at a time as playback reaches them. They are handed to
+app.publish_sample with their recorded timestamps, so alarms, deadbands and
+the live page behave as they did at the time, and Socket.IO clients of the
+dashboard see them as live frames. --speed 1 plays in real time, 10 ten
+times faster, and 0 as fast as the pipeline takes them. The achieved frames
+per second are reported while it runs, which measures how far push (and,
+with --store-to, storage) scales without a PLC.
+"""
+import sys
+if __name__ == '__main__' and '--headless' not in sys.argv[1:]:
+    # Serving the dashboard: patch in green threads before app, sqlite3 and the
+    # writer create any locks, threads or sockets
+    import eventlet
+    eventlet.monkey_patch()
+
+import argparse
+import sqlite3
+import time
+import history
+import metrics
+import storage
+from db_writer import configure_connection, close_writers
+
+# --- Configuration ---
+CHUNK_SIZE = 1000        # Samples fetched from SQLite at a time
+REPORT_INTERVAL = 5.0    # Seconds between progress reports
+MAX_GAP = 300.0          # Recorded gaps longer than this (outages) are skipped, in seconds
+SERVE_PORT = 5000
+
+REPLAY_FRAMES = metrics.counter('replay_frames_total', 'Recorded samples replayed')
+REPLAY_LAG = metrics.gauge('replay_lag_seconds', 'How far playback is behind its schedule')
+
+
+def recorded_samples(conn, device_id, start_ms=None, end_ms=None, chunk_size=CHUNK_SIZE):
+    """
+    Yield (ts_ms, registers, inputs) lists in time order, fetched lazily. A
+    block a sample did not store (None) repeats the previous sample's, so
+    every sample carries both once each block has been seen.
+    """
+    registers = inputs = None
+    for ts, register_view, input_blob, input_count in storage.iter_samples(conn, device_id, start_ms, end_ms,
+                                                                           chunk_size):
+        if register_view is not None:
+            registers = register_view.tolist()
+        if input_blob is not None:
+            inputs = storage.unpack_bits(input_blob, input_count)
+        if registers is not None and inputs is not None:
+            yield ts, registers, inputs
+
+
+class ReplayStats:
+    """Throughput and schedule accounting for one replay."""
+
+    def __init__(self):
+        self.frames = 0
+        self.started = None
+        self.elapsed = 0.0
+        self.recorded_seconds = 0.0  # span of recorded time played, gaps over MAX_GAP excluded
+        self.sink_seconds = 0.0
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.gaps_skipped = 0
+
+    @property
+    def fps(self):
+        return self.frames / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def speed(self):
+        """Recorded seconds played per wall-clock second."""
+        return self.recorded_seconds / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def max_fps(self):
+        """Frames per second the sink alone could take, i.e. the pipeline's ceiling."""
+        return self.frames / self.sink_seconds if self.sink_seconds else 0.0
+
+    def as_dict(self):
+        return {
+            'frames': self.frames, 'elapsed': round(self.elapsed, 3), 'fps': round(self.fps, 1),
+            'speed': round(self.speed, 2), 'max_fps': round(self.max_fps, 1),
+            'max_lag': round(self.max_lag, 3), 'gaps_skipped': self.gaps_skipped,
+        }
+
+
+class Replayer:
+    """
+    Plays (ts_ms, registers, inputs) samples into sink(timestamp, registers,
+    inputs) on a schedule of speed times their recorded spacing (speed 0 =
+    no waiting). Falls behind rather than dropping frames when the sink is
+    slower than the schedule; lag reports by how much.
+    """
+
+    def __init__(self, samples, sink, speed=1.0, max_gap=MAX_GAP, report_interval=REPORT_INTERVAL,
+                 clock=time.monotonic, sleep=time.sleep, report=print):
+        if speed < 0:
+            raise ValueError("speed must be >= 0")
+        self.samples = samples
+        self.sink = sink
+        self.speed = speed
+        self.max_gap = max_gap
+        self.report_interval = report_interval
+        self.clock = clock
+        self.sleep = sleep
+        self.report = report
+        self.stats = ReplayStats()
+        self._stopping = False
+
+    def stop(self):
+        self._stopping = True
+
+    def run(self):
+        stats = self.stats
+        clock = self.clock
+        started = stats.started = clock()
+        next_report = started + self.report_interval
+        try:
+            self._play(started, next_report)
+        finally:
+            stats.elapsed = clock() - started
+        return stats
+
+    def _play(self, started, next_report):
+        stats = self.stats
+        clock = self.clock
+        position = None  # recorded seconds since the first sample, gaps excluded
+        previous = None
+        for ts_ms, registers, inputs in self.samples:
+            if self._stopping:
+                break
+            timestamp = ts_ms / 1000
+            if previous is None:
+                position = 0.0
+            else:
+                step = timestamp - previous
+                if step > self.max_gap:
+                    stats.gaps_skipped += 1
+                    step = 0.0
+                position += step
+            previous = timestamp
+
+            if self.speed:
+                delay = started + position / self.speed - clock()
+                if delay > 0:
+                    self.sleep(delay)
+                stats.lag = max(0.0, -delay)
+                stats.max_lag = max(stats.max_lag, stats.lag)
+                REPLAY_LAG.set(stats.lag)
+
+            sink_started = clock()
+            self.sink(timestamp, registers, inputs)
+            now = clock()
+            stats.sink_seconds += now - sink_started
+            stats.frames += 1
+            stats.recorded_seconds = position
+            REPLAY_FRAMES.inc()
+            if now >= next_report:
+                stats.elapsed = now - started
+                self.report(self.summary())
+                next_report = now + self.report_interval
+
+    def summary(self):
+        stats = self.stats
+        return (f"Replayed {stats.frames} frames in {stats.elapsed:.1f}s: {stats.fps:.1f} fps, "
+                f"{stats.speed:.1f}x recorded time, pipeline ceiling {stats.max_fps:.0f} fps, "
+                f"lag {stats.lag:.2f}s (max {stats.max_lag:.2f}s), {stats.gaps_skipped} gaps skipped")
+
+
+def main():
+    # No abbreviations: --headless is looked for verbatim before anything is imported
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0], allow_abbrev=False)
+    parser.add_argument('--database', default='modbus_data.db', help='database to read recorded samples from')
+    parser.add_argument('--device', help='device to replay; app.py is configured for app.DEVICE_NAME only')
+    parser.add_argument('--start', help='unix seconds or ISO 8601 local time (default: first sample)')
+    parser.add_argument('--end', help='unix seconds or ISO 8601 local time (default: last sample)')
+    parser.add_argument('--speed', type=float, default=1.0, help='1 = real time, 10 = ten times faster, 0 = max')
+    parser.add_argument('--max-gap', type=float, default=MAX_GAP, help='skip recorded gaps longer than this (s)')
+    parser.add_argument('--store-to', metavar='DATABASE',
+                        help='also store replayed samples and alarm events here (not the source database)')
+    parser.add_argument('--headless', action='store_true', help='do not start the web server')
+    parser.add_argument('--port', type=int, default=SERVE_PORT)
+    args = parser.parse_args()
+
+    # app.py reads its configuration at import; set the source before anything starts
+    import app
+    app.LIVE_SOURCE = 'replay'
+    app.ROLLUP_ENABLED = False
+    # Tags, alarms, metrics and storage in app.py are all set up for DEVICE_NAME at import
+    device = args.device or app.DEVICE_NAME
+    if device != app.DEVICE_NAME:
+        parser.error(f'--device {device!r} differs from app.DEVICE_NAME {app.DEVICE_NAME!r}; '
+                     f'set DEVICE_NAME (and its tags) in app.py to replay another device')
+    if args.store_to:
+        if args.store_to == args.database:
+            parser.error('--store-to must differ from --database; replayed rows would overwrite the recording')
+        app.DATABASE = args.store_to
+        app.initialize_database()
+
+    conn = configure_connection(sqlite3.connect(args.database))
+    device_id = storage.find_device_id(conn, device)
+    if device_id is None:
+        parser.error(f'Unknown device {device!r} in {args.database}')
+    start_ms = None if args.start is None else history.parse_time_ms(args.start)
+    end_ms = None if args.end is None else history.parse_time_ms(args.end)
+
+    store = args.store_to is not None
+    replayer = Replayer(
+        recorded_samples(conn, device_id, start_ms, end_ms),
+        lambda timestamp, registers, inputs: app.publish_sample(registers, inputs, timestamp, store=store),
+        speed=args.speed, max_gap=args.max_gap,
+        sleep=time.sleep if args.headless else app.socketio.sleep)
+
+    def finish():
+        print(f"Replay finished. {replayer.summary()}")
+        if store:
+            close_writers()
+
+    if args.headless:
+        try:
+            replayer.run()
+        except KeyboardInterrupt:
+            replayer.stop()
+        finish()
+        conn.close()
+        return
+
+    def play():
+        replayer.run()
+        finish()
+
+    print(f"Replaying {device} at {args.speed or 'max'}x; open http://localhost:{args.port}/live_data")
+    app.socketio.start_background_task(play)
+    app.socketio.run(app.app, host='0.0.0.0', port=args.port)
+
+if __name__ == '__main__':
+    main()
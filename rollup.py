@@ -0,0 +1,375 @@
+import logging
+import sqlite3
+import threading
+import time
+import numpy as np
+from db_writer import configure_connection
+from history import blob_matrix, bit_matrix, raw_stat_chunks, reduce_stats, stats_from_values, take_columns
+from storage import timestamp_ms
+
+# --- Tiers ---
+MINUTE_MS = 60 * 1000
+HOUR_MS = 60 * MINUTE_MS
+DAY_MS = 24 * HOUR_MS
+
+# (name, bucket size, source). Each tier is built from the one before it,
+# the first from raw samples, so no tier ever rescans raw history.
+TIERS = (
+    ('1m', MINUTE_MS, 'raw'),
+    ('1h', HOUR_MS, '1m'),
+    ('1d', DAY_MS, '1h'),
+)
+
+# --- Configuration ---
+ROLLUP_INTERVAL = 30.0           # Seconds between rollup/retention passes
+ROLLUP_LAG_MS = 2 * MINUTE_MS    # A bucket is rolled up this long after it closes
+CATCH_UP_BUCKETS = {'1m': 60, '1h': 24, '1d': 31}  # Buckets written per transaction
+
+# How long each tier is kept (None = forever). Rows are only deleted once the
+# next tier up has rolled them up, whatever the retention says.
+RETENTION_MS = {
+    'raw': 7 * DAY_MS,
+    '1m': 90 * DAY_MS,
+    '1h': 2 * 365 * DAY_MS,
+    '1d': None,
+}
+RETENTION_BATCH = 2000           # Rows deleted per transaction
+RETENTION_PAUSE = 0.05           # Seconds between delete batches, lets the writer in
+
+logger = logging.getLogger(__name__)
+
+# Aggregates per bucket: min/max/last as float32 (exact for 16-bit registers,
+# NaN = no samples), sum as float64 and count as uint32, one value per point.
+STAT_COLUMNS = (('min', '<f4'), ('max', '<f4'), ('sum', '<f8'), ('count', '<u4'), ('last', '<f4'))
+ROLLUP_COLUMNS = [f'{prefix}_{key}' for prefix in ('reg', 'in') for key, _ in STAT_COLUMNS]
+
+SCHEMA = [
+    f'''
+    CREATE TABLE IF NOT EXISTS rollup_{name} (
+        device_id INTEGER NOT NULL,
+        ts INTEGER NOT NULL,            -- bucket start, ms since the Unix epoch
+        {', '.join(f'{column} BLOB' for column in ROLLUP_COLUMNS)},
+        PRIMARY KEY (device_id, ts)
+    ) WITHOUT ROWID
+    '''
+    for name, _, _ in TIERS
+] + [
+    '''
+    CREATE TABLE IF NOT EXISTS rollup_state (
+        tier TEXT NOT NULL,
+        device_id INTEGER NOT NULL,
+        hwm INTEGER NOT NULL,           -- everything before this has been rolled up
+        PRIMARY KEY (tier, device_id)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS rollup_dirty (
+        tier TEXT NOT NULL,
+        device_id INTEGER NOT NULL,
+        ts INTEGER NOT NULL,            -- earliest source row changed behind the tier's hwm
+        PRIMARY KEY (tier, device_id)
+    )
+    ''',
+] + [
+    # Samples that arrive late (spool replay, pusher resends) land behind the
+    # first tier's high-water mark; remember where so their buckets are rolled again
+    f'''
+    CREATE TRIGGER IF NOT EXISTS rollup_late_{event.lower()} AFTER {event} ON samples
+    WHEN NEW.ts < (SELECT hwm FROM rollup_state WHERE tier = '{TIERS[0][0]}' AND device_id = NEW.device_id)
+    BEGIN
+        INSERT INTO rollup_dirty (tier, device_id, ts) VALUES ('{TIERS[0][0]}', NEW.device_id, NEW.ts)
+        ON CONFLICT (tier, device_id) DO UPDATE SET ts = min(ts, excluded.ts);
+    END
+    '''
+    for event in ('INSERT', 'UPDATE')
+]
+
+TIER_SIZES = {name: size for name, size, _ in TIERS}
+
+
+def initialize_rollups(conn):
+    """Create the rollup tables on an open connection."""
+    for statement in SCHEMA:
+        conn.execute(statement)
+    conn.commit()
+
+def _table(tier):
+    return 'samples' if tier == 'raw' else f'rollup_{tier}'
+
+def get_hwm(conn, tier, device_id):
+    row = conn.execute('SELECT hwm FROM rollup_state WHERE tier = ? AND device_id = ?',
+                       (tier, device_id)).fetchone()
+    return None if row is None else row[0]
+
+def get_dirty(conn, tier, device_id):
+    """Earliest source timestamp that changed behind the tier's high-water mark, or None."""
+    row = conn.execute('SELECT ts FROM rollup_dirty WHERE tier = ? AND device_id = ?',
+                       (tier, device_id)).fetchone()
+    return None if row is None else row[0]
+
+def _mark_dirty(conn, tier, device_id, ts):
+    conn.execute('INSERT INTO rollup_dirty (tier, device_id, ts) VALUES (?, ?, ?) '
+                 'ON CONFLICT (tier, device_id) DO UPDATE SET ts = min(ts, excluded.ts)',
+                 (tier, device_id, ts))
+
+def _clear_dirty(conn, tier, device_id, ts):
+    # Only the mark that was read; a later row may have moved it further back meanwhile
+    conn.execute('DELETE FROM rollup_dirty WHERE tier = ? AND device_id = ? AND ts = ?',
+                 (tier, device_id, ts))
+
+
+# --- Encoding Aggregates ---
+def _encode_stats(stats, row):
+    """Blobs for one bucket row of a stats dict, in STAT_COLUMNS order."""
+    return [np.asarray(stats[key][row]).astype(dtype).tobytes() for key, dtype in STAT_COLUMNS]
+
+def _decode_stats(columns):
+    """Stats matrices from per-row blob lists, in STAT_COLUMNS order."""
+    stats = {}
+    for (key, dtype), blobs in zip(STAT_COLUMNS, columns):
+        stats[key] = blob_matrix(blobs, dtype, fill=0.0 if key in ('sum', 'count') else np.nan)
+    return stats
+
+def _source_stats(conn, source, device_id, start_ms, end_ms):
+    """Load [start_ms, end_ms) of the source of a tier as (ts, register stats, input stats)."""
+    if source == 'raw':
+        rows = conn.execute('SELECT ts, registers, inputs, input_count FROM samples '
+                            'WHERE device_id = ? AND ts >= ? AND ts < ? ORDER BY ts',
+                            (device_id, start_ms, end_ms)).fetchall()
+        if not rows:
+            return None
+        ts, registers, inputs, counts = zip(*rows)
+        return (np.asarray(ts, dtype=np.int64),
+                stats_from_values(blob_matrix(registers, '<u2')),
+                stats_from_values(bit_matrix(inputs, counts)))
+
+    rows = conn.execute(f"SELECT ts, {', '.join(ROLLUP_COLUMNS)} FROM {_table(source)} "
+                        'WHERE device_id = ? AND ts >= ? AND ts < ? ORDER BY ts',
+                        (device_id, start_ms, end_ms)).fetchall()
+    if not rows:
+        return None
+    columns = list(zip(*rows))
+    half = len(STAT_COLUMNS)
+    return (np.asarray(columns[0], dtype=np.int64),
+            _decode_stats(columns[1:1 + half]),
+            _decode_stats(columns[1 + half:]))
+
+
+# --- Rolling Up ---
+def _roll_device(conn, tier, size, source, device_id, now_ms):
+    """
+    Advance one tier for one device from its high-water mark, first rolling
+    up again the buckets whose source rows changed behind it. Returns buckets
+    written.
+    """
+    limit = (now_ms - ROLLUP_LAG_MS) // size * size
+    if source != 'raw':
+        source_hwm = get_hwm(conn, source, device_id)
+        if source_hwm is None:
+            return 0
+        limit = min(limit, source_hwm // size * size)
+
+    hwm = get_hwm(conn, tier, device_id)
+    dirty = get_dirty(conn, tier, device_id)
+    if dirty is not None:
+        start = dirty // size * size
+        keep_ms = RETENTION_MS[source]
+        if keep_ms is not None:
+            # Source rows past retention may be partly deleted already; rolling their
+            # bucket again would replace a complete aggregate with a partial one
+            start = max(start, -(-(now_ms - keep_ms) // size) * size)
+        if hwm is not None and start < hwm:
+            hwm = start
+        else:
+            with conn:
+                _clear_dirty(conn, tier, device_id, dirty)
+            dirty = None
+    upper_tiers = [name for name, _, name_source in TIERS if name_source == tier]
+
+    written = 0
+    while hwm is None or hwm < limit:
+        # Jump straight over gaps with no source data
+        row = conn.execute(f'SELECT min(ts) FROM {_table(source)} WHERE device_id = ? AND ts >= ?',
+                           (device_id, hwm or 0)).fetchone()
+        if row[0] is None or row[0] >= limit:
+            if hwm is not None:
+                with conn:
+                    conn.execute('UPDATE rollup_state SET hwm = ? WHERE tier = ? AND device_id = ?',
+                                 (max(hwm, limit), tier, device_id))
+                    if dirty is not None:
+                        _clear_dirty(conn, tier, device_id, dirty)
+            return written
+
+        window_start = row[0] // size * size
+        window_end = min(limit, window_start + CATCH_UP_BUCKETS[tier] * size)
+        loaded = _source_stats(conn, source, device_id, window_start, window_end)
+        with conn:
+            if loaded is not None:
+                ts, reg_stats, in_stats = loaded
+                buckets, reg_part = reduce_stats(ts // size, reg_stats)
+                _, in_part = reduce_stats(ts // size, in_stats)
+                conn.executemany(
+                    f"INSERT OR REPLACE INTO rollup_{tier} (device_id, ts, {', '.join(ROLLUP_COLUMNS)}) "
+                    f"VALUES (?, ?, {', '.join(['?'] * len(ROLLUP_COLUMNS))})",
+                    [(device_id, int(bucket) * size, *_encode_stats(reg_part, i), *_encode_stats(in_part, i))
+                     for i, bucket in enumerate(buckets)])
+                written += len(buckets)
+                # Buckets rewritten behind the next tier's mark must be rolled into it again
+                for upper in upper_tiers:
+                    upper_hwm = get_hwm(conn, upper, device_id)
+                    if upper_hwm is not None and int(buckets[0]) * size < upper_hwm:
+                        _mark_dirty(conn, upper, device_id, int(buckets[0]) * size)
+            conn.execute('INSERT OR REPLACE INTO rollup_state (tier, device_id, hwm) VALUES (?, ?, ?)',
+                         (tier, device_id, window_end))
+            # The lowered mark now records how far the re-roll got
+            if dirty is not None:
+                _clear_dirty(conn, tier, device_id, dirty)
+                dirty = None
+        hwm = window_end
+    return written
+
+def run_rollups(conn, now_ms=None):
+    """Bring every tier of every device up to date. Returns {tier: buckets written}."""
+    now_ms = timestamp_ms() if now_ms is None else now_ms
+    device_ids = [row[0] for row in conn.execute('SELECT id FROM devices')]
+    written = {}
+    for tier, size, source in TIERS:
+        written[tier] = sum(_roll_device(conn, tier, size, source, device_id, now_ms)
+                            for device_id in device_ids)
+    return written
+
+
+# --- Retention ---
+def _delete_before(conn, table, device_id, cutoff_ms):
+    """Delete rows older than cutoff_ms in RETENTION_BATCH-sized transactions."""
+    deleted = 0
+    while True:
+        row = conn.execute(f'SELECT ts FROM {table} WHERE device_id = ? AND ts < ? '
+                           'ORDER BY ts LIMIT 1 OFFSET ?',
+                           (device_id, cutoff_ms, RETENTION_BATCH - 1)).fetchone()
+        upper = cutoff_ms if row is None else row[0] + 1
+        with conn:
+            deleted += conn.execute(f'DELETE FROM {table} WHERE device_id = ? AND ts < ?',
+                                    (device_id, upper)).rowcount
+        if row is None:
+            return deleted
+        time.sleep(RETENTION_PAUSE)
+
+def apply_retention(conn, now_ms=None):
+    """Delete data past its tier's retention, never before it has been rolled up."""
+    now_ms = timestamp_ms() if now_ms is None else now_ms
+    device_ids = [row[0] for row in conn.execute('SELECT id FROM devices')]
+    rolled_into = {source: tier for tier, _, source in TIERS}
+    deleted = {}
+    for tier, keep_ms in RETENTION_MS.items():
+        if keep_ms is None:
+            continue
+        deleted[tier] = 0
+        for device_id in device_ids:
+            cutoff = now_ms - keep_ms
+            if tier in rolled_into:
+                hwm = get_hwm(conn, rolled_into[tier], device_id)
+                cutoff = min(cutoff, hwm or 0)
+                # Late rows not rolled up yet stay until they are, with the rest of their bucket
+                dirty = get_dirty(conn, rolled_into[tier], device_id)
+                if dirty is not None:
+                    size = TIER_SIZES[rolled_into[tier]]
+                    cutoff = min(cutoff, dirty // size * size)
+            deleted[tier] += _delete_before(conn, _table(tier), device_id, cutoff)
+    return deleted
+
+
+# --- Reading Tiers for History ---
+def _tier_stat_chunks(conn, tier, device_id, start_ms, end_ms, points, chunk_size=5000):
+    """Yield (timestamps, stats) for the requested points from one rollup tier."""
+    cursor = conn.execute(f"SELECT ts, {', '.join(ROLLUP_COLUMNS)} FROM {_table(tier)} "
+                          'WHERE device_id = ? AND ts >= ? AND ts < ? ORDER BY ts',
+                          (device_id, start_ms, end_ms))
+    half = len(STAT_COLUMNS)
+    reg_indices = [index for _, kind, index in points if kind == 'register']
+    in_indices = [index for _, kind, index in points if kind == 'input']
+    reg_cols = [col for col, (_, kind, _) in enumerate(points) if kind == 'register']
+    in_cols = [col for col, (_, kind, _) in enumerate(points) if kind == 'input']
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            return
+        columns = list(zip(*rows))
+        reg_stats = _decode_stats(columns[1:1 + half])
+        in_stats = _decode_stats(columns[1 + half:])
+        stats = {}
+        for key, _ in STAT_COLUMNS:
+            values = np.full((len(rows), len(points)), np.nan)
+            values[:, reg_cols] = take_columns(reg_stats[key], reg_indices)
+            values[:, in_cols] = take_columns(in_stats[key], in_indices)
+            if key in ('sum', 'count'):
+                values = np.nan_to_num(values)
+            stats[key] = values
+        yield np.asarray(columns[0], dtype=np.int64), stats
+
+def history_stat_chunks(conn, device_id, start_ms, end_ms, bucket_ms, points):
+    """
+    Yield (timestamps, stats) covering [start_ms, end_ms) from the coarsest
+    tier whose bucket size divides bucket_ms, filling the edges that tier does
+    not cover (unaligned start, not yet rolled-up tail) from finer tiers and
+    finally raw samples.
+    """
+    tiers = [name for name, size, _ in reversed(TIERS) if bucket_ms % size == 0]
+    return _covering_chunks(conn, device_id, start_ms, end_ms, points, tiers)
+
+def _covering_chunks(conn, device_id, start_ms, end_ms, points, tiers):
+    if start_ms >= end_ms:
+        return
+    if not tiers:
+        yield from raw_stat_chunks(conn, device_id, start_ms, end_ms, points)
+        return
+    tier, finer = tiers[0], tiers[1:]
+    size = TIER_SIZES[tier]
+    hwm = get_hwm(conn, tier, device_id)
+    lo = -(-start_ms // size) * size
+    hi = min(end_ms // size * size, hwm or 0)
+    if lo >= hi:
+        yield from _covering_chunks(conn, device_id, start_ms, end_ms, points, finer)
+        return
+    yield from _covering_chunks(conn, device_id, start_ms, lo, points, finer)
+    yield from _tier_stat_chunks(conn, tier, device_id, lo, hi, points)
+    yield from _covering_chunks(conn, device_id, hi, end_ms, points, finer)
+
+
+# --- Background Job ---
+class RollupJob(threading.Thread):
+    """Runs rollups and retention every ROLLUP_INTERVAL seconds on its own connection."""
+
+    def __init__(self, database, interval=ROLLUP_INTERVAL):
+        super().__init__(name=f'rollup:{database}', daemon=True)
+        self.database = database
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        conn = configure_connection(sqlite3.connect(self.database))
+        try:
+            initialize_rollups(conn)
+            while not self._stop_event.is_set():
+                try:
+                    written = run_rollups(conn)
+                    deleted = apply_retention(conn)
+                    logger.debug(f"Rollup pass wrote {written}, retention deleted {deleted}")
+                except sqlite3.Error as e:
+                    logger.error(f"Rollup pass failed: {e}")
+                self._stop_event.wait(self.interval)
+        finally:
+            conn.close()
+
+
+if __name__ == '__main__':
+    import sys
+    database = sys.argv[1] if len(sys.argv) > 1 else 'modbus_data.db'
+    connection = configure_connection(sqlite3.connect(database))
+    initialize_rollups(connection)
+    print(f"Rolled up: {run_rollups(connection)}")
+    print(f"Retention deleted: {apply_retention(connection)}")
+    connection.close()
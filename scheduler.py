@@ -0,0 +1,142 @@
+import time
+import metrics
+
+# --- Configuration ---
+# Named scan rates tags can be assigned to (seconds per scan)
+SCAN_CLASSES = {
+    'fast': 0.1,
+    'normal': 1.0,
+    'slow': 10.0,
+}
+DEFAULT_SCAN_CLASS = 'normal'
+
+# What to do when a scan is still running (or the process stalled) past one or
+# more of its deadlines:
+#   SKIP      drop the missed cycles and wait for the next deadline on the grid
+#   COALESCE  run once immediately for all of them, then continue on the grid
+SKIP = 'skip'
+COALESCE = 'coalesce'
+DEFAULT_POLICY = SKIP
+
+SCAN_JITTER = metrics.histogram('scan_jitter_seconds', 'How late scans start relative to their deadline', ['scan_class'])
+SCAN_DURATION = metrics.histogram('scan_duration_seconds', 'Time from scan start to finish', ['scan_class'])
+SCAN_OVERRUNS = metrics.counter('scan_overruns_total', 'Scans that ran past their next deadline', ['scan_class'])
+SCAN_MISSED = metrics.counter('scan_missed_cycles_total', 'Cycles skipped or coalesced after an overrun', ['scan_class'])
+
+
+class ScanStats:
+    """Jitter and overrun accounting for one scan loop."""
+
+    def __init__(self):
+        self.runs = 0
+        self.overruns = 0
+        self.missed_cycles = 0
+        self.coalesced = 0
+        self.last_jitter = 0.0
+        self.max_jitter = 0.0
+        self.total_jitter = 0.0
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+
+    @property
+    def mean_jitter(self):
+        return self.total_jitter / self.runs if self.runs else 0.0
+
+    def as_dict(self):
+        return {
+            'runs': self.runs, 'overruns': self.overruns, 'missed_cycles': self.missed_cycles,
+            'coalesced': self.coalesced, 'mean_jitter': self.mean_jitter, 'max_jitter': self.max_jitter,
+            'last_duration': self.last_duration, 'max_duration': self.max_duration,
+        }
+
+
+class ScanTimer:
+    """
+    Absolute deadlines on a monotonic grid: deadline n is start + phase + n * interval.
+    Work time never shifts the grid, and wall-clock (NTP) adjustments never
+    touch it. Call due_in() to learn how long to wait, then begin() and end()
+    around each scan.
+    """
+
+    def __init__(self, interval, phase=0.0, policy=DEFAULT_POLICY, name=DEFAULT_SCAN_CLASS,
+                 clock=time.monotonic, start=None):
+        if policy not in (SKIP, COALESCE):
+            raise ValueError(f"Unknown overrun policy {policy!r}")
+        self.interval = interval
+        self.policy = policy
+        self.name = name
+        self.clock = clock
+        self.deadline = (clock() if start is None else start) + phase
+        self.stats = ScanStats()
+        self._started = None
+        self._run_now = False
+        self._jitter = SCAN_JITTER.labels(name)
+        self._duration = SCAN_DURATION.labels(name)
+        self._overruns = SCAN_OVERRUNS.labels(name)
+        self._missed = SCAN_MISSED.labels(name)
+
+    def due_in(self):
+        """Seconds until the next scan should start (0 if it is due now)."""
+        if self._run_now:
+            return 0.0
+        return max(0.0, self.deadline - self.clock())
+
+    def begin(self):
+        now = self.clock()
+        # A coalesced run starts late by design; measure it against the deadline it replaces
+        jitter = max(0.0, now - self.deadline)
+        self._started = now
+        self._run_now = False
+        stats = self.stats
+        stats.runs += 1
+        stats.last_jitter = jitter
+        stats.total_jitter += jitter
+        stats.max_jitter = max(stats.max_jitter, jitter)
+        self._jitter.observe(jitter)
+
+    def miss(self):
+        """Count the current cycle as missed: it began but never got to do its work."""
+        self.stats.missed_cycles += 1
+        self._missed.inc()
+
+    def end(self):
+        """Record the scan and move to the next deadline according to the overrun policy."""
+        now = self.clock()
+        stats = self.stats
+        duration = now - (self._started if self._started is not None else now)
+        stats.last_duration = duration
+        stats.max_duration = max(stats.max_duration, duration)
+        self._duration.observe(duration)
+
+        self.deadline += self.interval
+        if now <= self.deadline:
+            return
+        stats.overruns += 1
+        self._overruns.inc()
+        # Number of whole deadlines that passed while we were busy
+        missed = int((now - self.deadline) // self.interval) + 1
+        stats.missed_cycles += missed
+        self._missed.inc(missed)
+        if self.policy == COALESCE:
+            # One immediate run stands in for all of them; keep the grid for afterwards
+            stats.coalesced += 1
+            self._run_now = True
+            self.deadline += (missed - 1) * self.interval
+        else:
+            self.deadline += missed * self.interval
+
+
+def stagger(intervals):
+    """
+    Phase offsets that spread loops of the same interval evenly across one
+    period, so e.g. ten 1 s scans start 100 ms apart instead of all at once.
+    Returns one offset per entry of intervals, in order.
+    """
+    groups = {}
+    for index, interval in enumerate(intervals):
+        groups.setdefault(interval, []).append(index)
+    offsets = [0.0] * len(intervals)
+    for interval, members in groups.items():
+        for position, index in enumerate(members):
+            offsets[index] = interval * position / len(members)
+    return offsets
@@ -1,28 +1,228 @@
-import socket
+"""
+Modbus TCP fan-in gateway: many downstream clients, one upstream connection per device.
 
-# Create a TCP socket
-server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    python server.py --listen 0.0.0.0:1502 --upstream 1=192.168.1.10:502 --max-age 0.5
 
-# Bind the socket to an address and port
-server_socket.bind(('0.0.0.0', 9999))
+Reads (FC01-04) are answered from a cache while the cached response is younger
+than the configured max age; concurrent identical reads that miss the cache
+share one upstream request. Everything else (writes, diagnostics) is forwarded
+in arrival order over the same upstream connection and invalidates the
+cached reads of that unit. Point app.py, master.py, main.py and SCADA at the
+gateway instead of the PLC, and upstream load stays flat however many clients
+connect.
+"""
+import argparse
+import asyncio
+import logging
+import time
+import metrics
+from mbap import (MbapClient, FrameError, READ_FUNCTION_CODES, GATEWAY_PATH_UNAVAILABLE,
+                  GATEWAY_TARGET_NO_RESPONSE, encode_frame, exception_pdu, is_exception, read_frame)
 
-# Listen for incoming connections
-server_socket.listen(5)
+# --- Configuration ---
+LISTEN_HOST = '0.0.0.0'
+LISTEN_PORT = 1502               # 502 needs root; point clients here instead
+MAX_AGE = 0.5                    # Serve cached reads younger than this (seconds)
+MAX_AGE_BY_FUNCTION = {}         # Per function code overrides, e.g. {3: 1.0, 2: 0.2}
+UPSTREAM_TIMEOUT = 2.0
+MAX_CACHE_ENTRIES = 10000        # Oldest entries are dropped past this
 
-print("Server is listening...")
+# Downstream unit id -> (upstream host, port, upstream unit id). Units on the
+# same host:port share one upstream connection.
+UPSTREAMS = {
+    1: ('127.0.0.1', 502, 1),
+}
 
-while True:
-    # Accept a connection
-    client_socket, address = server_socket.accept()
-    print(f"Connection from {address} has been established!")
+logger = logging.getLogger(__name__)
 
-    # Receive a message from the client
-    message = client_socket.recv(1024).decode()
-    print(f"Received from client: {message}")
+GATEWAY_REQUESTS = metrics.counter('gateway_requests_total', 'Downstream requests by how they were served', ['result'])
+GATEWAY_UPSTREAM_LATENCY = metrics.histogram('gateway_upstream_latency_seconds', 'Upstream request round trips', ['upstream'])
+GATEWAY_CLIENTS = metrics.gauge('gateway_clients', 'Connected downstream clients')
 
-    # Send a response back to the client
-    response = "Hello from Ajay"
-    client_socket.send(response.encode())
 
-    # Close the client socket
-    client_socket.close()
\ No newline at end of file
+class ModbusGateway:
+    """Routes downstream MBAP requests to shared upstream connections through a read cache."""
+
+    def __init__(self, upstreams=UPSTREAMS, max_age=MAX_AGE, max_age_by_function=None,
+                 timeout=UPSTREAM_TIMEOUT, max_cache_entries=MAX_CACHE_ENTRIES):
+        self.max_age = max_age
+        self.max_age_by_function = dict(max_age_by_function or MAX_AGE_BY_FUNCTION)
+        self.max_cache_entries = max_cache_entries
+        self._connections = {}
+        self._routes = {}
+        for unit_id, (host, port, upstream_unit) in upstreams.items():
+            connection = self._connections.get((host, port))
+            if connection is None:
+                connection = self._connections[(host, port)] = MbapClient(host, port, timeout)
+            self._routes[unit_id] = (connection, upstream_unit)
+        self._cache = {}      # (unit id, request pdu) -> (response pdu, monotonic time)
+        self._inflight = {}   # (unit id, request pdu) -> Task reading the response pdu
+        self._writes = {}     # unit id -> number of writes forwarded, to spot reads a write overtook
+        self._results = {key: GATEWAY_REQUESTS.labels(key)
+                         for key in ('hit', 'merged', 'upstream', 'forwarded', 'error')}
+        self._client_count = 0
+        self._server = None
+
+    # --- Downstream ---
+    async def serve(self, host=LISTEN_HOST, port=LISTEN_PORT):
+        self._server = await asyncio.start_server(self._handle_client, host, port)
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def _handle_client(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        self._client_count += 1
+        GATEWAY_CLIENTS.set(self._client_count)
+        tasks = set()
+        try:
+            while True:
+                try:
+                    transaction_id, unit_id, pdu = await read_frame(reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except FrameError as e:
+                    logger.warning(f"Dropping client {peer}: {e}")
+                    break
+                # Answer pipelined requests as they complete; MBAP transaction ids match them up
+                task = asyncio.create_task(self._answer(writer, transaction_id, unit_id, pdu))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+            self._client_count -= 1
+            GATEWAY_CLIENTS.set(self._client_count)
+
+    async def _answer(self, writer, transaction_id, unit_id, pdu):
+        response = await self.handle(unit_id, pdu)
+        if not writer.is_closing():
+            writer.write(encode_frame(transaction_id, unit_id, response))
+
+    async def handle(self, unit_id, pdu):
+        """Return the response PDU for one downstream request PDU."""
+        route = self._routes.get(unit_id)
+        if route is None:
+            self._results['error'].inc()
+            return exception_pdu(pdu[0], GATEWAY_PATH_UNAVAILABLE)
+        if pdu[0] in READ_FUNCTION_CODES and len(pdu) == 5:
+            return await self._read(route, unit_id, pdu)
+        return await self._forward(route, unit_id, pdu)
+
+    # --- Reads ---
+    async def _read(self, route, unit_id, pdu):
+        key = (unit_id, pdu)
+        cached = self._cache.get(key)
+        if cached is not None and time.monotonic() - cached[1] <= self.max_age_by_function.get(pdu[0], self.max_age):
+            self._results['hit'].inc()
+            return cached[0]
+
+        pending = self._inflight.get(key)
+        if pending is not None:
+            self._results['merged'].inc()
+        else:
+            # The upstream read belongs to the gateway, not to the client that asked first, so
+            # that client disconnecting (and its tasks being cancelled) cannot fail merged reads
+            pending = self._inflight[key] = asyncio.ensure_future(self._fetch(route, unit_id, key, pdu))
+        return await asyncio.shield(pending)
+
+    async def _fetch(self, route, unit_id, key, pdu):
+        """Read upstream on behalf of every client waiting on key, and cache the answer."""
+        writes = self._writes.get(unit_id, 0)
+        try:
+            response = await self._upstream(route, pdu)
+        except Exception as e:
+            self._results['error'].inc()
+            logger.warning(f"Upstream read for unit {unit_id} failed: {e!r}")
+            return exception_pdu(pdu[0], GATEWAY_TARGET_NO_RESPONSE)
+        finally:
+            del self._inflight[key]
+        # Don't cache a response that may predate a write forwarded meanwhile
+        if not is_exception(response) and self._writes.get(unit_id, 0) == writes:
+            self._store(key, response)
+        self._results['upstream'].inc()
+        return response
+
+    def _store(self, key, response):
+        if len(self._cache) >= self.max_cache_entries:
+            # dicts keep insertion order; drop the oldest quarter in one go
+            for old in list(self._cache)[:self.max_cache_entries // 4 or 1]:
+                del self._cache[old]
+        self._cache.pop(key, None)
+        self._cache[key] = (response, time.monotonic())
+
+    # --- Writes and Everything Else ---
+    async def _forward(self, route, unit_id, pdu):
+        response = await self._upstream(route, pdu)
+        self._results['forwarded'].inc()
+        # The write may have changed anything this unit reports
+        self._writes[unit_id] = self._writes.get(unit_id, 0) + 1
+        for key in [key for key in self._cache if key[0] == unit_id]:
+            del self._cache[key]
+        return response
+
+    async def _upstream(self, route, pdu):
+        connection, upstream_unit = route
+        started = time.perf_counter()
+        try:
+            response = await connection.request(upstream_unit, pdu)
+        except (ConnectionError, asyncio.TimeoutError) as e:
+            self._results['error'].inc()
+            logger.warning(f"Upstream {connection.host}:{connection.port} failed: {e}")
+            return exception_pdu(pdu[0], GATEWAY_TARGET_NO_RESPONSE)
+        GATEWAY_UPSTREAM_LATENCY.labels(f'{connection.host}:{connection.port}').observe(time.perf_counter() - started)
+        return response
+
+    def stats(self):
+        return {
+            'clients': self._client_count,
+            'cached': len(self._cache),
+            'upstreams': {f'{host}:{port}': dict(connection.stats)
+                          for (host, port), connection in self._connections.items()},
+        }
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+        for connection in self._connections.values():
+            connection.close()
+
+
+def _parse_address(spec, default_port):
+    host, _, port = spec.rpartition(':') if ':' in spec else (spec, None, None)
+    return host, int(port) if port else default_port
+
+def _parse_upstream(spec):
+    """Parse 'UNIT=HOST[:PORT][/UPSTREAM_UNIT]' into (unit, (host, port, upstream unit))."""
+    unit, _, target = spec.partition('=')
+    target, _, upstream_unit = target.partition('/')
+    host, port = _parse_address(target, 502)
+    return int(unit), (host, port, int(upstream_unit or unit))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--listen', default=f'{LISTEN_HOST}:{LISTEN_PORT}')
+    parser.add_argument('--upstream', action='append', metavar='UNIT=HOST[:PORT][/UNIT]',
+                        help='route a downstream unit id to a device (repeatable)')
+    parser.add_argument('--max-age', type=float, default=MAX_AGE, help='cache freshness for reads (s)')
+    parser.add_argument('--timeout', type=float, default=UPSTREAM_TIMEOUT)
+    parser.add_argument('--metrics-port', type=int, help='serve Prometheus /metrics on this port')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    upstreams = dict(_parse_upstream(spec) for spec in args.upstream) if args.upstream else UPSTREAMS
+    host, port = _parse_address(args.listen, LISTEN_PORT)
+    if args.metrics_port:
+        metrics.start_http_server(args.metrics_port)
+
+    gateway = ModbusGateway(upstreams, max_age=args.max_age, timeout=args.timeout)
+    print(f"Gateway listening on {host}:{port}")
+    for unit, (up_host, up_port, up_unit) in sorted(upstreams.items()):
+        print(f"  unit {unit} -> {up_host}:{up_port} unit {up_unit}")
+    try:
+        asyncio.run(gateway.serve(host, port))
+    except KeyboardInterrupt:
+        print(f"\nGateway stopped. {gateway.stats()}")
+
+if __name__ == '__main__':
+    main()
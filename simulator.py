@@ -0,0 +1,173 @@
+"""
+Modbus TCP device simulator for load-testing the pollers without real PLCs.
+
+    python simulator.py --port 5020 --units 1-100 --latency 0.02 --jitter 0.01
+"""
+import argparse
+import asyncio
+import logging
+import math
+import random
+import resource
+import numpy as np
+from pymodbus.datastore import ModbusSequentialDataBlock, ModbusServerContext, ModbusSlaveContext
+from pymodbus.server import ModbusTcpServer
+
+# --- Configuration ---
+SIM_HOST = '0.0.0.0'
+SIM_PORT = 5020
+UNIT_IDS = range(1, 11)      # Unit ids served; each gets its own data maps
+REGISTER_COUNT = 10000       # Holding and input registers per unit
+BIT_COUNT = 10000            # Coils and discrete inputs per unit
+UPDATE_INTERVAL = 0.1        # Seconds between waveform updates
+RESPONSE_LATENCY = 0.0       # Seconds added to every request...
+RESPONSE_JITTER = 0.0        # ...plus a uniform random 0..jitter seconds
+
+# Waveforms applied to every unit: (table, start, count, kind, parameters).
+# Tables are 'hr' (holding), 'ir' (input registers), 'co' (coils), 'di' (discrete inputs).
+# Each point gets a phase offset so neighbouring values differ.
+WAVEFORMS = [
+    ('hr', 0, 20, 'sine', {'period': 60.0, 'amplitude': 1000, 'offset': 1000}),
+    ('hr', 20, 20, 'ramp', {'period': 30.0, 'high': 65535}),
+    ('hr', 40, 20, 'random', {'low': 0, 'high': 100}),
+    ('ir', 0, 20, 'sine', {'period': 10.0, 'amplitude': 500, 'offset': 500}),
+    ('di', 0, 20, 'square', {'period': 10.0}),
+    ('di', 20, 20, 'random', {}),
+    ('co', 0, 20, 'square', {'period': 4.0}),
+]
+
+
+class SimulatedSlaveContext(ModbusSlaveContext):
+    """Slave context that delays every request by latency + uniform(0, jitter)."""
+
+    def __init__(self, latency=RESPONSE_LATENCY, jitter=RESPONSE_JITTER, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency
+        self.jitter = jitter
+
+    async def _delay(self):
+        delay = self.latency + (random.uniform(0, self.jitter) if self.jitter else 0.0)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def async_getValues(self, fc_as_hex, address, count=1):
+        await self._delay()
+        return self.getValues(fc_as_hex, address, count)
+
+    async def async_setValues(self, fc_as_hex, address, values):
+        await self._delay()
+        self.setValues(fc_as_hex, address, values)
+
+
+def build_context(unit_ids=UNIT_IDS, register_count=REGISTER_COUNT, bit_count=BIT_COUNT,
+                  latency=RESPONSE_LATENCY, jitter=RESPONSE_JITTER):
+    """Create a server context with large, independent maps for every unit id."""
+    # pymodbus slave contexts add 1 to every protocol address, so blocks start at 1
+    # to make protocol address 0 the first value
+    slaves = {
+        unit: SimulatedSlaveContext(
+            latency=latency, jitter=jitter,
+            hr=ModbusSequentialDataBlock(1, [0] * register_count),
+            ir=ModbusSequentialDataBlock(1, [0] * register_count),
+            co=ModbusSequentialDataBlock(1, [False] * bit_count),
+            di=ModbusSequentialDataBlock(1, [False] * bit_count),
+        )
+        for unit in unit_ids
+    }
+    return ModbusServerContext(slaves=slaves, single=False)
+
+
+# --- Waveforms ---
+def waveform_values(kind, params, count, t):
+    """Compute the current values of one waveform range as a list."""
+    phase = np.arange(count) / max(count, 1)
+    period = params.get('period', 10.0)
+    if kind == 'sine':
+        values = params.get('offset', 0) + params.get('amplitude', 1000) * np.sin(2 * math.pi * (t / period + phase))
+    elif kind == 'ramp':
+        values = ((t / period + phase) % 1.0) * params.get('high', 65535)
+    elif kind == 'square':
+        values = ((t / period + phase) % 1.0) < 0.5
+    elif kind == 'random':
+        values = np.random.randint(params.get('low', 0), params.get('high', 2), size=count)
+    else:
+        raise ValueError(f"Unknown waveform {kind!r}")
+    if values.dtype != bool:
+        values = np.clip(np.rint(values), 0, 65535).astype(np.uint16)
+    return values.tolist()
+
+async def update_waveforms(context, unit_ids, waveforms=WAVEFORMS, interval=UPDATE_INTERVAL):
+    """
+    Rewrite every waveform range of every unit each interval. Values are
+    computed once per tick and shared by all units, and the loop yields
+    between units so requests keep being served during large updates.
+    """
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    fx = {'co': 1, 'di': 2, 'hr': 3, 'ir': 4}
+    while True:
+        tick = loop.time()
+        t = tick - started
+        ranges = [(fx[table], start, waveform_values(kind, params, count, t))
+                  for table, start, count, kind, params in waveforms]
+        for unit in unit_ids:
+            slave = context[unit]
+            for function_code, start, values in ranges:
+                slave.setValues(function_code, start, values)
+            await asyncio.sleep(0)
+        await asyncio.sleep(max(0.0, tick + interval - loop.time()))
+
+
+def raise_file_limit():
+    """Lift the open-file soft limit to the hard limit so thousands of clients can connect."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+async def run_simulator(host=SIM_HOST, port=SIM_PORT, unit_ids=UNIT_IDS,
+                        latency=RESPONSE_LATENCY, jitter=RESPONSE_JITTER, ready=None):
+    """Serve the simulator until cancelled. Sets the optional ready event once listening."""
+    unit_ids = list(unit_ids)
+    context = build_context(unit_ids, latency=latency, jitter=jitter)
+    server = ModbusTcpServer(context, address=(host, port))
+    updater = asyncio.create_task(update_waveforms(context, unit_ids))
+    try:
+        await server.listen()
+        if ready is not None:
+            ready.set()
+        await server.serving
+    finally:
+        updater.cancel()
+        await server.shutdown()
+
+
+def _parse_units(spec):
+    """Parse '1-10,20' into a list of unit ids."""
+    units = []
+    for part in spec.split(','):
+        lo, _, hi = part.partition('-')
+        units.extend(range(int(lo), int(hi or lo) + 1))
+    return units
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default=SIM_HOST)
+    parser.add_argument('--port', type=int, default=SIM_PORT)
+    parser.add_argument('--units', default=f'{UNIT_IDS.start}-{UNIT_IDS.stop - 1}', help="e.g. '1-100' or '1,2,5'")
+    parser.add_argument('--latency', type=float, default=RESPONSE_LATENCY, help='seconds added to each response')
+    parser.add_argument('--jitter', type=float, default=RESPONSE_JITTER, help='extra uniform random delay (seconds)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    units = _parse_units(args.units)
+    print(f"Open file limit: {raise_file_limit()}")
+    print(f"Simulating {len(units)} unit(s) on {args.host}:{args.port} "
+          f"(latency {args.latency * 1000:.0f} ms + up to {args.jitter * 1000:.0f} ms jitter)")
+    try:
+        asyncio.run(run_simulator(args.host, args.port, units, args.latency, args.jitter))
+    except KeyboardInterrupt:
+        print("\nSimulator stopped.")
+
+if __name__ == '__main__':
+    main()
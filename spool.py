@@ -0,0 +1,307 @@
+"""
+Durable store-and-forward spool between acquisition and the database.
+
+Rows are appended to memory-mapped, preallocated segment files as fast as
+the page cache takes them, and survive a restart of the process. The DB
+writer replays them in bulk from a persisted cursor and deletes segments once
+every row in them is committed, so a locked or slow database delays rows
+instead of losing them or stalling the pollers.
+
+Segment layout, little-endian:
+
+    header  4s magic 'MBSP', uint16 version, uint16 marshal version, uint64 segment number
+    record  uint32 length, uint32 crc32, uint64 seq, float64 unix time, uint16 statement,
+            then length bytes of marshal'ed params
+
+A record with statement DEFINE instead carries (statement id, sql) and
+introduces that statement for the rest of the segment, so the SQL text is
+stored once per segment instead of once per row. A zero length or a bad
+CRC marks the end of the data, which is how a record torn by a crash is
+dropped on recovery. Replay is at-least-once: rows committed just before a
+crash may be replayed again, which the upsert statements of storage.py
+absorb.
+"""
+import fcntl
+import marshal
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+# --- Configuration ---
+SEGMENT_SIZE = 16 * 1024 * 1024     # Bytes per segment file
+MAX_BYTES = 1024 * 1024 * 1024      # Refuse new rows past this much backlog
+
+MAGIC = b'MBSP'
+VERSION = 1
+SEGMENT_HEADER = struct.Struct('<4sHHQ')
+RECORD = struct.Struct('<IIQdH')
+RECORD_META = struct.Struct('<QdH')   # the part of RECORD covered by the CRC, with the payload
+DATA_START = SEGMENT_HEADER.size
+DEFINE = 0xFFFF
+CURSOR_FILE = 'cursor'
+LOCK_FILE = 'lock'
+
+
+class SpoolFull(Exception):
+    """The spool already holds MAX_BYTES that the database has not taken yet."""
+
+
+class Spool:
+    """
+    Append-only segment log of (sql, params) rows. append() may be called
+    from any thread; read() and commit() belong to the single replaying
+    writer. Positions are byte offsets into the concatenated segments
+    (segment number * segment size + offset).
+    """
+
+    def __init__(self, directory, segment_size=SEGMENT_SIZE, max_bytes=MAX_BYTES):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        # One process per spool directory; a second one would interleave appends and replay rows twice
+        self._lock_fd = os.open(os.path.join(directory, LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(self._lock_fd)
+            raise RuntimeError(f"Spool {directory} is in use by another process")
+        self._lock = threading.Lock()
+        self._segments = {}        # segment number -> mmap
+        self._statements = {}      # sql -> id, in the segment being appended to
+        self._definitions = {}     # segment number -> {id: sql}, as seen by read()
+
+        numbers = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith('.seg'))
+        for number in numbers:
+            self._open_segment(number)
+        if not numbers:
+            self._open_segment(1)
+            numbers = [1]
+        last = numbers[-1]
+        # Appending resumes after the last intact record; whatever follows is a torn write
+        end, self.next_seq = DATA_START, None
+        for offset, next_offset, seq, _, stmt, payload in self._records(last, DATA_START):
+            if stmt == DEFINE:
+                statement_id, sql = marshal.loads(payload)
+                self._statements[sql] = statement_id
+            end, self.next_seq = next_offset, seq + 1
+        for number in reversed(numbers[:-1]):
+            if self.next_seq is not None:
+                break
+            for _, _, seq, _, _, _ in self._records(number, DATA_START):
+                self.next_seq = seq + 1
+        self.next_seq = self.next_seq or 1
+        if end >= segment_size:
+            # A segment filled to the last byte by an older release; continue in the next one
+            last, end = last + 1, DATA_START
+            self._open_segment(last)
+            self._statements = {}
+        mm = self._segments[last]
+        mm[end:] = bytes(len(mm) - end)
+        self.write_position = last * segment_size + end
+
+        self.read_position = self._normalise(max(self._load_cursor(), numbers[0] * segment_size + DATA_START))
+        self.committed_seq = self._peek(self.read_position)[0]
+
+    # --- Segments ---
+    def _path(self, number):
+        return os.path.join(self.directory, f'{number:010d}.seg')
+
+    def _open_segment(self, number):
+        path = self._path(number)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < self.segment_size:
+                os.ftruncate(fd, self.segment_size)
+            mm = mmap.mmap(fd, self.segment_size)
+        finally:
+            os.close(fd)
+        magic, version, marshal_version, stored = SEGMENT_HEADER.unpack_from(mm)
+        if magic != MAGIC:
+            mm[:SEGMENT_HEADER.size] = SEGMENT_HEADER.pack(MAGIC, VERSION, marshal.version, number)
+        elif version != VERSION or marshal_version != marshal.version or stored != number:
+            mm.close()
+            raise ValueError(f"{path} was written by an incompatible spool (version {version}, "
+                             f"marshal {marshal_version}); replay it with the matching release or remove it")
+        self._segments[number] = mm
+        return mm
+
+    def _normalise(self, position):
+        """Move a position that points into a segment header to that segment's first record."""
+        number, offset = divmod(position, self.segment_size)
+        return number * self.segment_size + max(offset, DATA_START)
+
+    def _records(self, number, offset):
+        """Yield (offset, next offset, seq, time, statement, payload) for the intact records of a segment from offset."""
+        mm = self._segments[number]
+        size = len(mm)
+        while offset + RECORD.size <= size:
+            length, crc, seq, timestamp, stmt = RECORD.unpack_from(mm, offset)
+            start = offset + RECORD.size
+            if length == 0 or start + length > size:
+                return
+            payload = mm[start:start + length]
+            if zlib.crc32(payload, zlib.crc32(mm[offset + 8:start])) != crc:
+                return
+            yield offset, start + length, seq, timestamp, stmt, payload
+            offset = start + length
+
+    # --- Appending ---
+    def append(self, sql, params, timestamp=None):
+        """Add one row. Raises SpoolFull once max_bytes are waiting for the database."""
+        payload = marshal.dumps(params)
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._lock:
+            number, offset = divmod(self.write_position, self.segment_size)
+            statement_id = self._statements.get(sql)
+            need = RECORD.size + len(payload)
+            if statement_id is None:
+                definition = marshal.dumps((len(self._statements), sql))
+                need += RECORD.size + len(definition)
+            # A record may not end on the boundary: that position would be the next segment's header
+            if offset + need >= self.segment_size:
+                number, offset = self._roll(number, need)
+                statement_id = None
+                definition = marshal.dumps((0, sql))
+            mm = self._segments[number]
+            if statement_id is None:
+                statement_id = len(self._statements)
+                offset = self._write(mm, offset, DEFINE, definition, timestamp)
+                self._statements[sql] = statement_id
+            offset = self._write(mm, offset, statement_id, payload, timestamp)
+            self.next_seq += 1
+            self.write_position = number * self.segment_size + offset
+
+    def _write(self, mm, offset, stmt, payload, timestamp):
+        # Definitions carry the seq of the row that follows them, so seqs count rows only
+        meta = RECORD_META.pack(self.next_seq, timestamp, stmt)
+        start = offset + RECORD.size
+        mm[start:start + len(payload)] = payload
+        mm[offset:start] = RECORD.pack(len(payload), zlib.crc32(payload, zlib.crc32(meta)),
+                                       self.next_seq, timestamp, stmt)
+        return start + len(payload)
+
+    def _roll(self, number, need):
+        if self.pending_bytes() + self.segment_size > self.max_bytes:
+            raise SpoolFull(f"Spool {self.directory} holds {self.pending_bytes()} bytes not yet in the database")
+        if SEGMENT_HEADER.size + need >= self.segment_size:
+            raise ValueError(f"Row of {need} bytes does not fit in a {self.segment_size} byte segment")
+        self._open_segment(number + 1)
+        self._statements = {}
+        return number + 1, DATA_START
+
+    # --- Replaying ---
+    def read(self, position, max_rows):
+        """
+        Up to max_rows rows from position on. Returns ([(sql, params)], position
+        after the last row, seq of the last row).
+        """
+        with self._lock:
+            end = self.write_position
+        position = self._normalise(position)
+        rows = []
+        last_seq = None
+        while position < end and len(rows) < max_rows:
+            number, offset = divmod(position, self.segment_size)
+            definitions = self._definitions_of(number, offset)
+            for _, next_offset, seq, _, stmt, payload in self._records(number, offset):
+                if number * self.segment_size + next_offset > end:
+                    break
+                position = number * self.segment_size + next_offset
+                if stmt == DEFINE:
+                    statement_id, sql = marshal.loads(payload)
+                    definitions[statement_id] = sql
+                    continue
+                rows.append((definitions[stmt], marshal.loads(payload)))
+                last_seq = seq
+                if len(rows) >= max_rows:
+                    break
+            else:
+                if number < end // self.segment_size:
+                    position = (number + 1) * self.segment_size + DATA_START
+                    continue
+            break
+        return rows, position, last_seq
+
+    def _definitions_of(self, number, offset):
+        """Statements defined in a segment before offset (scanned once per segment)."""
+        definitions = self._definitions.get(number)
+        if definitions is None:
+            definitions = self._definitions[number] = {}
+            for record_offset, _, _, _, stmt, payload in self._records(number, DATA_START):
+                if record_offset >= offset:
+                    break
+                if stmt == DEFINE:
+                    statement_id, sql = marshal.loads(payload)
+                    definitions[statement_id] = sql
+        return definitions
+
+    def commit(self, position, last_seq):
+        """Record that every row before position is in the database; drop the segments that are done."""
+        self._save_cursor(position)
+        with self._lock:
+            self.read_position = position
+            if last_seq is not None:
+                self.committed_seq = last_seq + 1
+            done = [number for number in self._segments
+                    if number < position // self.segment_size and number < self.write_position // self.segment_size]
+            for number in done:
+                self._segments.pop(number).close()
+                self._definitions.pop(number, None)
+        for number in done:
+            os.unlink(self._path(number))
+
+    def _peek(self, position):
+        """(seq, time) of the first row at or after position, or (next seq, None) if there is none."""
+        with self._lock:
+            end = self.write_position
+            number, offset = divmod(self._normalise(position), self.segment_size)
+            while number * self.segment_size + offset < end:
+                for _, _, seq, timestamp, stmt, _ in self._records(number, offset):
+                    if stmt != DEFINE:
+                        return seq, timestamp
+                number, offset = number + 1, DATA_START
+            return self.next_seq, None
+
+    def _load_cursor(self):
+        try:
+            with open(os.path.join(self.directory, CURSOR_FILE), 'rb') as f:
+                return struct.unpack('<Q', f.read(8))[0]
+        except (FileNotFoundError, struct.error):
+            return 0
+
+    def _save_cursor(self, position):
+        path = os.path.join(self.directory, CURSOR_FILE)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(struct.pack('<Q', position))
+        os.replace(path + '.tmp', path)
+
+    # --- Status ---
+    def pending_bytes(self):
+        """Bytes appended but not yet committed (segment slack included)."""
+        return max(0, self.write_position - self.read_position)
+
+    def pending_rows(self):
+        return max(0, self.next_seq - self.committed_seq)
+
+    def replay_lag(self):
+        """Seconds since the oldest row not yet in the database was appended (0 if none)."""
+        _, timestamp = self._peek(self.read_position)
+        return 0.0 if timestamp is None else max(0.0, time.time() - timestamp)
+
+    def sync(self):
+        """Write dirty pages of the open segments to disk (they already survive a process crash)."""
+        with self._lock:
+            segments = list(self._segments.values())
+        for mm in segments:
+            mm.flush()
+
+    def close(self):
+        with self._lock:
+            for mm in self._segments.values():
+                mm.close()
+            self._segments.clear()
+        os.close(self._lock_fd)  # releases the flock
@@ -0,0 +1,260 @@
+import json
+import sqlite3
+import sys
+import threading
+import time
+from array import array
+from db_writer import configure_connection, get_writer
+
+# --- Packed Sample Schema ---
+# One row per device per poll. Registers are stored as a little-endian
+# array('H') blob and discrete inputs as a bit-packed blob (bit i of the
+# block is bit i % 8 of byte i // 8, the same order Modbus uses on the wire),
+# so the point count can change without a schema change. Decoded engineering
+# values of typed tags (see tag_decoder.py) go in tag_values as a float64
+# array (NaN = not read) whose names are listed once per layout in tag_sets.
+SCHEMA = (
+    '''
+    CREATE TABLE IF NOT EXISTS devices (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS samples (
+        device_id INTEGER NOT NULL,
+        ts INTEGER NOT NULL,            -- milliseconds since the Unix epoch
+        registers BLOB,                 -- array('H'), little-endian
+        inputs BLOB,                    -- bit-packed, LSB first
+        input_count INTEGER NOT NULL DEFAULT 0,
+        tag_set INTEGER,                -- tag_sets.id naming the tag_values entries
+        tag_values BLOB,                -- array('d'), little-endian
+        PRIMARY KEY (device_id, ts)
+    ) WITHOUT ROWID
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS tag_sets (
+        id INTEGER PRIMARY KEY,
+        device_id INTEGER NOT NULL,
+        names TEXT NOT NULL,            -- JSON list, in tag_values order
+        UNIQUE (device_id, names)
+    )
+    ''',
+)
+
+# Columns added since the packed schema was introduced: (name, declaration)
+ADDED_SAMPLE_COLUMNS = (
+    ('tag_set', 'INTEGER'),
+    ('tag_values', 'BLOB'),
+)
+
+# Upsert so a register-only and an input-only write at the same instant merge
+SAMPLE_INSERT_SQL = '''
+    INSERT INTO samples (device_id, ts, registers, inputs, input_count, tag_set, tag_values)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (device_id, ts) DO UPDATE SET
+        registers = coalesce(excluded.registers, registers),
+        inputs = coalesce(excluded.inputs, inputs),
+        input_count = max(excluded.input_count, input_count),
+        tag_set = coalesce(excluded.tag_set, tag_set),
+        tag_values = coalesce(excluded.tag_values, tag_values)
+'''
+
+_LITTLE_ENDIAN = sys.byteorder == 'little'
+
+
+def initialize_schema(conn):
+    """Create the packed sample tables on an open connection."""
+    configure_connection(conn)
+    for statement in SCHEMA:
+        conn.execute(statement)
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(samples)')}
+    for name, declaration in ADDED_SAMPLE_COLUMNS:
+        if name not in columns:
+            conn.execute(f'ALTER TABLE samples ADD COLUMN {name} {declaration}')
+    conn.commit()
+
+
+# --- Packing ---
+def pack_registers(registers):
+    """Pack 16-bit register values into a little-endian blob."""
+    packed = array('H', registers)
+    if not _LITTLE_ENDIAN:
+        packed.byteswap()
+    return packed.tobytes()
+
+def pack_values(values):
+    """Pack engineering values (floats, NaN for missing) into a little-endian float64 blob."""
+    packed = array('d', values)
+    if not _LITTLE_ENDIAN:
+        packed.byteswap()
+    return packed.tobytes()
+
+def pack_bits(bits):
+    """Pack booleans into bytes, LSB first."""
+    value = 0
+    for i, bit in enumerate(bits):
+        if bit:
+            value |= 1 << i
+    return value.to_bytes((len(bits) + 7) // 8, 'little')
+
+
+# --- Unpacking ---
+def unpack_registers(blob):
+    """
+    Return the registers of a blob as a read-only memoryview of 'H' items.
+    On little-endian hosts this is a view over the blob itself, not a copy.
+    """
+    if blob is None:
+        return None
+    if _LITTLE_ENDIAN:
+        return memoryview(blob).cast('H')
+    values = array('H')
+    values.frombytes(blob)
+    values.byteswap()
+    return memoryview(values)
+
+def unpack_values(blob):
+    """Return the engineering values of a blob as a memoryview of 'd' items (see unpack_registers)."""
+    if blob is None:
+        return None
+    if _LITTLE_ENDIAN:
+        return memoryview(blob).cast('d')
+    values = array('d')
+    values.frombytes(blob)
+    values.byteswap()
+    return memoryview(values)
+
+def input_bit(blob, index):
+    """Return one discrete input from a bit-packed blob without unpacking the rest."""
+    return (blob[index >> 3] >> (index & 7)) & 1
+
+def unpack_bits(blob, count):
+    """Expand a bit-packed blob into a list of count 0/1 ints."""
+    if blob is None:
+        return None
+    value = int.from_bytes(blob, 'little')
+    return [(value >> i) & 1 for i in range(count)]
+
+
+# --- Devices ---
+_device_ids = {}
+_device_lock = threading.Lock()
+
+def get_device_id(database, name):
+    """Return the numeric id for a device name, registering it on first use."""
+    key = (database, name)
+    with _device_lock:
+        device_id = _device_ids.get(key)
+        if device_id is None:
+            conn = sqlite3.connect(database)
+            try:
+                initialize_schema(conn)
+                conn.execute('INSERT OR IGNORE INTO devices (name) VALUES (?)', (name,))
+                conn.commit()
+                device_id = conn.execute('SELECT id FROM devices WHERE name = ?', (name,)).fetchone()[0]
+            finally:
+                conn.close()
+            _device_ids[key] = device_id
+        return device_id
+
+
+_tag_set_ids = {}
+
+def get_tag_set_id(database, device_id, names):
+    """Return the id of a device's tag layout (list of tag names), registering it on first use."""
+    names = json.dumps(list(names))
+    key = (database, device_id, names)
+    with _device_lock:
+        tag_set = _tag_set_ids.get(key)
+        if tag_set is None:
+            conn = sqlite3.connect(database)
+            try:
+                initialize_schema(conn)
+                conn.execute('INSERT OR IGNORE INTO tag_sets (device_id, names) VALUES (?, ?)', (device_id, names))
+                conn.commit()
+                tag_set = conn.execute('SELECT id FROM tag_sets WHERE device_id = ? AND names = ?',
+                                       (device_id, names)).fetchone()[0]
+            finally:
+                conn.close()
+            _tag_set_ids[key] = tag_set
+        return tag_set
+
+def tag_set_names(conn, tag_set):
+    """Tag names of a tag_values layout, in blob order; None if unknown."""
+    row = conn.execute('SELECT names FROM tag_sets WHERE id = ?', (tag_set,)).fetchone()
+    return None if row is None else json.loads(row[0])
+
+
+# --- Writing ---
+def timestamp_ms(when=None):
+    """Convert a unix time in seconds (default: now) to integer milliseconds."""
+    return int((time.time() if when is None else when) * 1000)
+
+def sample_row(device_id, registers, inputs, ts=None, tag_set=None, tag_values=None):
+    """Build the parameter tuple for SAMPLE_INSERT_SQL."""
+    return (
+        device_id,
+        timestamp_ms() if ts is None else ts,
+        None if registers is None else pack_registers(registers),
+        None if inputs is None else pack_bits(inputs),
+        0 if inputs is None else len(inputs),
+        None if tag_values is None else tag_set,
+        None if tag_values is None else pack_values(tag_values),
+    )
+
+def store_sample(database, device_name, registers, inputs, ts=None, tag_names=None, tag_values=None):
+    """
+    Queue one packed sample row on the database's batched writer. tag_values,
+    if given, are the engineering values of the tags named in tag_names.
+    """
+    device_id = get_device_id(database, device_name)
+    tag_set = None if tag_values is None else get_tag_set_id(database, device_id, tag_names)
+    row = sample_row(device_id, registers, inputs, ts, tag_set, tag_values)
+    return get_writer(database).submit(SAMPLE_INSERT_SQL, row)
+
+
+# --- Reading ---
+def _range_cursor(conn, columns, device_id, start_ms, end_ms):
+    """Run a time-ordered range scan over one device's samples (served by the primary key)."""
+    query = f'SELECT {columns} FROM samples WHERE device_id = ?'
+    params = [device_id]
+    if start_ms is not None:
+        query += ' AND ts >= ?'
+        params.append(start_ms)
+    if end_ms is not None:
+        query += ' AND ts < ?'
+        params.append(end_ms)
+    return conn.execute(query + ' ORDER BY ts', params)
+
+def iter_samples(conn, device_id, start_ms=None, end_ms=None, chunk_size=1000):
+    """
+    Yield (ts, registers_view, inputs_blob, input_count) in time order.
+    Rows are fetched in chunks so large ranges never load into memory at once.
+    """
+    cursor = _range_cursor(conn, 'ts, registers, inputs, input_count', device_id, start_ms, end_ms)
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            return
+        for ts, registers, inputs, input_count in rows:
+            yield ts, unpack_registers(registers), inputs, input_count
+
+def iter_sample_chunks(conn, device_id, start_ms=None, end_ms=None, chunk_size=1000,
+                       columns='ts, registers, inputs, input_count'):
+    """
+    Yield (timestamps, register_blobs, input_blobs, input_counts) tuples of up
+    to chunk_size rows in time order, for callers that unpack whole chunks at
+    once. columns picks other samples columns, one tuple entry each.
+    """
+    cursor = _range_cursor(conn, columns, device_id, start_ms, end_ms)
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            return
+        yield tuple(zip(*rows))
+
+def find_device_id(conn, name):
+    """Look up a device id by name without registering it; None if unknown."""
+    row = conn.execute('SELECT id FROM devices WHERE name = ?', (name,)).fetchone()
+    return None if row is None else row[0]
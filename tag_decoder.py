@@ -0,0 +1,158 @@
+"""
+Vectorized tag decoding: turns the raw registers/bits of a whole scan into
+engineering values with NumPy, instead of a struct call per tag.
+
+A TagDecoder is compiled once per read plan (or per fixed register block).
+Every scan then copies the raw blocks into one uint16 buffer and, for each
+group of tags sharing a type and byte order, gathers their words with a
+single fancy index, reinterprets the bytes as the target dtype, applies
+bitfields and scale/offset, and scatters the results into one float64 array
+aligned with the tag list. The rules are those of read_plan.decode_tag.
+
+Values are float64 so they can share one array with NaN for points that
+were not read; 64-bit integers above 2**53 lose their lowest bits.
+"""
+from collections import namedtuple
+import numpy as np
+
+# numpy type code of each register type; combined with '>' or '<' per group
+_DTYPE_CODES = {
+    'uint16': 'u2', 'int16': 'i2', 'uint32': 'u4', 'int32': 'i4',
+    'float32': 'f4', 'uint64': 'u8', 'int64': 'i8', 'float64': 'f8',
+}
+
+Source = namedtuple('Source', 'function_code address count')
+Layout = namedtuple('Layout', 'names bools ints floats')
+
+
+def output_layout(tags):
+    """Names and per-kind index arrays used by to_dict(); build once per tag list."""
+    kinds = [tag.kind for tag in tags]
+    return Layout([tag.name for tag in tags],
+                  *(np.array([i for i, kind in enumerate(kinds) if kind == wanted], dtype=np.intp)
+                    for wanted in ('bool', 'int', 'float')))
+
+def to_dict(layout, values, valid):
+    """Map tag name -> Python bool/int/float for every valid entry of a decoded array."""
+    result = {}
+    names = layout.names
+    for indices, cast in ((layout.bools, bool), (layout.ints, int), (layout.floats, float)):
+        indices = indices[valid[indices]]
+        if len(indices):
+            result.update(zip((names[i] for i in indices.tolist()), map(cast, values[indices].tolist())))
+    return result
+
+
+class _Group:
+    """Tags decoded together: same register type and byte order."""
+
+    def __init__(self, type, byte_order, members):
+        # byte_order only swaps the bytes inside each word; the words, once laid out
+        # in value order, always read as a big-endian number
+        self.dtype = np.dtype('>' + _DTYPE_CODES[type])
+        self.word_dtype = np.dtype('>u2' if byte_order == 'big' else '<u2')
+        # Words of each tag in the order they form the value; word_order='little' is reversed
+        self.positions = np.array([positions for _, _, positions in members], dtype=np.intp)
+        self.sources = np.array([source for _, source, _ in members], dtype=np.intp)
+        self.targets = np.array([index for index, _, _ in members], dtype=np.intp)
+        self.bitfields = None  # positions within the group of tags with bits, set by TagDecoder
+
+
+class TagDecoder:
+    """
+    Decodes tags from the raw values of a fixed list of sources (reads or
+    blocks, see Source). Each tag must lie entirely inside one source of its
+    function code.
+    """
+
+    def __init__(self, tags, sources):
+        self.tags = list(tags)
+        self.sources = [Source(*source) for source in sources]
+        self.layout = output_layout(self.tags)
+        self._counts = [source.count for source in self.sources]
+        self._offsets = np.cumsum([0] + self._counts)
+        self.word_count = int(self._offsets[-1])
+        self._filler = [0] * max(self._counts, default=0)
+
+        grouped = {}
+        for index, tag in enumerate(self.tags):
+            source = self._locate(tag)
+            start = int(self._offsets[source]) + tag.address - self.sources[source].address
+            positions = list(range(start, start + tag.width))
+            if tag.word_order == 'little':
+                positions.reverse()
+            key = ('uint16', 'big') if tag.type == 'bool' else (tag.type, tag.byte_order)
+            grouped.setdefault(key, []).append((index, source, positions))
+        self._groups = [_Group(type, byte_order, members) for (type, byte_order), members in grouped.items()]
+
+        count = len(self.tags)
+        self._scale = np.array([tag.scale for tag in self.tags], dtype=np.float64)
+        self._offset = np.array([tag.offset for tag in self.tags], dtype=np.float64)
+        self._scaled = bool(np.any(self._scale != 1.0) or np.any(self._offset != 0.0))
+        self._shift = np.zeros(count, dtype=np.uint64)
+        self._mask = np.zeros(count, dtype=np.uint64)
+        for i, tag in enumerate(self.tags):
+            if tag.bits is not None:
+                first, width = (tag.bits, 1) if isinstance(tag.bits, int) else tag.bits
+                self._shift[i] = first
+                self._mask[i] = (1 << width) - 1
+        for group in self._groups:
+            selected = np.flatnonzero(self._mask[group.targets])
+            if len(selected):
+                group.bitfields = selected
+
+    @classmethod
+    def for_plan(cls, plan):
+        """Decoder for the tags of a read plan, fed with execute_read_plan* results."""
+        return cls([tag for request in plan for tag in request.tags],
+                   [(request.function_code, request.address, request.count) for request in plan])
+
+    def _locate(self, tag):
+        for i, source in enumerate(self.sources):
+            if (source.function_code == tag.function_code and source.address <= tag.address
+                    and tag.address + tag.width <= source.address + source.count):
+                return i
+        raise ValueError(f"{tag!r} is not covered by any source of the decoder")
+
+    def decode(self, blocks):
+        """
+        Decode one scan. blocks holds the raw values of each source in order
+        (None, or shorter than the source, for reads that failed). Returns
+        (values, valid): a float64 array aligned with self.tags and a bool
+        array marking the tags whose source was read.
+        """
+        # One list -> array conversion for the whole scan; failed reads become zeros
+        flat = []
+        read = []
+        for block, count in zip(blocks, self._counts):
+            ok = block is not None and len(block) >= count
+            flat.extend((block if len(block) == count else block[:count]) if ok else self._filler[:count])
+            read.append(ok)
+        words = np.array(flat, dtype=np.uint16)
+        read = np.array(read, dtype=bool)
+
+        values = np.empty(len(self.tags))
+        valid = np.empty(len(self.tags), dtype=bool)
+        for group in self._groups:
+            # (tags, width) big- or little-endian words whose bytes, in row order, are the value
+            raw = words[group.positions].astype(group.word_dtype)
+            decoded = raw.view(group.dtype).reshape(-1)
+            values[group.targets] = decoded
+            valid[group.targets] = read[group.sources]
+            if group.bitfields is not None:
+                # Bitfields work on the integer before it was widened to float64
+                targets = group.targets[group.bitfields]
+                unsigned = decoded[group.bitfields].astype(np.uint64)  # two's complement for signed types
+                values[targets] = (unsigned >> self._shift[targets]) & self._mask[targets]
+        if self._scaled:
+            values = values * self._scale + self._offset
+        values[~valid] = np.nan
+        return values, valid
+
+    def decode_results(self, results):
+        """decode() for the [(request, values)] list of a plan built with for_plan()."""
+        return self.decode([raw for _, raw in results])
+
+    def values(self, results):
+        """Map tag name -> decoded value for every tag whose read succeeded."""
+        return to_dict(self.layout, *self.decode_results(results))
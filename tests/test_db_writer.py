@@ -0,0 +1,45 @@
+import sqlite3
+import db_writer
+from db_writer import BatchWriter
+
+ROWS = [('INSERT INTO t VALUES (?)', (i,)) for i in range(3)]
+
+
+def failing_writer(monkeypatch, errors):
+    """A writer whose first batches fail with errors, one per attempt, then succeed."""
+    writer = BatchWriter(':memory:', flush_interval=0.001)
+    attempts = []
+
+    def write_batch(conn, rows):
+        attempts.append(rows)
+        if len(attempts) <= len(errors):
+            writer.last_error = errors[len(attempts) - 1]
+            return False
+        return True
+
+    monkeypatch.setattr(writer, '_write_batch', write_batch)
+    return writer, attempts
+
+
+def test_locked_database_is_retried(monkeypatch):
+    locked = sqlite3.OperationalError('database is locked')
+    writer, attempts = failing_writer(monkeypatch, [locked, locked])
+    assert writer._commit(None, ROWS)
+    assert len(attempts) == 3
+    assert writer.stats['dropped'] == 0
+
+
+def test_rows_are_counted_as_dropped_once_retries_run_out(monkeypatch):
+    monkeypatch.setattr(db_writer, 'BATCH_RETRIES', 2)
+    locked = sqlite3.OperationalError('database is locked')
+    writer, attempts = failing_writer(monkeypatch, [locked] * 10)
+    assert not writer._commit(None, ROWS)
+    assert len(attempts) == 3
+    assert writer.stats['dropped'] == len(ROWS)
+
+
+def test_rejected_batches_are_not_retried(monkeypatch):
+    writer, attempts = failing_writer(monkeypatch, [sqlite3.IntegrityError('NOT NULL constraint failed')])
+    assert not writer._commit(None, ROWS)
+    assert len(attempts) == 1
+    assert writer.stats['dropped'] == len(ROWS)
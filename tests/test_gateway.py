@@ -0,0 +1,64 @@
+import asyncio
+from mbap import GATEWAY_TARGET_NO_RESPONSE, exception_pdu
+from server import ModbusGateway
+
+READ = bytes([3, 0, 0, 0, 2])
+RESPONSE = bytes([3, 4, 0, 1, 0, 2])
+
+
+class SlowUpstream:
+    host, port = 'fake', 502
+
+    def __init__(self, response=RESPONSE, error=None):
+        self.requests = 0
+        self.response = response
+        self.error = error
+
+    async def request(self, unit_id, pdu):
+        self.requests += 1
+        await asyncio.sleep(0.05)
+        if self.error is not None:
+            raise self.error
+        return self.response
+
+
+def gateway_with(upstream):
+    gateway = ModbusGateway({1: ('127.0.0.1', 1, 1)})
+    gateway._routes[1] = (upstream, 1)
+    return gateway
+
+
+def test_concurrent_reads_share_one_upstream_request():
+    async def run():
+        upstream = SlowUpstream()
+        gateway = gateway_with(upstream)
+        answers = await asyncio.gather(*(gateway.handle(1, READ) for _ in range(5)))
+        assert answers == [RESPONSE] * 5
+        assert upstream.requests == 1
+        # Now cached
+        assert await gateway.handle(1, READ) == RESPONSE
+        assert upstream.requests == 1
+    asyncio.run(run())
+
+
+def test_cancelling_the_first_reader_does_not_fail_merged_readers():
+    async def run():
+        upstream = SlowUpstream()
+        gateway = gateway_with(upstream)
+        first = asyncio.create_task(gateway.handle(1, READ))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(gateway.handle(1, READ))
+        await asyncio.sleep(0.01)
+        first.cancel()  # its client disconnected
+        assert await second == RESPONSE
+        assert upstream.requests == 1
+    asyncio.run(run())
+
+
+def test_upstream_failure_answers_every_merged_reader_with_a_gateway_error():
+    async def run():
+        gateway = gateway_with(SlowUpstream(error=ConnectionError('gone')))
+        answers = await asyncio.gather(gateway.handle(1, READ), gateway.handle(1, READ))
+        assert answers == [exception_pdu(3, GATEWAY_TARGET_NO_RESPONSE)] * 2
+        assert not gateway._inflight
+    asyncio.run(run())
@@ -0,0 +1,170 @@
+import asyncio
+import struct
+import numpy as np
+import pytest
+import ingest_server
+import storage
+from db_writer import BatchWriter, SpooledWriter
+from ingest_server import (ACK, ACK_FRAME, MALFORMED, REFUSED, STORED, IngestProtocol, IngestServer,
+                           encode_batch, encode_hello)
+
+
+class FakeTransport:
+    def __init__(self):
+        self.written = []
+        self.closed = False
+        self.paused = False
+
+    def get_extra_info(self, name):
+        return ('198.51.100.7', 40000)
+
+    def write(self, data):
+        self.written.append(bytes(data))
+
+    def close(self):
+        self.closed = True
+
+    def is_closing(self):
+        return self.closed
+
+    def pause_reading(self):
+        self.paused = True
+
+    def resume_reading(self):
+        self.paused = False
+
+
+class FakeWriter(SpooledWriter):
+    def __init__(self):
+        self.rows = []
+        self.room = True
+
+    def has_room(self, count):
+        return self.room
+
+    def submit(self, sql, params, timeout=None):
+        self.rows.append(params)
+        return True
+
+
+@pytest.fixture
+def writer(monkeypatch):
+    writer = FakeWriter()
+    monkeypatch.setattr(ingest_server, 'get_writer', lambda database: writer)
+    return writer
+
+
+@pytest.fixture
+def server(writer):
+    server = IngestServer(':memory:')
+    server.resolve = lambda device, tag_names: (42, 7 if tag_names else None)
+    return server
+
+
+def record(ts, registers, inputs, tags=()):
+    packed = struct.pack('<q', ts) + storage.pack_registers(registers) + storage.pack_bits(inputs)
+    return packed + storage.pack_values(tags) if tags else packed
+
+
+def feed(protocol, data, chunk):
+    """Deliver data the way the event loop would, chunk bytes at a time."""
+    for start in range(0, len(data), chunk):
+        piece = data[start:start + chunk]
+        while piece:
+            buffer = protocol.get_buffer(-1)
+            n = min(len(buffer), len(piece))
+            buffer[:n] = piece[:n]
+            protocol.buffer_updated(n)
+            piece = piece[n:]
+
+
+def acks(transport):
+    return [ACK_FRAME.unpack(frame)[1:] for frame in transport.written]
+
+
+def connect(server, tag_names=()):
+    """A protocol whose HELLO has been resolved."""
+    async def run():
+        protocol = IngestProtocol(server)
+        transport = FakeTransport()
+        protocol.connection_made(transport)
+        feed(protocol, encode_hello('site-7', tag_names), 3)
+        assert transport.paused
+        while protocol.device_id is None:
+            await asyncio.sleep(0.001)
+        assert not transport.paused
+        return protocol, transport
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize('chunk', [1, 7, 1 << 20])
+def test_batches_are_parsed_whatever_the_read_boundaries(server, writer, chunk):
+    protocol, transport = connect(server)
+    records = [record(1000 + i, [i, i + 1], [True, False, True]) for i in range(3)]
+    data = encode_batch(1, 2, 3, 0, records) + encode_batch(2, 2, 3, 0, [])
+    feed(protocol, data, chunk)
+    assert acks(transport) == [(ACK, 1, STORED), (ACK, 2, STORED)]
+    assert writer.rows == [storage.sample_row(42, [i, i + 1], [1, 0, 1], 1000 + i) for i in range(3)]
+    assert not transport.closed
+
+
+def test_tag_values_are_stored_with_the_hello_tag_set(server, writer):
+    protocol, transport = connect(server, ('power', 'flow'))
+    feed(protocol, encode_batch(5, 1, 0, 2, [record(9, [3], [], [1.5, -2.0])]), 1 << 20)
+    assert acks(transport) == [(ACK, 5, STORED)]
+    row = writer.rows[0]
+    assert row[5] == 7
+    assert np.frombuffer(row[6], '<f8').tolist() == [1.5, -2.0]
+
+
+def test_frames_larger_than_the_buffer_grow_it(server, writer):
+    protocol, transport = connect(server)
+    records = [record(i, list(range(100)), []) for i in range(1000)]
+    data = encode_batch(1, 100, 0, 0, records)
+    assert len(data) > ingest_server.INITIAL_BUFFER
+    feed(protocol, data, 4096)
+    assert acks(transport) == [(ACK, 1, STORED)]
+    assert len(writer.rows) == 1000
+
+
+def test_a_batch_that_does_not_match_its_header_is_malformed(server, writer):
+    protocol, transport = connect(server)
+    data = encode_batch(3, 2, 0, 0, [record(1, [1, 2], [])])
+    length, = struct.unpack_from('<I', data)
+    feed(protocol, struct.pack('<I', length + 1) + data[4:] + b'\0', 1 << 20)
+    assert acks(transport) == [(ACK, 3, MALFORMED)]
+    assert writer.rows == []
+    assert not transport.closed
+
+
+def test_a_full_writer_refuses_the_whole_batch(server, writer):
+    protocol, transport = connect(server)
+    writer.room = False
+    feed(protocol, encode_batch(4, 1, 0, 0, [record(1, [1], [])]), 1 << 20)
+    assert acks(transport) == [(ACK, 4, REFUSED)]
+    assert writer.rows == []
+
+
+@pytest.mark.parametrize('data', [
+    struct.pack('<I', 0),
+    struct.pack('<I', ingest_server.MAX_FRAME + 1),
+    struct.pack('<IB', 1, 99),
+])
+def test_invalid_frames_close_the_connection(server, data):
+    protocol, transport = connect(server)
+    feed(protocol, data, 1 << 20)
+    assert transport.closed
+
+
+def test_batch_before_hello_closes_the_connection(server):
+    protocol = IngestProtocol(server)
+    transport = FakeTransport()
+    protocol.connection_made(transport)
+    feed(protocol, encode_batch(1, 1, 0, 0, [record(1, [1], [])]), 1 << 20)
+    assert transport.closed
+
+
+def test_ingest_refuses_to_run_without_a_spool(monkeypatch):
+    monkeypatch.setattr(ingest_server, 'get_writer', lambda database: BatchWriter(database))
+    with pytest.raises(RuntimeError):
+        IngestServer(':memory:')
@@ -0,0 +1,95 @@
+import os
+import pytest
+from latest_cache import (HEADER_SIZE, MAGIC, Q_INPUTS, Q_REGISTERS, LatestCacheReader, LatestCacheWriter,
+                          to_json)
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'latest.cache')
+
+
+def open_writer(path, **kwargs):
+    kwargs.setdefault('max_devices', 4)
+    kwargs.setdefault('register_capacity', 8)
+    kwargs.setdefault('input_capacity', 8)
+    return LatestCacheWriter(path, **kwargs)
+
+
+def test_published_values_are_read_back(path):
+    writer = open_writer(path)
+    reader = LatestCacheReader(path)
+    try:
+        assert reader.read('plc') is None
+        writer.publish('plc', [1, 2, 3], [True, False], timestamp=100.0)
+        writer.publish('rtu', None, [True], timestamp=101.0)
+        value = reader.read('plc')
+        assert value.registers.tolist() == [1, 2, 3]
+        assert value.inputs.tolist() == [True, False]
+        assert value.quality == Q_REGISTERS | Q_INPUTS
+        assert value.seq % 2 == 0
+        assert reader.names() == ['plc', 'rtu']
+        partial = to_json(reader.read('rtu'), now=200.0)
+        assert partial['quality'] == {'registers': False, 'inputs': True, 'stale': True}
+    finally:
+        reader.close()
+        writer.close()
+
+
+def test_second_writer_is_refused(path):
+    writer = open_writer(path)
+    try:
+        with pytest.raises(RuntimeError):
+            open_writer(path)
+    finally:
+        writer.close()
+
+
+def test_restarted_writer_keeps_the_header_and_bumps_the_generation(path):
+    writer = open_writer(path)
+    writer.publish('plc', [1], [True])
+    reader = LatestCacheReader(path)
+    writer.close()
+
+    # A mapped reader must never see the header zeroed while the new writer resets the slots
+    writer = open_writer(path, register_capacity=16)
+    try:
+        with open(path, 'rb') as f:
+            assert f.read(4) == MAGIC
+        assert reader.read('plc') is None
+        writer.publish('rtu', list(range(16)), [])
+        assert reader.read('rtu').registers.tolist() == list(range(16))
+    finally:
+        reader.close()
+        writer.close()
+
+
+def test_reader_recovers_from_an_uninitialized_segment(path):
+    writer = open_writer(path)
+    writer.publish('plc', [7], [])
+    reader = LatestCacheReader(path)
+    writer.close()
+
+    with open(path, 'r+b') as f:
+        f.write(bytes(HEADER_SIZE))   # what an older publisher left while starting up
+    try:
+        with pytest.raises(ValueError):
+            reader.read('plc')
+        with pytest.raises(ValueError):
+            reader.names()            # still failing, but not with a stale mapping
+
+        writer = open_writer(path)
+        try:
+            writer.publish('plc', [9], [])
+            assert reader.read('plc').registers.tolist() == [9]
+        finally:
+            writer.close()
+    finally:
+        reader.close()
+
+
+def test_reader_refuses_an_empty_file(path):
+    open(path, 'wb').close()
+    with pytest.raises(FileNotFoundError):
+        LatestCacheReader(path)
+    assert os.path.getsize(path) == 0
@@ -0,0 +1,43 @@
+import modbus_pool
+from modbus_pool import ModbusConnectionPool
+
+
+class FakeClient:
+    def __init__(self, host, port, timeout):
+        self.open = False
+        self.closed = 0
+
+    def is_socket_open(self):
+        return self.open
+
+    def connect(self):
+        self.open = True
+        return True
+
+    def close(self):
+        self.open = False
+        self.closed += 1
+
+
+def test_an_entry_evicted_before_checkout_is_replaced(monkeypatch):
+    monkeypatch.setattr(modbus_pool, 'ModbusTcpClient', FakeClient)
+    pool = ModbusConnectionPool(idle_timeout=0)
+    with pool.connection('plc', 502, 1):
+        pass
+    evicted = pool._connections[('plc', 502, 1)]
+
+    get_entry = pool._get_entry
+
+    def evict_in_the_gap(*key):
+        entry = get_entry(*key)
+        if entry is evicted:
+            pool.evict_idle(force=True)   # runs after the pool lock is released, before entry.lock
+        return entry
+
+    monkeypatch.setattr(pool, '_get_entry', evict_in_the_gap)
+    with pool.connection('plc', 502, 1) as client:
+        assert client is not evicted.client
+        assert client.is_socket_open()
+        assert pool._connections[('plc', 502, 1)].client is client
+    assert evicted.client.closed == 1
+    assert pool.stats()['evictions'] == 1
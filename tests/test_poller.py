@@ -0,0 +1,47 @@
+import asyncio
+import poller
+from poller import AsyncPoller, Device
+
+
+class SlowClient:
+    connected = True
+
+    def __init__(self, delay):
+        self.delay = delay
+
+    def close(self):
+        pass
+
+
+async def slow_execute(client, plan, slave):
+    await asyncio.sleep(client.delay)
+    return [(request, [0] * request.count) for request in plan]
+
+
+def test_scans_starved_by_the_concurrency_limit_count_as_missed(monkeypatch):
+    original = poller._DeviceState.__init__
+
+    def fake_state(self, device, timeout):
+        original(self, device, timeout)
+        self.client.close()
+        self.client = SlowClient(0.5 if device.name == 'slow' else 0.01)
+        self.execute = slow_execute
+
+    monkeypatch.setattr(poller._DeviceState, '__init__', fake_state)
+    # The slow device holds the only read slot long enough to starve several fast cycles
+    slow = Device('slow', '127.0.0.1', interval=1.0, reg_count=2, input_count=0)
+    fast = Device('fast', '127.0.0.1', interval=0.1, reg_count=2, input_count=0)
+    samples = []
+    p = AsyncPoller([slow, fast], lambda device, data: samples.append(device.name), max_concurrency=1)
+
+    async def run():
+        asyncio.get_running_loop().call_later(0.9, p.stop)
+        await p.run()
+    asyncio.run(run())
+
+    stats = p.stats['fast']
+    assert stats.missed_cycles >= 2
+    assert stats.timeouts == 0
+    assert stats.polls == samples.count('fast')
+    # Every cycle either delivered a sample or was counted as missed
+    assert stats.polls + stats.missed_cycles >= stats.scans['device'].runs
@@ -0,0 +1,86 @@
+import pytest
+from read_plan import (MAX_REGISTERS_PER_READ, Tag, build_read_plan, execute_read_plan, read_block, response_values,
+                       tag_values)
+
+
+class Response:
+    def __init__(self, registers=None, bits=None, error=False):
+        self.registers = registers
+        self.bits = bits
+        self.error = error
+
+    def isError(self):
+        return self.error
+
+
+class FakeClient:
+    """Serves registers[address] = address and bits[address] = address % 3 == 0."""
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.calls = []
+
+    def _read(self, function_code, address, count, slave):
+        self.calls.append((function_code, address, count))
+        if function_code in self.failing:
+            return Response(error=True)
+        if function_code in (1, 2):
+            return Response(bits=[(address + i) % 3 == 0 for i in range(count)] + [False] * 3)
+        return Response(registers=[address + i for i in range(count)])
+
+    def read_coils(self, address, count, slave):
+        return self._read(1, address, count, slave)
+
+    def read_discrete_inputs(self, address, count, slave):
+        return self._read(2, address, count, slave)
+
+    def read_holding_registers(self, address, count, slave):
+        return self._read(3, address, count, slave)
+
+    def read_input_registers(self, address, count, slave):
+        return self._read(4, address, count, slave)
+
+
+def test_neighbouring_tags_share_a_request_within_the_gap():
+    plan = build_read_plan([Tag('a', 3, 0), Tag('b', 3, 5, 'float32'), Tag('c', 3, 20), Tag('d', 2, 3)],
+                           max_register_gap=8)
+    assert [(r.function_code, r.address, r.count) for r in plan] == [(2, 3, 1), (3, 0, 7), (3, 20, 1)]
+    assert [t.name for t in plan[1].tags] == ['a', 'b']
+
+
+def test_requests_stay_within_the_protocol_limit():
+    tags = [Tag(f'r{i}', 4, i) for i in range(MAX_REGISTERS_PER_READ + 10)]
+    plan = build_read_plan(tags)
+    assert [(r.address, r.count) for r in plan] == [(0, MAX_REGISTERS_PER_READ), (MAX_REGISTERS_PER_READ, 10)]
+
+
+@pytest.mark.parametrize('make', [
+    lambda: build_read_plan([Tag('a', 3, 0), Tag('a', 3, 1)]),
+    lambda: Tag('a', 2, 0, 'uint16'),
+    lambda: Tag('a', 3, 0, 'float16'),
+    lambda: Tag('a', 5, 0),
+    lambda: Tag('a', 3, 0, 'float32', bits=1),
+    lambda: Tag('a', 3, 0, 'uint16', bits=(12, 8)),
+])
+def test_invalid_tags_and_plans_are_refused(make):
+    with pytest.raises(ValueError):
+        make()
+
+
+def test_executing_a_plan_reassembles_blocks_and_values():
+    plan = build_read_plan([Tag('r', 3, 10), Tag('s', 3, 12), Tag('i', 2, 0), Tag('j', 2, 3)])
+    client = FakeClient()
+    results = execute_read_plan(client, plan, slave=1)
+    assert client.calls == [(2, 0, 4), (3, 10, 3)]
+    assert read_block(results, 3, 10, 3) == [10, 11, 12]
+    assert read_block(results, 2, 0, 4) == [True, False, False, True]   # padding bits trimmed
+    assert read_block(results, 3, 9, 2) is None                          # 9 was not read
+    assert tag_values(results) == {'r': 10, 's': 12, 'i': True, 'j': True}
+
+
+def test_failed_and_short_responses_have_no_values():
+    plan = build_read_plan([Tag('r', 3, 0), Tag('i', 2, 0)])
+    results = execute_read_plan(FakeClient(failing={3}), plan, slave=1)
+    assert [values for _, values in results] == [[True], None]
+    assert tag_values(results) == {'i': True}
+    assert response_values(plan[1], Response(registers=[])) is None
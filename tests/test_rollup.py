@@ -0,0 +1,97 @@
+import sqlite3
+import numpy as np
+import pytest
+import rollup
+import storage
+from rollup import DAY_MS, HOUR_MS, MINUTE_MS
+
+NOW = 1000 * DAY_MS
+
+
+@pytest.fixture
+def conn(tmp_path, monkeypatch):
+    monkeypatch.setattr(rollup, 'RETENTION_PAUSE', 0)
+    conn = sqlite3.connect(tmp_path / 'rollup.db')
+    storage.initialize_schema(conn)
+    rollup.initialize_rollups(conn)
+    conn.execute("INSERT INTO devices (id, name) VALUES (1, 'plc')")
+    conn.commit()
+    yield conn
+    conn.close()
+
+
+def insert(conn, ts, value):
+    with conn:
+        conn.execute(storage.SAMPLE_INSERT_SQL, storage.sample_row(1, [value], [value % 2 == 1], ts))
+
+
+def minute_stats(conn, ts):
+    row = conn.execute('SELECT reg_sum, reg_count FROM rollup_1m WHERE device_id = 1 AND ts = ?',
+                       (ts,)).fetchone()
+    return np.frombuffer(row[0], '<f8')[0], np.frombuffer(row[1], '<u4')[0]
+
+
+def test_rollups_aggregate_raw_samples_into_buckets(conn):
+    start = NOW - HOUR_MS
+    for i in range(6):
+        insert(conn, start + i * 20 * 1000, i)   # three samples per minute
+    written = rollup.run_rollups(conn, NOW)
+    assert written['1m'] == 2
+    assert minute_stats(conn, start) == (0 + 1 + 2, 3)
+    assert minute_stats(conn, start + MINUTE_MS) == (3 + 4 + 5, 3)
+    assert rollup.get_hwm(conn, '1m', 1) == NOW - rollup.ROLLUP_LAG_MS
+
+
+def test_late_samples_behind_the_mark_are_rolled_up_again(conn):
+    start = NOW - HOUR_MS
+    insert(conn, start, 10)
+    rollup.run_rollups(conn, NOW)
+    assert minute_stats(conn, start) == (10, 1)
+
+    insert(conn, start + 30 * 1000, 5)           # replayed from the spool after the pass
+    assert rollup.get_dirty(conn, '1m', 1) == start + 30 * 1000
+    rollup.run_rollups(conn, NOW + MINUTE_MS)
+    assert minute_stats(conn, start) == (15, 2)
+    assert rollup.get_dirty(conn, '1m', 1) is None
+    assert rollup.get_hwm(conn, '1m', 1) == NOW + MINUTE_MS - rollup.ROLLUP_LAG_MS
+
+
+def test_late_samples_propagate_to_coarser_tiers(conn):
+    start = NOW - 3 * DAY_MS
+    insert(conn, start, 10)
+    rollup.run_rollups(conn, NOW)
+    insert(conn, start + HOUR_MS, 5)
+    rollup.run_rollups(conn, NOW)
+    row = conn.execute('SELECT reg_sum FROM rollup_1d WHERE device_id = 1 AND ts = ?',
+                       (start // DAY_MS * DAY_MS,)).fetchone()
+    assert np.frombuffer(row[0], '<f8')[0] == 15
+
+
+def test_retention_keeps_late_samples_until_they_are_rolled_up(conn, monkeypatch):
+    monkeypatch.setitem(rollup.RETENTION_MS, 'raw', HOUR_MS)
+    old = NOW - 30 * MINUTE_MS
+    insert(conn, old, 1)
+    rollup.run_rollups(conn, NOW)
+
+    insert(conn, old + 1000, 2)                  # late, and retention has caught up with it
+    rollup.apply_retention(conn, NOW + HOUR_MS)
+    assert conn.execute('SELECT count(*) FROM samples WHERE ts = ?', (old + 1000,)).fetchone()[0] == 1
+
+    rollup.run_rollups(conn, NOW + 10 * MINUTE_MS)
+    assert minute_stats(conn, old) == (3, 2)
+    rollup.apply_retention(conn, NOW + HOUR_MS)
+    assert conn.execute('SELECT count(*) FROM samples').fetchone()[0] == 0
+
+
+def test_samples_past_retention_do_not_replace_complete_buckets(conn, monkeypatch):
+    monkeypatch.setitem(rollup.RETENTION_MS, 'raw', HOUR_MS)
+    old = NOW - 2 * HOUR_MS
+    insert(conn, old, 1)
+    insert(conn, old + 1000, 2)
+    rollup.run_rollups(conn, NOW)
+    rollup.apply_retention(conn, NOW)
+
+    insert(conn, old + 2000, 4)                  # its bucket's other samples are gone
+    rollup.run_rollups(conn, NOW)
+    assert minute_stats(conn, old) == (3, 2)
+    assert rollup.get_dirty(conn, '1m', 1) is None
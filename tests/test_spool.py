@@ -0,0 +1,108 @@
+import marshal
+import pytest
+import spool
+from spool import RECORD, Spool, SpoolFull
+
+SQL = 'INSERT INTO t VALUES (?)'
+
+
+def fill_exactly(s):
+    """Append one row whose record ends exactly on the segment boundary."""
+    offset = s.write_position % s.segment_size
+    params = (b'x' * (s.segment_size - offset - RECORD.size - len(marshal.dumps((b'',)))),)
+    assert offset + RECORD.size + len(marshal.dumps(params)) == s.segment_size
+    s.append(SQL, params)
+
+
+def read_all(s):
+    rows, position, last_seq = s.read(s.read_position, 10000)
+    return rows, position, last_seq
+
+
+def test_append_read_commit_roundtrip(tmp_path):
+    s = Spool(str(tmp_path), segment_size=4096)
+    for i in range(100):
+        s.append(SQL, (i, 'row'))
+    rows, position, last_seq = read_all(s)
+    assert [params for _, params in rows] == [(i, 'row') for i in range(100)]
+    assert all(sql == SQL for sql, _ in rows)
+    assert s.pending_rows() == 100
+    s.commit(position, last_seq)
+    assert s.pending_rows() == 0
+    assert read_all(s)[0] == []
+    s.close()
+
+
+def test_record_exactly_filling_a_segment(tmp_path):
+    s = Spool(str(tmp_path), segment_size=256)
+    s.append(SQL, (1,))
+    fill_exactly(s)
+    s.append(SQL, (3,))
+    s.append(SQL, (4,))
+    rows, position, last_seq = read_all(s)
+    assert [params[0] for _, params in rows][2:] == [3, 4]
+    assert len(rows) == 4
+    s.commit(position, last_seq)
+    assert s.pending_rows() == 0
+    s.close()
+
+
+def test_rows_survive_reopen_and_cursor_is_kept(tmp_path):
+    s = Spool(str(tmp_path), segment_size=512)
+    for i in range(50):
+        s.append(SQL, (i,))
+    rows, position, last_seq = s.read(s.read_position, 20)
+    s.commit(position, last_seq)
+    s.close()
+
+    s = Spool(str(tmp_path), segment_size=512)
+    rows, _, _ = read_all(s)
+    assert [params[0] for _, params in rows] == list(range(20, 50))
+    s.append(SQL, (50,))
+    assert read_all(s)[0][-1][1] == (50,)
+    s.close()
+
+
+def test_torn_record_is_dropped_on_recovery(tmp_path):
+    s = Spool(str(tmp_path), segment_size=4096)
+    s.append(SQL, (1,))
+    s.append(SQL, (2,))
+    # Corrupt the payload of the last record, as a crash halfway through a write would
+    mm = s._segments[1]
+    end = s.write_position % s.segment_size
+    mm[end - 1] ^= 0xFF
+    s.close()
+
+    s = Spool(str(tmp_path), segment_size=4096)
+    assert [params for _, params in read_all(s)[0]] == [(1,)]
+    s.append(SQL, (3,))
+    assert [params for _, params in read_all(s)[0]] == [(1,), (3,)]
+    s.close()
+
+
+def test_full_spool_refuses_rows(tmp_path):
+    s = Spool(str(tmp_path), segment_size=256, max_bytes=512)
+    with pytest.raises(SpoolFull):
+        for i in range(1000):
+            s.append(SQL, (i, 'x' * 20))
+    s.close()
+
+
+def test_second_process_is_locked_out(tmp_path):
+    s = Spool(str(tmp_path))
+    with pytest.raises(RuntimeError):
+        spool.Spool(str(tmp_path))
+    s.close()
+
+
+def test_spooled_writer_submit_drops_rows_the_spool_cannot_take(tmp_path, monkeypatch):
+    import db_writer
+    s = Spool(str(tmp_path / 'spool'))
+    writer = db_writer.SpooledWriter(str(tmp_path / 'x.db'), s)
+
+    def fail(*args, **kwargs):
+        raise OSError('disk gone')
+    monkeypatch.setattr(s, 'append', fail)
+    assert writer.submit(SQL, (1,)) is False
+    assert writer.stats['dropped'] == 1
+    s.close()
@@ -0,0 +1,61 @@
+import math
+import struct
+import pytest
+from read_plan import Tag, build_read_plan, decode_tag, tag_values
+from tag_decoder import TagDecoder
+
+
+def words(fmt, value):
+    """Big-endian registers of a packed value."""
+    packed = struct.pack(fmt, value)
+    return list(struct.unpack(f'>{len(packed) // 2}H', packed))
+
+
+TYPED_TAGS = [
+    (Tag('u16', 3, 0), [7]),
+    (Tag('i16', 3, 1, 'int16'), words('>h', -5)),
+    (Tag('f32', 3, 2, 'float32'), words('>f', 1.5)),
+    (Tag('f32_swapped', 3, 4, 'float32', word_order='little'), words('>f', -2.25)[::-1]),
+    (Tag('u32_bytes', 3, 6, 'uint32', byte_order='little'), [0x3412, 0x7856]),
+    (Tag('i64', 3, 8, 'int64'), words('>q', -123456789)),
+    (Tag('f64', 3, 12, 'float64'), words('>d', math.pi)),
+    (Tag('flag', 3, 16, bits=3), [0b1000]),
+    (Tag('field', 3, 17, bits=(4, 4)), [0xA5]),
+    (Tag('signed_field', 3, 18, 'int16', bits=(12, 4)), words('>h', -1)),
+    (Tag('scaled', 3, 19, 'int16', scale=0.1, offset=-40), words('>h', 655)),
+    (Tag('coil', 1, 0), [True]),
+]
+
+
+def test_vectorized_decoder_matches_the_reference_decoder():
+    tags = [tag for tag, _ in TYPED_TAGS]
+    registers = [0] * 20
+    for tag, raw in TYPED_TAGS:
+        if tag.function_code == 3:
+            registers[tag.address:tag.address + tag.width] = raw
+    plan = build_read_plan(tags)
+    results = [(request, registers[request.address:request.address + request.count]
+                if request.function_code == 3 else [True]) for request in plan]
+
+    expected = tag_values(results)
+    assert expected['f32_swapped'] == -2.25
+    assert expected['u32_bytes'] == 0x12345678
+    assert expected['field'] == 0xA
+    assert expected['signed_field'] == 0xF
+    assert expected['scaled'] == pytest.approx(25.5)
+    assert TagDecoder.for_plan(plan).values(results) == pytest.approx(expected)
+    assert {tag.name: decode_tag(tag, raw) for tag, raw in TYPED_TAGS} == pytest.approx(expected)
+
+
+def test_decoder_marks_tags_of_failed_reads_invalid():
+    plan = build_read_plan([Tag('r', 3, 0, 'float32'), Tag('c', 1, 0)])
+    decoder = TagDecoder.for_plan(plan)
+    values, valid = decoder.decode_results([(plan[0], [True]), (plan[1], None)])
+    assert valid.tolist() == [True, False]
+    assert math.isnan(values[1])
+    assert decoder.values([(plan[0], [True]), (plan[1], None)]) == {'c': True}
+
+
+def test_decoder_refuses_tags_outside_its_sources():
+    with pytest.raises(ValueError):
+        TagDecoder([Tag('r', 3, 10, 'uint32')], [(3, 0, 11)])
@@ -0,0 +1,147 @@
+import itertools
+import threading
+from contextlib import contextmanager
+import pytest
+import writes
+from writes import DONE, FAILED, DeviceWriteQueue, _TokenBucket
+
+_names = itertools.count()
+
+
+class OK:
+    def isError(self):
+        return False
+
+
+class FakeClient:
+    def __init__(self):
+        self.calls = []
+        self.fail = None
+
+    def _call(self, name, address, values):
+        if self.fail is not None:
+            error, self.fail = self.fail, None
+            raise error
+        self.calls.append((name, address, values))
+        return OK()
+
+    def write_registers(self, address, values, slave):
+        return self._call('write_registers', address, list(values))
+
+    def write_register(self, address, value, slave):
+        return self._call('write_register', address, value)
+
+    def write_coils(self, address, values, slave):
+        return self._call('write_coils', address, list(values))
+
+    def write_coil(self, address, value, slave):
+        return self._call('write_coil', address, value)
+
+
+@pytest.fixture
+def client(monkeypatch):
+    client = FakeClient()
+
+    class Pool:
+        @contextmanager
+        def connection(self, host, port, slave):
+            yield client
+
+    monkeypatch.setattr(writes, 'get_pool', Pool)
+    return client
+
+
+@pytest.fixture
+def queue(client):
+    queue = DeviceWriteQueue(f'test-{next(_names)}', 'fake', 502, 1, rate_limit=None, linger=0.05)
+    yield queue
+    queue.close()
+
+
+def test_writes_to_a_queued_point_coalesce_into_one_frame(queue, client):
+    first = queue.submit('register', 0, [1, 2])
+    second = queue.submit('register', 1, [5])
+    third = queue.submit('register', 2, [3])
+    assert writes.wait_all([first, second, third], timeout=2)
+    assert client.calls == [('write_registers', 0, [1, 5, 3])]
+    assert first.superseded == 1
+    assert (first.state, second.state, third.state) == (DONE, DONE, DONE)
+
+
+def test_registers_go_out_before_coils_and_lone_points_use_single_writes(queue, client):
+    coil = queue.submit('coil', 7, [1])
+    register = queue.submit('register', 40, [9])
+    assert writes.wait_all([coil, register], timeout=2)
+    assert client.calls == [('write_register', 40, 9), ('write_coil', 7, True)]
+
+
+def test_runs_are_split_at_the_per_request_limit_and_at_gaps(queue, client, monkeypatch):
+    monkeypatch.setitem(writes.MAX_PER_WRITE, 'register', 2)
+    ticket = queue.submit('register', 0, [1, 2, 3])
+    other = queue.submit('register', 10, [4, 5])
+    assert writes.wait_all([ticket, other], timeout=2)
+    assert client.calls == [('write_registers', 0, [1, 2]), ('write_register', 2, 3),
+                            ('write_registers', 10, [4, 5])]
+
+
+def test_any_failure_fails_only_that_frames_tickets(queue, client):
+    client.fail = RuntimeError('socket gone')
+    failed = queue.submit('register', 0, [1])
+    assert failed.wait(2)
+    assert failed.state == FAILED
+    assert 'socket gone' in failed.error
+
+    later = queue.submit('register', 0, [2])
+    assert later.wait(2)
+    assert later.state == DONE
+    assert client.calls == [('write_register', 0, 2)]
+
+
+def test_a_dead_worker_is_restarted(queue, client):
+    dead = threading.Thread(target=lambda: None)
+    dead.start()
+    dead.join()
+    queue._thread = dead
+    ticket = queue.submit('coil', 0, [True, False])
+    assert ticket.wait(2)
+    assert client.calls == [('write_coils', 0, [True, False])]
+
+
+def test_malformed_and_forbidden_writes_are_refused(client):
+    queue = DeviceWriteQueue(f'test-{next(_names)}', 'fake', 502, 1, writable={'register': [(100, 10)]})
+    with pytest.raises(ValueError):
+        queue.check('holding', 0, [1])
+    with pytest.raises(ValueError):
+        queue.check('register', 100, [70000])
+    with pytest.raises(ValueError):
+        queue.check('coil', 0, [2])
+    with pytest.raises(PermissionError):
+        queue.check('register', 105, [1] * 6)
+    with pytest.raises(PermissionError):
+        queue.check('coil', 0, [1])
+    queue.check('register', 100, [1] * 10)
+
+
+def test_full_queue_raises(client):
+    queue = DeviceWriteQueue(f'test-{next(_names)}', 'fake', 502, 1, rate_limit=None, linger=1.0, max_pending=3)
+    try:
+        queue.submit('register', 0, [1, 2])
+        with pytest.raises(writes.QueueFull):
+            queue.submit('register', 5, [1, 2])
+        queue.submit('register', 1, [3])   # overwrites a queued point, still counts against the limit
+    finally:
+        queue.close()
+
+
+def test_token_bucket_paces_after_the_burst():
+    now = [0.0]
+    slept = []
+
+    def sleep(seconds):
+        slept.append(seconds)
+        now[0] += seconds
+
+    bucket = _TokenBucket(10.0, 2, clock=lambda: now[0], sleep=sleep)
+    for _ in range(4):
+        bucket.wait()
+    assert slept == pytest.approx([0.1, 0.1])
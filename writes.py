@@ -0,0 +1,367 @@
+"""
+Batched, coalescing writes of coils and holding registers.
+
+Each device gets a queue of the points waiting to be written and one worker
+thread that drains it. A write to a point that is still queued replaces the
+queued value, so only the latest value goes out. The worker writes the
+lowest contiguous run of queued addresses as one FC16 (registers) or FC15
+(coils) request, up to the protocol's per-request limit, and a lone point as
+FC06/FC05. Requests are paced by a per-device token bucket. While the
+worker waits for a token, more writes coalesce into the queue, so a burst
+takes as few frames as the addresses allow.
+
+Within a batch, registers go out before coils, so a setpoint lands before
+the command bit that acts on it. Otherwise no order is kept between
+different points. Every submit() returns a WriteTicket that completes once
+all of its points have been written, either with its own values or with the
+value of a later write.
+"""
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict
+from pymodbus.exceptions import ModbusException
+import metrics
+from modbus_pool import get_pool
+
+# --- Configuration ---
+MAX_REGISTERS_PER_WRITE = 123   # FC16
+MAX_COILS_PER_WRITE = 1968      # FC15
+RATE_LIMIT = 20.0               # Write requests per second per device (None = unlimited)
+RATE_BURST = 5                  # Requests that may go out back to back after an idle spell
+LINGER = 0.02                   # Seconds an idle queue waits after the first write for the rest of a burst
+MAX_PENDING = 10000             # Points a device queue holds before refusing writes
+WRITE_TIMEOUT = 10.0            # Seconds callers wait for completion by default
+TICKET_HISTORY = 1000           # Finished tickets kept for find_ticket()
+
+KINDS = ('register', 'coil')    # in the order a batch is written
+MAX_PER_WRITE = {'register': MAX_REGISTERS_PER_WRITE, 'coil': MAX_COILS_PER_WRITE}
+
+# Ticket states
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    """The device queue already holds MAX_PENDING points."""
+
+
+class WriteTicket:
+    """
+    Completion handle of one submitted write. superseded counts the points
+    that a later write overwrote before they went out.
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, device, kind, address, count):
+        self.id = next(self._ids)
+        self.device = device
+        self.kind = kind
+        self.address = address
+        self.count = count
+        self.state = PENDING
+        self.error = None
+        self.superseded = 0
+        self.submitted = time.monotonic()
+        self.latency = None
+        self._remaining = count
+        self._done = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def wait(self, timeout=None):
+        """Block until the write completed; returns False on timeout."""
+        return self._done.wait(timeout)
+
+    def done(self):
+        return self._done.is_set()
+
+    def add_done_callback(self, function):
+        """Call function(ticket) on completion, from the device's worker thread (now if already done)."""
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(function)
+                return
+        function(self)
+
+    def _point_done(self, error):
+        """Count one point as written (or failed); returns True when that completed the ticket."""
+        if error is not None and self.error is None:
+            self.error = error
+        self._remaining -= 1
+        if self._remaining:
+            return False
+        self.state = FAILED if self.error is not None else DONE
+        self.latency = time.monotonic() - self.submitted
+        return True
+
+    def _complete(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for function in callbacks:
+            try:
+                function(self)
+            except Exception:
+                logger.exception(f"Write ticket {self.id} callback failed")
+
+    def as_dict(self):
+        return {
+            'id': self.id, 'device': self.device, 'kind': self.kind, 'address': self.address,
+            'count': self.count, 'state': self.state, 'error': self.error, 'superseded': self.superseded,
+            'latency': None if self.latency is None else round(self.latency, 4),
+        }
+
+    def __repr__(self):
+        return f"WriteTicket({self.id}, {self.device!r}, {self.kind} {self.address}+{self.count}, {self.state})"
+
+
+class _TokenBucket:
+    """rate tokens per second, up to burst saved; wait() takes one."""
+
+    def __init__(self, rate, burst, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.clock = clock
+        self.sleep = sleep
+        self._tokens = float(self.burst)
+        self._last = clock()
+
+    def wait(self):
+        if not self.rate:
+            return
+        now = self.clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+        if self._tokens < 1:
+            self.sleep((1 - self._tokens) / self.rate)
+            now = self.clock()
+            self._tokens += (now - self._last) * self.rate
+            self._last = now
+        self._tokens -= 1
+
+
+class DeviceWriteQueue:
+    """
+    Write queue and worker of one device. writable limits what may be
+    written: {kind: [(start, count), ...]}, None allowing every address.
+    """
+
+    def __init__(self, name, host, port, slave, rate_limit=RATE_LIMIT, burst=RATE_BURST,
+                 writable=None, linger=LINGER, max_pending=MAX_PENDING):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.slave = slave
+        self.writable = writable
+        self.linger = linger
+        self.max_pending = max_pending
+        self._bucket = _TokenBucket(rate_limit, burst)
+        self._pending = {kind: {} for kind in KINDS}  # address -> [value, [tickets]]
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        self._points = metrics.WRITE_POINTS.labels(name)
+        self._coalesced = metrics.WRITE_COALESCED.labels(name)
+        self._errors = metrics.WRITE_ERRORS.labels(name)
+        self._latency = metrics.WRITE_LATENCY.labels(name)
+        self._frames = {}
+        metrics.WRITE_QUEUE_DEPTH.set_function(self.depth, name)
+
+    def depth(self):
+        """Points waiting to be written."""
+        return sum(len(pending) for pending in self._pending.values())
+
+    def check(self, kind, address, values):
+        """Raise ValueError or PermissionError for a write submit() would refuse."""
+        if kind not in KINDS:
+            raise ValueError(f"Unknown write kind {kind!r}; expected one of {', '.join(KINDS)}")
+        if not values:
+            raise ValueError("Nothing to write")
+        if not isinstance(address, int) or address < 0 or address + len(values) > 65536:
+            raise ValueError(f"Bad address {address!r} for {len(values)} {kind}s")
+        if kind == 'register':
+            for value in values:
+                if not isinstance(value, int) or isinstance(value, bool) or not 0 <= value <= 0xFFFF:
+                    raise ValueError(f"Register values must be integers 0..65535, got {value!r}")
+        elif any(value not in (0, 1) for value in values):
+            raise ValueError(f"Coil values must be booleans or 0/1, got {values!r}")
+        if self.writable is not None and not any(
+                start <= address and address + len(values) <= start + count
+                for start, count in self.writable.get(kind, ())):
+            raise PermissionError(f"{kind}s {address}..{address + len(values) - 1} of {self.name} are not writable")
+
+    def submit(self, kind, address, values):
+        """
+        Queue values for consecutive points from address; returns a
+        WriteTicket. Raises ValueError for a malformed write, PermissionError
+        outside the writable ranges and QueueFull when the queue is full.
+        """
+        values = list(values)
+        self.check(kind, address, values)
+        if kind == 'coil':
+            values = [bool(value) for value in values]
+        ticket = WriteTicket(self.name, kind, address, len(values))
+        with self._cond:
+            if self._stopping:
+                raise RuntimeError(f"Write queue of {self.name} is closed")
+            pending = self._pending[kind]
+            if self.depth() + len(values) > self.max_pending:
+                raise QueueFull(f"{self.depth()} points of {self.name} are already waiting to be written")
+            superseded = []
+            for offset, value in enumerate(values):
+                entry = pending.get(address + offset)
+                if entry is None:
+                    pending[address + offset] = [value, [ticket]]
+                else:
+                    entry[0] = value
+                    superseded.append(entry[1][-1])  # the ticket whose value this replaces
+                    entry[1].append(ticket)
+            for earlier in superseded:
+                earlier.superseded += 1
+            if self._thread is None or not self._thread.is_alive():
+                if self._thread is not None:
+                    logger.error(f"Write worker of {self.name} died, restarting it")
+                self._thread = threading.Thread(target=self._run, name=f'writes-{self.name}', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        self._points.inc(len(values))
+        if superseded:
+            self._coalesced.inc(len(superseded))
+        return ticket
+
+    # --- Worker ---
+    def _take_frame(self):
+        """Remove and return (kind, address, entries) of the next request to send, or None."""
+        for kind in KINDS:
+            pending = self._pending[kind]
+            if not pending:
+                continue
+            start = min(pending)
+            end = start + 1
+            while end in pending and end - start < MAX_PER_WRITE[kind]:
+                end += 1
+            return kind, start, [pending.pop(address) for address in range(start, end)]
+        return None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self.depth() and not self._stopping:
+                    self._cond.wait()
+                if not self.depth():
+                    return
+            # Let the rest of a burst arrive before cutting it into requests
+            if self.linger:
+                time.sleep(self.linger)
+            while True:
+                self._bucket.wait()
+                with self._cond:
+                    frame = self._take_frame()
+                if frame is None:
+                    break
+                self._send(*frame)
+
+    def _send(self, kind, address, entries):
+        values = [value for value, _ in entries]
+        function = (16 if len(values) > 1 else 6) if kind == 'register' else (15 if len(values) > 1 else 5)
+        error = None
+        try:
+            with get_pool().connection(self.host, self.port, self.slave) as client:
+                if client is None:
+                    error = f"{self.name} is unreachable"
+                else:
+                    if function == 16:
+                        response = client.write_registers(address, values, slave=self.slave)
+                    elif function == 6:
+                        response = client.write_register(address, values[0], slave=self.slave)
+                    elif function == 15:
+                        response = client.write_coils(address, values, slave=self.slave)
+                    else:
+                        response = client.write_coil(address, values[0], slave=self.slave)
+                    if response.isError():
+                        error = f"{self.name} refused FC{function} at {address}: {response}"
+        except ModbusException as e:
+            error = f"FC{function} at {address} of {self.name} failed: {e}"
+        except Exception as e:
+            # Anything else still fails just this frame's tickets, never the worker
+            logger.exception(f"FC{function} at {address} of {self.name} raised")
+            error = f"FC{function} at {address} of {self.name} failed: {e!r}"
+
+        counter = self._frames.get(function)
+        if counter is None:
+            counter = self._frames[function] = metrics.WRITE_FRAMES.labels(self.name, function)
+        counter.inc()
+        if error is not None:
+            self._errors.inc()
+            logger.warning(error)
+
+        finished = []
+        with self._cond:
+            for _, tickets in entries:
+                finished.extend(ticket for ticket in tickets if ticket._point_done(error))
+        for ticket in finished:
+            self._latency.observe(ticket.latency)
+            ticket._complete()
+
+    def close(self, timeout=WRITE_TIMEOUT):
+        """Write what is queued (within timeout), then stop the worker."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+
+# --- Shared Queues ---
+_queues = {}
+_tickets = OrderedDict()  # id -> ticket, most recent TICKET_HISTORY
+_lock = threading.Lock()
+
+def register_device(name, host, port, slave, rate_limit=RATE_LIMIT, burst=RATE_BURST, writable=None):
+    """Make a device writable by name; returns its queue (the existing one if already registered)."""
+    with _lock:
+        queue = _queues.get(name)
+        if queue is None:
+            queue = _queues[name] = DeviceWriteQueue(name, host, port, slave, rate_limit, burst, writable)
+        return queue
+
+def get_queue(name):
+    """The queue of a registered device; LookupError if there is none."""
+    queue = _queues.get(name)
+    if queue is None:
+        raise LookupError(f"Unknown device {name!r}")
+    return queue
+
+def submit(device, kind, address, values):
+    """Queue a write to a registered device; see DeviceWriteQueue.submit."""
+    ticket = get_queue(device).submit(kind, address, values)
+    with _lock:
+        _tickets[ticket.id] = ticket
+        while len(_tickets) > TICKET_HISTORY:
+            _tickets.popitem(last=False)
+    return ticket
+
+def find_ticket(ticket_id):
+    """A recently submitted ticket by id, or None."""
+    return _tickets.get(ticket_id)
+
+def wait_all(tickets, timeout=WRITE_TIMEOUT):
+    """Wait for every ticket to complete; returns False if some are still pending at timeout."""
+    deadline = time.monotonic() + timeout
+    for ticket in tickets:
+        if not ticket.wait(max(0.0, deadline - time.monotonic())):
+            return False
+    return True
+
+def close_queues(timeout=WRITE_TIMEOUT):
+    """Drain and stop every device queue."""
+    with _lock:
+        queues = list(_queues.values())
+    for queue in queues:
+        queue.close(timeout)